@@ -5,9 +5,14 @@
 
 import sys
 import numpy as np
-import pandas as pd
 import subprocess
 import argparse
+import os
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),'..'))
+from opes_analysis import colvar
+from opes_analysis import reweight
+from opes_analysis import profiling
+from opes_analysis.reweight import Reweighter
 
 
 #parser
@@ -15,6 +20,7 @@ parser = argparse.ArgumentParser(description='calculate Neff over a range of tem
 parser.add_argument('--temp',dest='temp',type=float,default=300,required=False,help='the simulation temperature')
 parser.add_argument('--mintemp',dest='mintemp',type=float,default=300,required=False,help='the minimum temperature')
 parser.add_argument('--maxtemp',dest='maxtemp',type=float,default=1000,required=False,help='the maximum temperature')
+parser.add_argument('--validate',dest='validate',action='store_true',default=False,help='repeat the calculation in float128 and print the deviations')
 parser.add_argument('--tran',dest='tran',type=int,default=0,required=False,help='transient to be skipped')
 parser.add_argument('--rep',dest='wk',type=str,default='',required=False,help='replica number')
 parser.add_argument('--bck',dest='bck',type=str,default='',required=False,help='backup prefix, e.g. \"bck.0.\"')
@@ -38,18 +44,20 @@ if bck:
 ene_col=3
 bias_col=4
 #ene,bias=np.loadtxt(bck+'Colvar.data',usecols=(1,3),unpack=True,skiprows=transient)
-data=pd.read_csv(bck+'Colvar'+wk+'.data',sep='\s+',comment='#',header=None,usecols=[ene_col,bias_col],skiprows=tran)
-ene=np.array(data.iloc[:,0])
-bias=np.array(data.iloc[:,1])
-del data
+profiling.mark('load')
+ene,bias=colvar.read_columns(bck+'Colvar'+wk+'.data',[ene_col,bias_col],skiprows=tran)
+profiling.rows(len(ene))
 
 kB=0.0083144621 #kj/mol
 beta=1/(kB*temp)
 beta_range=np.linspace(1/(kB*min_temp),1/(kB*max_temp),300)
-def weights(b):
-  return np.exp(-beta*((b/beta-1)*(ene-np.mean(ene))-bias))
-neff=np.array([np.sum(weights(b))**2/np.sum(weights(b)**2) for b in beta_range])
+ene=reweight.center(ene)
+profiling.mark('reweight')
+def compute(dtype):
+  return Reweighter(ene.astype(dtype,copy=False),None,bias.astype(dtype,copy=False),temp).neff(beta_range)
+neff=reweight.validate(compute,np.float64,args.validate)
 
+profiling.mark('output')
 cmd=subprocess.Popen('bck.meup.sh -i '+outfilename,shell=True)
 cmd.wait()
 np.savetxt(outfilename,np.c_[1/(kB*beta_range),neff/len(ene)],header='temp  Neff/N')
@@ -3,12 +3,21 @@
 # Used for Fig.1b
 # Calculates the free energy difference between the alanine metastable states, as a function of temperature
 # error estimate via weighted block average
+# with --convergence also deltaF_AB and Neff over growing and shrinking windows of the data, from the same pass
 
 import sys
 import numpy as np
-import pandas as pd
-import subprocess
 import argparse
+import os
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),'..'))
+from opes_analysis import colvar
+from opes_analysis import stream
+from opes_analysis import reweight
+from opes_analysis import blocks
+from opes_analysis import convergence
+from opes_analysis import output
+from opes_analysis import profiling
+from opes_analysis.reweight import Reweighter
 
 #set columns
 cv_col=1
@@ -17,17 +26,24 @@ bias_col=4
 
 #parser
 parser = argparse.ArgumentParser(description='reweight deltaF as a function of temperature')
-parser.add_argument('--blocks',dest='num_blocks',type=int,required=True,help='number of blocks')
+parser.add_argument('--blocks',dest='num_blocks',type=int,required=True,help='number of blocks, 0 to use the recommended one from --scan')
+parser.add_argument('--scan',dest='scan',type=int,default=0,required=False,help='also print the error for any number of blocks from 2 up to this')
+parser.add_argument('--convergence',dest='stride',type=int,default=0,required=False,help='also print deltaF_AB and Neff as a function of the number of samples, every this many samples')
 parser.add_argument('--temp',dest='temp',type=float,default=300,required=False,help='the simulation temperature')
 parser.add_argument('--mintemp',dest='mintemp',type=float,default=300,required=False,help='the minimum temperature')
 parser.add_argument('--maxtemp',dest='maxtemp',type=float,default=1000,required=False,help='the maximum temperature')
 parser.add_argument('--nbins',dest='nbins',type=int,default=50,required=False,help='number of bins')
+parser.add_argument('--stream',dest='stream',action='store_true',default=False,help='read the input file in chunks, with memory independent of its length')
+parser.add_argument('--float32',dest='float32',action='store_true',default=False,help='store the bulk arrays in single precision')
+parser.add_argument('--validate',dest='validate',action='store_true',default=False,help='repeat the calculation in float128 and print the deviations')
 parser.add_argument('--tran',dest='tran',type=int,default=0,required=False,help='transient to be skipped')
 parser.add_argument('--bck',dest='bck',type=str,default='',required=False,help='backup prefix, e.g. \"bck.0.\"')
 parser.add_argument('-f',dest='filename',type=str,default='Colvar.data',required=False,help='input file name')
+parser.add_argument('--format',dest='format',type=str,default='text',required=False,help='comma separated output formats: text, npz, hdf5')
 parser.add_argument('-o',dest='outfilename',type=str,default='deltaF_AB.data',required=False,help='output file name')
 
 args = parser.parse_args()
+fmts=output.parse_formats(args.format)
 temp=args.temp
 mintemp=args.mintemp
 maxtemp=args.maxtemp
@@ -43,51 +59,96 @@ if bck:
   print('  backup: '+bck,file=sys.stderr)
 filename=args.filename
 
-data=pd.read_csv(bck+filename,sep='\s+',comment='#',header=None,usecols=[cv_col,ene_col,bias_col],skiprows=tran,dtype=np.float128)
-cv=np.array(data.iloc[:,0])
-ene=np.array(data.iloc[:,1])
-bias=np.array(data.iloc[:,2])
-del data
-ene-=np.mean(ene)
-basin=np.zeros(len(cv)) # zero if A, one if B
-for i in range(len(cv)): 
-  if cv[i]>0:
-    basin[i]=1
-
 kB=0.0083144621 #kj/mol
 beta=1/(kB*temp)
 temp_range=np.linspace(mintemp,maxtemp,nbins)
 num_blocks=args.num_blocks
-len_blocks=int(np.floor(len(ene)/num_blocks))
+if num_blocks<=0 and args.scan<2:
+  sys.exit(' --blocks 0 requires --scan')
+dtype=np.float32 if args.float32 else np.float64
+profiling.mark('load')
+if args.stream:
+  (mean_ene,),N=stream.means(bck+filename,[ene_col],skiprows=tran)
+else:
+  cv,ene,bias=colvar.read_columns(bck+filename,[cv_col,ene_col,bias_col],skiprows=tran)
+  ene=reweight.center(ene,dtype)
+  bias=bias.astype(dtype,copy=False)
+  basin=(cv>0).astype(int) # zero if A, one if B
+  N=len(ene)
+profiling.rows(N)
+scan=blocks.BlockScan(N,[num_blocks]+list(range(2,args.scan+1)))
+segments=scan
+powers=(1,)
+if args.stride>0:
+  segments=convergence.Windows(N,args.stride,bounds=scan.bounds)
+  powers=(1,2)
+
+def compute(dtype):
+  #log-sums for each power, temperature, basin and segment of the blocks (and windows)
+  if args.stream:
+    log_Z=[np.full((2*segments.nsegments,nbins),-np.inf,dtype=np.result_type(dtype,np.float64)) for p in powers]
+    first=0
+    progress=output.Progress(N,file=sys.stderr)
+    for c_cv,c_ene,c_bias in stream.iter_chunks(bck+filename,[cv_col,ene_col,bias_col],skiprows=tran,dtype=dtype):
+      progress.update(first)
+      groups=2*segments.labels(first,len(c_ene))+(c_cv>0)
+      rw=Reweighter(c_ene-mean_ene,None,c_bias,temp,labels=groups,nlabels=2*segments.nsegments)
+      log_Z=[np.logaddexp(l,s) for l,s in zip(log_Z,rw._reduce(1/(kB*temp_range),0,powers))]
+      first+=len(c_ene)
+  else:
+    groups=2*segments.labels(0,N)+basin
+    rw=Reweighter(ene.astype(dtype,copy=False),None,bias.astype(dtype,copy=False),temp,labels=groups,nlabels=2*segments.nsegments)
+    log_Z=rw._reduce(1/(kB*temp_range),0,powers)
+  return tuple(log_Z)
+profiling.mark('reweight')
+log_Z=reweight.validate(compute,dtype,args.validate)
+profiling.mark('blocks')
+if args.stride>0:
+  windows=segments
+  log_W,log_W2=log_Z
+  log_W_A=log_W[0::2].T #A is basin=0
+  log_W_B=log_W[1::2].T
+  log_W2_tot=np.logaddexp(log_W2[0::2],log_W2[1::2]).T
+  columns=[np.repeat(temp_range[:,np.newaxis],len(windows.lengths),axis=1),np.tile(windows.lengths,(nbins,1))]
+  for window in (windows.growing,windows.shrinking):
+    columns.append(window(log_W_A)-window(log_W_B))
+  for window in (windows.growing,windows.shrinking):
+    columns.append(np.exp(2*window(np.logaddexp(log_W_A,log_W_B))-window(log_W2_tot)))
+  names=['temp','nsamples','deltaF_AB','deltaF_AB_shrinking','Neff','Neff_shrinking']
+  convfilename='convergence-'+outfilename
+  output.write_grid(convfilename,names,columns,'#growing windows from the start, shrinking windows from the end',{'temp':temp,'N':N,'tran':args.tran,'stride':args.stride},fmts,fmt=['%-9g','%d','%-9g','%-9g','%-9g','%-9g'])
+  log_Z=np.empty((2*scan.nsegments,nbins))
+  log_Z[0::2]=windows.coarsen(log_W_A,scan.bounds).T
+  log_Z[1::2]=windows.coarsen(log_W_B,scan.bounds).T
+else:
+  log_Z=log_Z[0]
+
+def block_stats(num_blocks):
+  log_Z_A=scan.block_log_sums(log_Z[0::2].T,num_blocks) #A is basin=0
+  log_Z_B=scan.block_log_sums(log_Z[1::2].T,num_blocks) #B is basin=1
+  return blocks.block_average(log_Z_A-log_Z_B,np.logaddexp(log_Z_A,log_Z_B)) #deltaF,error,blocks_neff
+
+if args.scan:
+  counts=scan.counts[::-1] #increasing block size
+  stats=np.array([block_stats(n) for n in counts]) #shape (len(counts),3,nbins)
+  best=blocks.plateau(stats[:,1].T,stats[:,2].T)
+  if num_blocks<=0:
+    num_blocks=counts[blocks.recommended(stats[:,1].T,stats[:,2].T)]
+    print(' recommended num_blocks=',num_blocks,file=sys.stderr)
+  scanfilename='blocks-'+outfilename
+  n=np.array(counts)
+  columns=[np.repeat(temp_range[:,np.newaxis],len(n),axis=1),np.tile(n,(nbins,1)),np.tile(scan.nrows//n,(nbins,1)),
+           stats[:,0].T,stats[:,1].T,stats[:,2].T,best[:,np.newaxis]==np.arange(len(n))]
+  names=['temp','num_blocks','len_blocks','deltaF_AB','error','blocks_neff','recommended']
+  output.write_grid(scanfilename,names,columns,'',{'temp':temp,'N':N,'tran':args.tran},fmts,fmt=['%-9g','%d','%d','%-9g','%-9g','%-9g','%d'])
+
+len_blocks=scan.len_blocks(num_blocks)
 print(' len_blocks=',len_blocks,file=sys.stderr)
-skip=len(ene)-num_blocks*len_blocks
+skip=scan.skip(num_blocks)
 if skip!=0:
   print(' +++ WARNING blocks mismatch: throwing away first %d lines'%skip)
+deltaF,error,blocks_neff=block_stats(num_blocks)
+profiling.mark('output')
 
-def weights(T):
-  b=1/(kB*T)
-  log_w=((beta-b)*ene+beta*bias)
-  return np.exp(log_w-np.amax(log_w))
-deltaF=np.zeros(nbins)
-error=np.zeros(nbins)
-blocks_neff=np.zeros(nbins)
-for i in range(nbins):
-  print('    working... {:.0%}'.format(i/nbins),end='\r',file=sys.stderr)
-  block_w=np.zeros(num_blocks)
-  Z_A=np.zeros(num_blocks)
-  Z_B=np.zeros(num_blocks)
-  w=weights(temp_range[i])
-  for n in range(num_blocks):
-    mask=slice(skip+n*len_blocks,skip+(n+1)*len_blocks)
-    block_w[n]=np.sum(w[mask])
-    Z_A[n]=np.sum(w[mask]*(1-basin[mask])) #A is basin=0
-    Z_B[n]=np.sum(w[mask]*basin[mask]) #B is basin=1
-  blocks_neff[i]=np.sum(block_w)**2/np.sum(block_w**2)
-  deltaF[i]=np.average(-np.log(Z_B/Z_A),axis=0,weights=block_w)
-  error[i]=np.sqrt(1/(blocks_neff[i]-1)*np.average((-np.log(Z_B/Z_A)-deltaF[i])**2,axis=0,weights=block_w))
-
-
-head='temp deltaF_AB error blocks_neff #num_blocks=%g'%num_blocks
-cmd=subprocess.Popen('bck.meup.sh -i '+outfilename,shell=True)
-cmd.wait()
-np.savetxt(outfilename,np.c_[temp_range,deltaF,error,blocks_neff],header=head,fmt='%-9g')
+metadata={'temp':temp,'N':N,'tran':args.tran,'num_blocks':num_blocks}
+output.write_grid(outfilename,['temp','deltaF_AB','error','blocks_neff'],[temp_range,deltaF,error,blocks_neff],'#num_blocks=%g'%num_blocks,metadata,fmts,fmt='%-9g')
@@ -0,0 +1,225 @@
+#! /usr/bin/env python3
+
+### Time the analysis kernels and scripts on synthetic Colvar files, and check their results against figures/ ###
+# usage: ./Run_benchmarks.py --sizes 1e4,1e5,1e6 --walkers 1,40 -o benchmark.json
+#    or: ./Run_benchmarks.py --systems sodium --sizes 1e7 --compare old-benchmark.json
+# each system has the load, weight and grid stages of its scripts, timed in this process, and the whole script, in a subprocess
+# results are written as JSON, with the commit and the machine, and --compare flags the stages slower than a previous run
+
+import sys
+import numpy as np
+import argparse
+import os
+import json
+import time
+import platform
+import subprocess
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),'..'))
+from opes_analysis import colvar
+from opes_analysis import kde
+from opes_analysis import backup
+from opes_analysis import synthetic
+from opes_analysis.reweight import Reweighter
+from opes_analysis.reweight import kB
+
+root=os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+#parser
+parser = argparse.ArgumentParser(description='benchmark the analysis on synthetic data')
+parser.add_argument('--systems',dest='systems',type=str,default='model,alanine,chignolin,sodium',required=False,help='comma separated systems, among: '+', '.join(synthetic.systems))
+parser.add_argument('--sizes',dest='sizes',type=str,default='1e4,1e5',required=False,help='comma separated number of rows, e.g. 1e4,1e6,1e8')
+parser.add_argument('--walkers',dest='walkers',type=str,default='1',required=False,help='comma separated number of walkers')
+parser.add_argument('--repeat',dest='repeat',type=int,default=3,required=False,help='repeat each stage this many times and keep the fastest')
+parser.add_argument('--no_scripts',dest='no_scripts',action='store_true',default=False,help='only time the stages, without running the whole scripts')
+parser.add_argument('--check_rows',dest='check_rows',type=float,default=1e5,required=False,help='check the results against figures/ only with at least this many rows')
+parser.add_argument('--seed',dest='seed',type=int,default=0,required=False,help='random seed of the synthetic data')
+parser.add_argument('--workdir',dest='workdir',type=str,default='bench_data',required=False,help='folder for the synthetic data and the outputs of the scripts')
+parser.add_argument('--compare',dest='compare',type=str,default='',required=False,help='previous results, to report the ratios of the times')
+parser.add_argument('--threshold',dest='threshold',type=float,default=0.2,required=False,help='relative slowdown reported as a regression')
+parser.add_argument('-o',dest='outfilename',type=str,default='benchmark.json',required=False,help='output file name')
+args = parser.parse_args()
+names=args.systems.split(',')
+for name in names:
+  if name not in synthetic.systems:
+    sys.exit(' unknown system "%s", choose among: %s'%(name,', '.join(synthetic.systems)))
+sizes=[int(float(s)) for s in args.sizes.split(',')]
+walkers=[int(w) for w in args.walkers.split(',')]
+os.makedirs(args.workdir,exist_ok=True)
+env=dict(os.environ,OPES_COLVAR_CACHE='0',OPES_RESULT_CACHE='0')
+
+def timed(func,*a):
+  # fastest of args.repeat calls, and the last result
+  best=np.inf
+  for r in range(args.repeat):
+    start=time.perf_counter()
+    res=func(*a)
+    best=min(best,time.perf_counter()-start)
+  return best,res
+
+def load(filename,cols,cached):
+  os.environ['OPES_COLVAR_CACHE']='1' if cached else '0'
+  try:
+    return colvar.read_columns(filename,cols)
+  finally:
+    os.environ['OPES_COLVAR_CACHE']='0'
+
+#stages of each system, as in its scripts: columns to load, then weight(columns) and grid(columns,weights)
+def model_weight(c):
+  x,bias=c
+  return np.exp(bias-np.amax(bias))
+def model_grid(c,w):
+  return kde.binned_gaussian_sums(c[0],w,np.linspace(-3,3,100),0.03)
+
+def alanine_weight(c):
+  x,y,ene,bias=c
+  kbt=kB*synthetic.Alanine.temp
+  log_w=np.multiply.outer(1/kbt-1/(kB*np.array([300,500,1000])),ene-np.mean(ene))+bias/kbt
+  return np.exp(log_w-np.amax(log_w,axis=1,keepdims=True))
+def alanine_grid(c,w):
+  grid=np.linspace(-np.pi,np.pi,100)
+  return kde.binned_periodic_gaussian_sums_2d(c[0],c[1],w,grid,grid,0.15,2*np.pi)
+
+def chignolin_weight(c):
+  ene,vol,bias,basin=c
+  rw=Reweighter(ene-np.mean(ene),vol-np.mean(vol),bias,synthetic.Chignolin.temp,synthetic.Chignolin.pres*0.06022140857,labels=basin,nlabels=2)
+  return rw._reduce(1/(kB*np.linspace(280,370,50)),0.06022140857,(1,))
+def chignolin_grid(c,w):
+  ene,vol,bias,basin=c
+  rw=Reweighter(ene-np.mean(ene),vol-np.mean(vol),bias,synthetic.Chignolin.temp,synthetic.Chignolin.pres*0.06022140857)
+  t,p=np.meshgrid(np.linspace(280,370,50),np.linspace(1,4000,20))
+  return rw.neff(1/(kB*t),0.06022140857*p)
+
+def sodium_weight(c):
+  ene,vol,cv,bias=c
+  rw=Reweighter(ene-np.mean(ene),vol-np.mean(vol),bias,synthetic.Sodium.temp,synthetic.Sodium.pres*0.06022140857)
+  return rw.log_weights(1/(kB*synthetic.Sodium.temp),synthetic.Sodium.pres*0.06022140857)
+def sodium_grid(c,w):
+  cv=c[2]/synthetic.Sodium.rescale_cv
+  return kde.truncated_log_sums(cv,w,np.linspace(0,1,100),0.01,np.zeros(len(cv),dtype=int),1)
+
+stages={'model':([1,3],model_weight,model_grid),
+        'alanine':([1,2,3,4],alanine_weight,alanine_grid),
+        'chignolin':([1,2,4,5],chignolin_weight,chignolin_grid),
+        'sodium':([1,2,4,5],sodium_weight,sodium_grid)}
+
+#whole scripts: input file name, command and output file
+scripts={'model':('Colvar.0.data',['model/Reweight-multi.py','-r','0'],'FES_rew.0.data'),
+         'alanine':('Colvar.data',['alanine/Reweight-ala2D-temp.py','300'],'FES_rew2D-T300.0.data'),
+         'chignolin':('all_Colvar.data',['chignolin/Analyze_temp_folding.py','--tran','0','--temp','%g'%synthetic.Chignolin.temp,'--pres','%g'%synthetic.Chignolin.pres,'--rewpres','1'],'temp_folded.data'),
+         'sodium':('all_Colvar.data',['sodium/Reweight-blocks.py','--blocks','10','--temp','%g'%synthetic.Sodium.temp,'--pres','%g'%synthetic.Sodium.pres,
+                   '--rewtemp','%g'%synthetic.Sodium.temp,'--rewpres','%g'%synthetic.Sodium.pres],'FES_rew.data')}
+
+#checks of the outputs of the scripts: deviation from the reference and tolerance
+#the FES are compared with the same KDE of the exact distribution of the synthetic data, so that only the statistical
+#error is left: the tolerance is a little above the largest deviation seen at 1e5 rows, scaled as 1/sqrt(rows),
+#plus 2e-3 for the binned KDE
+def _shifted_rms(fes,ref,region):
+  # rms deviation in region, up to the additive constant of free energies
+  d=(fes-ref)[region]
+  return np.sqrt(np.mean((d-np.mean(d))**2))
+
+def _tolerance(tol,nrows):
+  return tol*np.sqrt(1e5/nrows)+2e-3
+
+def check_model(system,out,nrows):
+  x,fes=np.loadtxt(out,unpack=True)
+  ref=-np.log(kde.gaussian_sums(*system.reweighted_nodes(),x,0.03))
+  ref-=np.amin(ref)
+  return _shifted_rms(fes,ref,ref<8),_tolerance(0.035,nrows)
+
+def check_alanine(system,out,nrows):
+  x,y,fes=np.loadtxt(out,unpack=True)
+  grid=np.linspace(-np.pi,np.pi,100)
+  nodes,w=system.reweighted_nodes(2)
+  ref=-np.log(kde.binned_periodic_gaussian_sums_2d(nodes[:,0],nodes[:,1],w,grid,grid,0.15,2*np.pi)[0])
+  i=np.rint((np.c_[x,y]+np.pi)/(grid[1]-grid[0])).astype(int)
+  ref=ref[i[:,1],i[:,0]]
+  ref-=np.amin(ref)
+  return _shifted_rms(fes,ref,ref<4),_tolerance(0.035,nrows)
+
+def check_chignolin(system,out,nrows):
+  temps,fraction,error=np.loadtxt(out,usecols=(0,1,2),unpack=True)
+  ref=system.folded_fraction(temps)
+  return np.amax(np.abs(fraction-ref)),_tolerance(0.008,nrows)
+
+def check_sodium(system,out,nrows):
+  cv,fes,error=np.loadtxt(out,usecols=(0,1,2),unpack=True)
+  ref=-np.log(kde.gaussian_sums(*system.reweighted_nodes(16),cv,0.01))
+  ref-=np.amin(ref)
+  return _shifted_rms(fes,ref,ref<15),_tolerance(0.012,nrows)
+
+checks={'model':check_model,'alanine':check_alanine,'chignolin':check_chignolin,'sodium':check_sodium}
+
+def git_commit():
+  try:
+    return subprocess.run(['git','rev-parse','HEAD'],cwd=root,capture_output=True,text=True,check=True).stdout.strip()
+  except (OSError,subprocess.CalledProcessError):
+    return ''
+
+#run
+meta={'commit':git_commit(),'date':time.strftime('%Y-%m-%d %H:%M:%S'),'machine':platform.machine(),'processor':platform.processor(),
+      'cpus':os.cpu_count(),'python':platform.python_version(),'numpy':np.__version__,'repeat':args.repeat,'seed':args.seed}
+results=[]
+for name in names:
+  system=synthetic.systems[name]()
+  cols,weight,grid=stages[name]
+  infile,command,out=scripts[name]
+  for nrows in sizes:
+    for nw in walkers:
+      print(' %s: %d rows, %d walkers'%(name,nrows,nw),file=sys.stderr)
+      folder=os.path.join(args.workdir,'%s-%d-%d'%(name,nrows,nw))
+      os.makedirs(folder,exist_ok=True)
+      filename=os.path.join(folder,infile)
+      gen_time=time.perf_counter()
+      system.write(filename,nrows,nw,args.seed)
+      gen_time=time.perf_counter()-gen_time
+      record={'system':name,'rows':nrows,'walkers':nw,'bytes':os.path.getsize(filename),'times':{'generate':gen_time}}
+      record['times']['load'],columns=timed(load,filename,cols,False)
+      os.environ['OPES_COLVAR_CACHE']='1'
+      start=time.perf_counter()
+      colvar.convert(filename)
+      record['times']['convert']=time.perf_counter()-start
+      os.environ['OPES_COLVAR_CACHE']='0'
+      record['times']['load_cached'],columns=timed(load,filename,cols,True)
+      record['times']['weight'],w=timed(weight,columns)
+      record['times']['grid'],res=timed(grid,columns,w)
+      if not args.no_scripts:
+        start=time.perf_counter()
+        proc=subprocess.run([sys.executable,os.path.join(root,command[0])]+command[1:],cwd=folder,env=env,capture_output=True,text=True)
+        record['times']['script']=time.perf_counter()-start
+        if proc.returncode!=0:
+          record['error']=proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else 'exit code %d'%proc.returncode
+          print(' +++ WARNING %s failed: %s +++'%(command[0],record['error']),file=sys.stderr)
+        elif nrows>=args.check_rows:
+          deviation,tol=checks[name](system,os.path.join(folder,out),nrows)
+          record['check']={'reference':system.reference,'deviation':float(deviation),'tolerance':tol,'passed':bool(deviation<=tol)}
+          if deviation>tol:
+            print(' +++ WARNING %s deviates from %s: %g > %g +++'%(name,system.reference,deviation,tol),file=sys.stderr)
+      record['rows_per_s']={k:nrows/t for k,t in record['times'].items() if t>0}
+      print('   '+'  '.join('%s %.3gs'%kv for kv in record['times'].items()),file=sys.stderr)
+      results.append(record)
+
+#output
+backup.backup(args.outfilename)
+with open(args.outfilename,'w') as f:
+  json.dump({'meta':meta,'results':results},f,indent=1)
+failed=[r for r in results if 'error' in r or not r.get('check',{}).get('passed',True)]
+print(' %d benchmarks, %d failed checks, results in %s'%(len(results),len(failed),args.outfilename),file=sys.stderr)
+
+if args.compare:
+  with open(args.compare) as f:
+    old={(r['system'],r['rows'],r['walkers']):r for r in json.load(f)['results']}
+  print('#system rows walkers stage old_time new_time ratio')
+  regressions=0
+  for r in results:
+    o=old.get((r['system'],r['rows'],r['walkers']))
+    if o is None:
+      continue
+    for stage,t in r['times'].items():
+      if stage in o['times'] and stage!='generate':
+        ratio=t/o['times'][stage]
+        flag=' +++ slower +++' if ratio>1+args.threshold else ''
+        regressions+=flag!=''
+        print('%s %d %d %s %.4g %.4g %.3f%s'%(r['system'],r['rows'],r['walkers'],stage,o['times'][stage],t,ratio,flag))
+  if regressions:
+    print(' +++ WARNING %d stages slower than in %s by more than %g%% +++'%(regressions,args.compare,100*args.threshold),file=sys.stderr)
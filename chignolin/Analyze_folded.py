@@ -6,9 +6,17 @@
 
 import sys
 import numpy as np
-import pandas as pd
-import subprocess
 import argparse
+import os
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),'..'))
+from opes_analysis import colvar
+from opes_analysis import reweight
+from opes_analysis import bootstrap
+from opes_analysis import output
+from opes_analysis import profiling
+from opes_analysis.reweight import Reweighter
+from opes_analysis.binned import BinnedReweighter
+from opes_analysis.results import ResultCache
 
 #set columns
 ene_col=1
@@ -25,12 +33,21 @@ parser.add_argument('--pres',dest='pres',type=float,default=2000,required=False,
 parser.add_argument('--minpres',dest='minpres',type=float,default=1,required=False,help='the minimum preserature')
 parser.add_argument('--maxpres',dest='maxpres',type=float,default=4000,required=False,help='the maximum preserature')
 parser.add_argument('--nbins',dest='nbins',type=int,default=50,required=False,help='number of bins')
+parser.add_argument('--tol',dest='tol',type=float,default=0,required=False,help='accuracy bound on the log partition sums, if positive use the binned (ene,vol) index instead of exact reweighting')
+parser.add_argument('--float32',dest='float32',action='store_true',default=False,help='store the bulk arrays in single precision')
+parser.add_argument('--validate',dest='validate',action='store_true',default=False,help='repeat the calculation in float128 and print the deviations')
+parser.add_argument('--bootstrap',dest='bootstrap',type=int,default=0,required=False,help='number of moving-block bootstrap replicas, to print also a confidence interval')
+parser.add_argument('--boot_block',dest='boot_block',type=int,default=1000,required=False,help='length in samples of the bootstrap blocks')
+parser.add_argument('--level',dest='level',type=float,default=0.95,required=False,help='confidence level of the bootstrap interval')
+parser.add_argument('--nproc',dest='nproc',type=int,default=0,required=False,help='number of processes for the bootstrap, 0 to use all the cores')
 parser.add_argument('--tran',dest='tran',type=int,default=400000,required=False,help='transient to be skipped')
 parser.add_argument('--bck',dest='bck',type=str,default='',required=False,help='backup prefix, e.g. \"bck.0.\"')
 parser.add_argument('-f',dest='filename',type=str,default='all_Colvar.data',required=False,help='input file name')
+parser.add_argument('--format',dest='format',type=str,default='text',required=False,help='comma separated output formats: text, npz, hdf5')
 parser.add_argument('-o',dest='outfilename',type=str,default='fraction_folded.data',required=False,help='output file name')
 
 args = parser.parse_args()
+fmts=output.parse_formats(args.format)
 temp=args.temp
 min_temp=args.mintemp
 max_temp=args.maxtemp
@@ -50,47 +67,52 @@ if bck:
   print('  backup: '+bck)
 filename=args.filename
 
-data=pd.read_csv(bck+filename,sep='\s+',comment='#',header=None,usecols=[ene_col,vol_col,bias_col,basin_col],skiprows=tran,dtype=np.float128)
-ene=np.array(data.iloc[:,0])
-vol=np.array(data.iloc[:,1])
-bias=np.array(data.iloc[:,2])
-basin=np.array(data.iloc[:,3])
-del data
-ene-=np.mean(ene)
-vol-=np.mean(vol)
+profiling.mark('load')
+ene,vol,bias,basin=colvar.read_columns(bck+filename,[ene_col,vol_col,bias_col,basin_col],skiprows=tran)
+dtype=np.float32 if args.float32 else np.float64
+ene=reweight.center(ene,dtype)
+vol=reweight.center(vol,dtype)
+bias=bias.astype(dtype,copy=False)
 print('  all data loaded')
+profiling.rows(len(ene))
 
-# f=folded, u=unfolded
-f_ene=ene[basin==0]
-u_ene=ene[basin==1]
-if len(ene)!=len(f_ene)+len(u_ene):
+# f=folded is basin=0, u=unfolded is basin=1
+if np.any((basin!=0)&(basin!=1)):
   sys.exit('basin column should contain only 0 or 1')
-del ene
-f_vol=vol[basin==0]
-u_vol=vol[basin==1]
-del vol
-f_bias=bias[basin==0]
-u_bias=bias[basin==1]
-del bias
+N_fold=np.sum(basin==0)
+N_unfold=len(basin)-N_fold
 
 kB=0.0083144621 #kj/mol
 beta=1/(kB*temp)
 temp_range=np.linspace(min_temp,max_temp,nbins)
 pres_range=np.linspace(min_pres,max_pres,nbins)
 t,p=np.meshgrid(temp_range,pres_range)
-def f_weights(_b,_p):
-  return np.exp((beta-_b)*f_ene+(beta*pres-_b*_p)*f_vol+beta*f_bias)
-def u_weights(_b,_p):
-  return np.exp((beta-_b)*u_ene+(beta*pres-_b*_p)*u_vol+beta*u_bias)
+profiling.mark('reweight')
+cache=ResultCache(bck+filename,enabled=args.tol<=0,cols=[ene_col,vol_col,bias_col,basin_col],tran=tran)
+def compute(dtype):
+  rw=Reweighter(ene.astype(dtype,copy=False),vol.astype(dtype,copy=False),bias.astype(dtype,copy=False),temp,pres,labels=basin,nlabels=2)
+  if args.tol>0:
+    rw=BinnedReweighter(rw,1/(kB*t),p,tol=args.tol)
+    print('  binned index: %d occupied bins, tol=%g'%(rw.nbins,args.tol))
+    log_f,log_u=rw.log_sums(1/(kB*t),p)
+  else:
+    log_f,log_u=cache.log_sums(rw,1/(kB*t),p)[0]
+  return 1/(1+np.exp(log_u-log_f)),-(log_u-log_f)
+fraction_folded,deltaG=reweight.validate(compute,dtype,args.validate)
+cache.report()
+if args.bootstrap:
+  profiling.mark('bootstrap')
+  rep=bootstrap.bootstrap_log_sums(ene,vol,bias,temp,pres,1/(kB*t),p,labels=basin,nlabels=2,segment_len=max(1,args.boot_block//4),block_len=4,nrep=args.bootstrap,processes=args.nproc or None)[1]
+  fraction_low,fraction_high=bootstrap.confidence_interval(1/(1+np.exp(rep[:,1]-rep[:,0])),args.level)
+  deltaG_low,deltaG_high=bootstrap.confidence_interval(-(rep[:,1]-rep[:,0]),args.level)
+profiling.mark('output')
 
-cmd=subprocess.Popen('bck.meup.sh -i '+outfilename,shell=True)
-cmd.wait()
-outfile=open(outfilename,'w')
-print('#temp  pres  fraction_folded  deltaG  # N_fold=%d N_unfold=%d'%(len(f_ene),len(u_ene)),file=outfile)
-for i in range(nbins):
-  for j in range(nbins):
-    print('    working... {:.0%}'.format((i*nbins+j)/(nbins*nbins)),end='\r')
-    f_count=np.sum(f_weights(1/(kB*t[i,j]),p[i,j]))
-    u_count=np.sum(u_weights(1/(kB*t[i,j]),p[i,j]))
-    print(t[i,j],p[i,j]/from_bar,f_count/(f_count+u_count),-np.log(u_count/f_count),file=outfile)
-  print('',file=outfile)
+names=['temp','pres','fraction_folded','deltaG']
+columns=[t,p/from_bar,fraction_folded,deltaG]
+comment='# N_fold=%d N_unfold=%d'%(N_fold,N_unfold)
+if args.bootstrap:
+  names+=['fraction_low','fraction_high','deltaG_low','deltaG_high']
+  columns+=[fraction_low,fraction_high,deltaG_low,deltaG_high]
+  comment+=', %g%% bootstrap interval'%(100*args.level)
+metadata={'temp':temp,'pres':args.pres,'N':len(basin),'N_fold':N_fold,'N_unfold':N_unfold,'tran':args.tran}
+output.write_grid(outfilename,names,columns,comment,metadata,fmts)
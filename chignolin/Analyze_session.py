@@ -0,0 +1,91 @@
+#! /usr/bin/env python3
+
+# Runs several analyses on all_Colvar.data, loading it only once
+# usage: ./Analyze_session.py 'folded' 'neff' 'histo --nbins 300' 'temp_folding --blocks 0 --scan 20'
+#    or: ./Analyze_session.py --jobs jobs.dat   (one job per line)
+# jobs and their defaults are the same as Analyze_folded.py, Analyze_neff-2D.py, Analyze_histo-2D.py and Analyze_temp_folding.py
+# jobs on the same (T,P) grid share a single reweighting pass, e.g. folded and neff with the default grids
+# CAUTION: run Prepare_analysis.sh  before this
+
+import sys
+import numpy as np
+import argparse
+import os
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),'..'))
+from opes_analysis import colvar
+from opes_analysis import reweight
+from opes_analysis import output
+from opes_analysis import profiling
+from opes_analysis import session
+
+#set columns
+ene_col=1
+vol_col=2
+bias_col=4
+basin_col=5
+
+grid_defaults={'mintemp':270,'maxtemp':800,'minpres':1,'maxpres':4000,'nbins':50}
+
+class Folded(session.TwoStateGrid):
+  name='folded'
+  help='fraction folded and DeltaG over a range of temperatures and pressures'
+  fraction='fraction_folded'
+  defaults=dict(grid_defaults,outfilename='fraction_folded.data')
+
+class Neff(session.NeffGrid):
+  name='neff'
+  help='effective sample size over a range of temperatures and pressures'
+  defaults=dict(grid_defaults,outfilename='Neff-2D.data')
+
+class Histo(session.Histo2D):
+  name='histo'
+  help='histogram of energies and volumes'
+  defaults={'nbins':300,'outfilename':'Histo-2D.data'}
+
+class TempFolding(session.TempBlocks):
+  name='temp_folding'
+  help='folded fraction at fixed pressure for different temperatures, with block average uncertainty'
+  defaults={'num_blocks':4,'mintemp':280,'maxtemp':370,'rewpres':1,'nbins':50,'outfilename':'temp_folded.data'}
+
+#parser
+parser = argparse.ArgumentParser(description='run several analyses loading the data only once')
+parser.add_argument('jobs',type=str,nargs='*',help='jobs, with their own options, e.g. \"neff --nbins 30\". Available: folded, neff, histo, temp_folding')
+parser.add_argument('--jobs',dest='jobfile',type=str,default=None,required=False,help='file with one job per line')
+parser.add_argument('--temp',dest='temp',type=float,default=500,required=False,help='the simulation temperature')
+parser.add_argument('--pres',dest='pres',type=float,default=2000,required=False,help='the simulation pressure (bar)')
+parser.add_argument('--float32',dest='float32',action='store_true',default=False,help='store the bulk arrays in single precision')
+parser.add_argument('--nproc',dest='nproc',type=int,default=0,required=False,help='number of processes, 0 to use all the cores')
+parser.add_argument('--tran',dest='tran',type=int,default=400000,required=False,help='transient to be skipped')
+parser.add_argument('--bck',dest='bck',type=str,default='',required=False,help='backup prefix, e.g. \"bck.0.\"')
+parser.add_argument('-f',dest='filename',type=str,default='all_Colvar.data',required=False,help='input file name')
+parser.add_argument('--format',dest='format',type=str,default='text',required=False,help='comma separated output formats: text, npz, hdf5')
+args = parser.parse_args()
+fmts=output.parse_formats(args.format)
+jobs=session.read_jobs(args.jobs,args.jobfile)
+if len(jobs)==0:
+  sys.exit(' no jobs given')
+from_bar=0.06022140857
+tran=args.tran
+if tran:
+  print('  tran =',tran)
+  Folded.skip=TempFolding.skip=1 #as Analyze_folded.py and Analyze_temp_folding.py, where the first line is counted as a comment
+bck=args.bck
+if bck:
+  print('  backup: '+bck)
+
+profiling.mark('load')
+ene,vol,bias,basin=colvar.read_columns(bck+args.filename,[ene_col,vol_col,bias_col,basin_col],skiprows=tran)
+dtype=np.float32 if args.float32 else np.float64
+mean_ene=np.mean(ene,dtype=np.float64)
+mean_vol=np.mean(vol,dtype=np.float64)
+ene=reweight.center(ene,dtype)
+vol=reweight.center(vol,dtype)
+bias=bias.astype(dtype,copy=False)
+print('  all data loaded')
+profiling.rows(len(ene))
+# f=folded is basin=0, u=unfolded is basin=1
+if np.any((basin!=0)&(basin!=1)):
+  sys.exit('basin column should contain only 0 or 1')
+
+s=session.Session(ene,vol,bias,args.temp,args.pres*from_bar,basin,tran=tran,fmts=fmts,mean_ene=mean_ene,mean_vol=mean_vol)
+session.run_jobs(s,[Folded,Neff,Histo,TempFolding],jobs,args.nproc or None)
@@ -2,16 +2,28 @@
 
 # Default arguments used for the inset of Fig.3
 # Calculates the folded fraction at fixed pressure for different temperatures, estimating the uncertainties with block average
+# with --convergence also the folded fraction, deltaG and Neff over growing and shrinking windows of the data, from the same pass
+# with --autocorr also the autocorrelation of each walker, used to choose the blocks and to correct their error
 # CAUTION: run Prepare_analysis.sh  before this
 
 import sys
 import numpy as np
-import pandas as pd
-import subprocess
 import argparse
+import os
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),'..'))
+from opes_analysis import colvar
+from opes_analysis import stream
+from opes_analysis import reweight
+from opes_analysis import blocks
+from opes_analysis import convergence
+from opes_analysis import autocorr
+from opes_analysis import output
+from opes_analysis import profiling
+from opes_analysis.reweight import Reweighter
 
 
 #set columns
+time_col=0
 ene_col=1
 vol_col=2
 bias_col=4
@@ -19,19 +31,28 @@ basin_col=5
 
 #parser
 parser = argparse.ArgumentParser(description='reweight as a function of a CV for a given temperature and pressure')
-parser.add_argument('--blocks',dest='num_blocks',type=int,default=4,required=False,help='number of blocks')
+parser.add_argument('--blocks',dest='num_blocks',type=int,default=4,required=False,help='number of blocks, 0 to use the recommended one from --scan')
+parser.add_argument('--scan',dest='scan',type=int,default=0,required=False,help='also print the error for any number of blocks from 2 up to this')
+parser.add_argument('--convergence',dest='stride',type=int,default=0,required=False,help='also print folded fraction, deltaG and Neff as a function of the number of samples, every this many samples')
+parser.add_argument('--autocorr',dest='autocorr',action='store_true',default=False,help='also estimate the autocorrelation time of each walker, to choose the blocks (with --blocks 0) and correct their error')
+parser.add_argument('--walker_col',dest='walker_col',type=int,default=-1,required=False,help='column with the walker index, if negative the walker is the rank of the row among those with the same time')
 parser.add_argument('--temp',dest='temp',type=float,default=500,required=False,help='the simulation temperature')
 parser.add_argument('--mintemp',dest='mintemp',type=float,default=280,required=False,help='the minimum temperature')
 parser.add_argument('--maxtemp',dest='maxtemp',type=float,default=370,required=False,help='the maximum temperature')
 parser.add_argument('--pres',dest='pres',type=float,default=2000,required=False,help='the simulation pressure (bar)')
 parser.add_argument('--rewpres',dest='rewpres',type=float,default=1,required=False,help='the reweighting pressure (bar)')
 parser.add_argument('--nbins',dest='nbins',type=int,default=50,required=False,help='number of bins')
+parser.add_argument('--stream',dest='stream',action='store_true',default=False,help='read the input file in chunks, with memory independent of its length')
+parser.add_argument('--float32',dest='float32',action='store_true',default=False,help='store the bulk arrays in single precision')
+parser.add_argument('--validate',dest='validate',action='store_true',default=False,help='repeat the calculation in float128 and print the deviations')
 parser.add_argument('--tran',dest='tran',type=int,default=400000,required=False,help='transient to be skipped')
 parser.add_argument('--bck',dest='bck',type=str,default='',required=False,help='backup prefix, e.g. \"bck.0.\"')
 parser.add_argument('-f',dest='filename',type=str,default='all_Colvar.data',required=False,help='input file name')
+parser.add_argument('--format',dest='format',type=str,default='text',required=False,help='comma separated output formats: text, npz, hdf5')
 parser.add_argument('-o',dest='outfilename',type=str,default='temp_folded.data',required=False,help='output file name')
 
 args = parser.parse_args()
+fmts=output.parse_formats(args.format)
 temp=args.temp
 mintemp=args.mintemp
 maxtemp=args.maxtemp
@@ -50,50 +71,141 @@ if bck:
   print('  backup: '+bck,file=sys.stderr)
 filename=args.filename
 
-data=pd.read_csv(bck+filename,sep='\s+',comment='#',header=None,usecols=[ene_col,vol_col,bias_col,basin_col],skiprows=tran,dtype=np.float128)
-ene=np.array(data.iloc[:,0])
-vol=np.array(data.iloc[:,1])
-bias=np.array(data.iloc[:,2])
-basin=np.array(data.iloc[:,3])
-del data
-ene-=np.mean(ene)
-vol-=np.mean(vol)
-
-
 kB=0.0083144621 #kj/mol
 beta=1/(kB*temp)
 temp_range=np.linspace(mintemp,maxtemp,nbins)
 num_blocks=args.num_blocks
-len_blocks=int(np.floor(len(ene)/num_blocks))
+if num_blocks<=0 and args.scan<2 and not args.autocorr:
+  sys.exit(' --blocks 0 requires --scan or --autocorr')
+if args.autocorr and args.stream:
+  sys.exit(' --autocorr is not available with --stream')
+dtype=np.float32 if args.float32 else np.float64
+profiling.mark('load')
+if args.stream:
+  (mean_ene,mean_vol),N=stream.means(bck+filename,[ene_col,vol_col],skiprows=tran)
+else:
+  ene,vol,bias,basin=colvar.read_columns(bck+filename,[ene_col,vol_col,bias_col,basin_col],skiprows=tran)
+  ene=reweight.center(ene,dtype)
+  vol=reweight.center(vol,dtype)
+  bias=bias.astype(dtype,copy=False)
+  N=len(ene)
+profiling.rows(N)
+if args.autocorr:
+  profiling.mark('autocorr')
+  #reweighted autocorrelation of the folded indicator at each temperature, and that of the bias
+  walker=colvar.read_columns(bck+filename,[args.walker_col if args.walker_col>=0 else time_col],skiprows=tran)[0]
+  walker=walker.astype(int) if args.walker_col>=0 else autocorr.walker_labels(walker)
+  nwalkers=np.amax(walker)+1
+  folded=(basin==0).astype(np.float64)
+  acfs=[]
+  for rew_temp in temp_range:
+    rew_beta=1/(kB*rew_temp)
+    log_w=(beta-rew_beta)*ene.astype(np.float64)+(beta*pres-rew_beta*rewpres)*vol.astype(np.float64)+beta*bias.astype(np.float64)
+    acfs.append(autocorr.Autocorrelation(folded,walker,log_w))
+  tau=np.array([a.tau for a in acfs])
+  bias_acf=autocorr.Autocorrelation(bias,walker)
+  print(' %d walkers, autocorrelation time of the bias: %g, of the folded fraction: from %g to %g samples'%(nwalkers,bias_acf.tau,np.amin(tau),np.amax(tau)),file=sys.stderr)
+  if num_blocks<=0:
+    num_blocks=autocorr.num_blocks(N,nwalkers,np.amax(tau))
+    print(' num_blocks from the autocorrelation time=',num_blocks,file=sys.stderr)
+  nlags=min(len(bias_acf.rho),2*max(a.window for a in acfs+[bias_acf])+1)
+  columns=[np.repeat(temp_range[:,np.newaxis],nlags,axis=1),np.tile(np.arange(nlags),(nbins,1)),
+           np.array([a.rho[:nlags] for a in acfs]),np.tile(bias_acf.rho[:nlags],(nbins,1))]
+  metadata={'temp':temp,'pres':args.pres,'rewpres':args.rewpres,'N':N,'tran':args.tran,'nwalkers':nwalkers,'tau_bias':bias_acf.tau}
+  output.write_grid('autocorr-'+outfilename,['temp','lag','rho','rho_bias'],columns,'#lag in samples of each walker',metadata,fmts,fmt=['%-9g','%d','%-9g','%-9g'])
+scan=blocks.BlockScan(N,[num_blocks]+list(range(2,args.scan+1)))
+segments=scan
+powers=(1,)
+if args.stride>0:
+  segments=convergence.Windows(N,args.stride,bounds=scan.bounds)
+  powers=(1,2)
+
+def compute(dtype):
+  #log-sums for each power, temperature, basin and segment of the blocks (and windows)
+  if args.stream:
+    log_Z=[np.full((2*segments.nsegments,nbins),-np.inf,dtype=np.result_type(dtype,np.float64)) for p in powers]
+    first=0
+    progress=output.Progress(N,file=sys.stderr)
+    for c_ene,c_vol,c_bias,c_basin in stream.iter_chunks(bck+filename,[ene_col,vol_col,bias_col,basin_col],skiprows=tran,dtype=dtype):
+      progress.update(first)
+      groups=2*segments.labels(first,len(c_ene))+c_basin.astype(int)
+      rw=Reweighter(c_ene-mean_ene,c_vol-mean_vol,c_bias,temp,pres,labels=groups,nlabels=2*segments.nsegments)
+      log_Z=[np.logaddexp(l,s) for l,s in zip(log_Z,rw._reduce(1/(kB*temp_range),rewpres,powers))]
+      first+=len(c_ene)
+  else:
+    groups=2*segments.labels(0,N)+basin.astype(int)
+    rw=Reweighter(ene.astype(dtype,copy=False),vol.astype(dtype,copy=False),bias.astype(dtype,copy=False),temp,pres,labels=groups,nlabels=2*segments.nsegments)
+    log_Z=rw._reduce(1/(kB*temp_range),rewpres,powers)
+  return tuple(log_Z)
+profiling.mark('reweight')
+log_Z=reweight.validate(compute,dtype,args.validate)
+profiling.mark('blocks')
+if args.stride>0:
+  windows=segments
+  log_W,log_W2=log_Z
+  log_W_f=log_W[0::2].T #folded is basin=0
+  log_W_u=log_W[1::2].T
+  log_W2_tot=np.logaddexp(log_W2[0::2],log_W2[1::2]).T
+  columns=[np.repeat(temp_range[:,np.newaxis],len(windows.lengths),axis=1),np.tile(windows.lengths,(nbins,1))]
+  deltaG=[window(log_W_f)-window(log_W_u) for window in (windows.growing,windows.shrinking)]
+  columns+=[1/(1+np.exp(-dG)) for dG in deltaG]+deltaG
+  for window in (windows.growing,windows.shrinking):
+    columns.append(np.exp(2*window(np.logaddexp(log_W_f,log_W_u))-window(log_W2_tot)))
+  names=['temp','nsamples','folded_fraction','folded_fraction_shrinking','deltaG','deltaG_shrinking','Neff','Neff_shrinking']
+  convfilename='convergence-'+outfilename
+  metadata={'temp':temp,'pres':args.pres,'rewpres':args.rewpres,'N':N,'tran':args.tran,'stride':args.stride}
+  output.write_grid(convfilename,names,columns,'#growing windows from the start, shrinking windows from the end',metadata,fmts,fmt=['%-9g','%d']+['%-9g']*6)
+  log_Z=np.empty((2*scan.nsegments,nbins))
+  log_Z[0::2]=windows.coarsen(log_W_f,scan.bounds).T
+  log_Z[1::2]=windows.coarsen(log_W_u,scan.bounds).T
+else:
+  log_Z=log_Z[0]
+
+def block_stats(num_blocks):
+  log_folded=scan.block_log_sums(log_Z[0::2].T,num_blocks) #folded is basin=0
+  log_block_w=np.logaddexp(log_folded,scan.block_log_sums(log_Z[1::2].T,num_blocks))
+  #ratio of the weighted averages of folded and block_w
+  log_p=blocks.normalize(log_block_w)
+  folded_fraction=np.exp(np.logaddexp.reduce(log_p+log_folded,axis=-1)-np.logaddexp.reduce(log_p+log_block_w,axis=-1))
+  error=blocks.block_error(np.exp(log_folded-log_block_w),log_block_w,folded_fraction)
+  return folded_fraction,error,blocks.blocks_neff(log_block_w)
+
+if args.scan:
+  counts=scan.counts[::-1] #increasing block size
+  stats=np.array([block_stats(n) for n in counts]) #shape (len(counts),3,nbins)
+  best=blocks.plateau(stats[:,1].T,stats[:,2].T)
+  if num_blocks<=0:
+    num_blocks=counts[blocks.recommended(stats[:,1].T,stats[:,2].T)]
+    print(' recommended num_blocks=',num_blocks,file=sys.stderr)
+  scanfilename='blocks-'+outfilename
+  n=np.array(counts)
+  columns=[np.repeat(temp_range[:,np.newaxis],len(n),axis=1),np.tile(n,(nbins,1)),np.tile(scan.nrows//n,(nbins,1)),
+           stats[:,0].T,stats[:,1].T,stats[:,2].T,best[:,np.newaxis]==np.arange(len(n))]
+  names=['temp','num_blocks','len_blocks','folded_fraction','error','blocks_neff','recommended']
+  output.write_grid(scanfilename,names,columns,'',{'temp':temp,'pres':args.pres,'rewpres':args.rewpres,'N':N,'tran':args.tran},fmts,fmt=['%-9g','%d','%d','%-9g','%-9g','%-9g','%d'])
+
+len_blocks=scan.len_blocks(num_blocks)
 print(' len_blocks=',len_blocks,file=sys.stderr)
-skip=len(ene)-num_blocks*len_blocks
+skip=scan.skip(num_blocks)
 if skip!=0:
   print(' +++ WARNING blocks mismatch: throwing away first %d lines'%skip)
+folded_fraction,error,blocks_neff=block_stats(num_blocks)
+profiling.mark('output')
 
-def weights(T):
-  b=1/(kB*T)
-  log_w=((beta-b)*ene+(beta*pres-b*rewpres)*vol+beta*bias)
-  return np.exp(log_w-np.amax(log_w))
-folded_fraction=np.zeros(nbins)
-error=np.zeros(nbins)
-blocks_neff=np.zeros(nbins)
-for i in range(nbins):
-  print('    working... {:.0%}'.format(i/nbins),end='\r',file=sys.stderr)
-  block_w=np.zeros(num_blocks)
-  folded=np.zeros(num_blocks)
-  w=weights(temp_range[i])
-  for n in range(num_blocks):
-    mask=slice(skip+n*len_blocks,skip+(n+1)*len_blocks)
-    block_w[n]=np.sum(w[mask])
-    folded[n]=np.sum(w[mask]*(1-basin[mask])) #folded is basin=0
-  blocks_neff[i]=np.sum(block_w)**2/np.sum(block_w**2)
-  folded_av=np.average(folded,axis=0,weights=block_w)
-  block_w_av=np.average(block_w,axis=0,weights=block_w)
-  folded_fraction[i]=folded_av/block_w_av
-  error[i]=np.sqrt(1/(blocks_neff[i]-1)*np.average((folded/block_w-folded_av/block_w_av)**2,axis=0,weights=block_w))
-
-
-head='temp folder_fraction error blocks_neff #num_blocks=%g'%num_blocks
-cmd=subprocess.Popen('bck.meup.sh -i '+outfilename,shell=True)
-cmd.wait()
-np.savetxt(outfilename,np.c_[temp_range,folded_fraction,error,blocks_neff],header=head,fmt='%-9g')
+names=['temp','folded_fraction','error','blocks_neff']
+columns=[temp_range,folded_fraction,error,blocks_neff]
+metadata={'temp':temp,'pres':args.pres,'rewpres':args.rewpres,'N':N,'tran':args.tran,'num_blocks':num_blocks}
+if args.autocorr:
+  #the block error times the correction for the correlation between blocks, and the error from the autocorrelation alone
+  len_walker=len_blocks//nwalkers
+  if len_walker<1:
+    print(' +++ WARNING blocks shorter than one sample of each of the %d walkers, corrected_error is the uncorrected block error +++'%nwalkers)
+    correction=np.ones(len(acfs))
+  else:
+    if len_walker<10*np.amax(tau):
+      print(' +++ WARNING blocks of %d samples of each walker are not much longer than the autocorrelation time +++'%len_walker)
+    correction=np.array([a.block_correction(len_walker,num_blocks) for a in acfs])
+  names+=['corrected_error','acf_error','tau_int']
+  columns+=[error*correction,np.array([a.error for a in acfs]),tau]
+  metadata['nwalkers']=nwalkers
+output.write_grid(outfilename,names,columns,'#num_blocks=%g'%num_blocks,metadata,fmts,fmt='%-9g')
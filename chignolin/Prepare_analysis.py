@@ -0,0 +1,101 @@
+#! /usr/bin/env python3
+
+# Same as Prepare_analysis.sh, prepares the file all_Colvar.data, to be used for further analysis:
+# - the full energy and volume are taken from the GROMACS energy.$i.xvg files (created with gmx energy if missing)
+# - each point of the trajectory is assigned to a basin by looking at the C_alpha-RMSD using the same criteria as https://dx.plos.org/10.1371/journal.pone.0032131
+# - all walkers trajectories are combined and sorted according time
+# Walkers are read in parallel and merged without a global sort, a walker with inconsistent files is skipped with a warning.
+# With --walker_column the walker index is added as last column, otherwise it is the rank of the row among those with the same time.
+# The binary column cache of the output is written together with the text file (unless OPES_COLVAR_CACHE=0)
+
+import sys
+import numpy as np
+import subprocess
+import argparse
+import os
+import shutil
+import tempfile
+import multiprocessing
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),'..'))
+from opes_analysis import colvar
+from opes_analysis import walkers
+from opes_analysis import backup
+
+#same criteria as https://dx.plos.org/10.1371/journal.pone.0032131
+low_lim=0.1
+up_lim=0.4
+start_folded=[6,8,9] #specific of my initial conditions
+
+#set columns
+time_col=0
+rmsd_col=3
+bias_col=4
+fields=['time','full_ene','vol','pdb_rmsd','opes.bias','basin']
+fmt='%12.6f  %12.6f  %12.6f\t%.9g %.9g %d'
+
+def prepare(job):
+  # reads and checks a walker, saves it as a binary file, returns its name or a warning
+  i,tmp_dir,gmx,end,walker_column=job
+  ene_file='energy.%d.xvg'%i
+  if not os.path.isfile(ene_file):
+    cmd=subprocess.run([gmx,'energy','-f','chignolin.%d.edr'%i,'-o',ene_file],input='12 23 0\n',text=True,capture_output=True) #the volume is actually the same...
+    if cmd.returncode!=0:
+      return i,None,'cannot get the energy from chignolin.%d.edr'%i
+  try:
+    ene_time,ene,vol=walkers.read_xvg(ene_file,[0,1,2])
+    time,rmsd,bias=walkers.read_restarts('Colvar.%d.data'%i,[time_col,rmsd_col,bias_col])
+  except (OSError,ValueError) as err:
+    return i,None,str(err)
+  keep=ene_time>=(time[0] if len(time)>0 else np.inf) #the first point is skipped also in the colvar
+  ene_time,ene,vol=ene_time[keep],ene[keep],vol[keep]
+  ene_time,ene,vol=[x[:np.searchsorted(ene_time,end,side='right')] for x in (ene_time,ene,vol)]
+  time,rmsd,bias=[x[:np.searchsorted(time,end,side='right')] for x in (time,rmsd,bias)]
+  if len(ene_time)!=len(time):
+    return i,None,'energy file and colvar file have different lengths: %d and %d'%(len(ene_time),len(time))
+  if not np.allclose(ene_time,time):
+    return i,None,'energy file and colvar file have different times'
+  basin=walkers.hysteresis(rmsd,low_lim,up_lim,0 if i in start_folded else 1)[0]
+  data=np.c_[ene_time,ene,vol,rmsd,bias,basin]
+  if walker_column:
+    data=np.c_[data,np.full(len(data),i)]
+  if np.any(np.diff(ene_time)<0):
+    data=data[np.argsort(ene_time,kind='stable')]
+  filename=os.path.join(tmp_dir,'walker.%d.npy'%i)
+  np.save(filename,data)
+  return i,filename,None
+
+if __name__=='__main__':
+  #parser
+  parser = argparse.ArgumentParser(description='combine all the walkers in a single time-sorted file, with basin labels')
+  parser.add_argument('end',type=int,nargs='?',default=300000,help='last time to be considered')
+  parser.add_argument('--walkers',dest='walkers',type=int,default=40,required=False,help='number of walkers')
+  parser.add_argument('--nproc',dest='nproc',type=int,default=0,required=False,help='number of processes, 0 to use all the cores')
+  parser.add_argument('--gmx',dest='gmx',type=str,default='gmx_mpi',required=False,help='gromacs executable, used if energy.$i.xvg is missing')
+  parser.add_argument('--walker_column',dest='walker_column',action='store_true',default=False,required=False,help='add a last column with the walker index')
+  parser.add_argument('--text_only',dest='text_only',action='store_true',default=False,required=False,help='do not write the binary column cache')
+  parser.add_argument('-o',dest='outfilename',type=str,default='all_Colvar.data',required=False,help='output file name')
+  args = parser.parse_args()
+  end=args.end
+  if args.walker_column:
+    fields=fields+['walker']
+    fmt=fmt+' %d'
+  print('  end =',end)
+
+  backup.backup(args.outfilename)
+  tmp_dir=tempfile.mkdtemp(prefix='tmp.walkers.',dir='.')
+  try:
+    with multiprocessing.Pool(args.nproc or None) as pool:
+      results=pool.map(prepare,[(i,tmp_dir,args.gmx,end,args.walker_column) for i in range(args.walkers)],chunksize=1)
+    data=[]
+    for i,filename,err in results:
+      if err is not None:
+        print(' +++ WARNING: skipping walker %d, %s +++'%(i,err))
+      else:
+        data.append(np.load(filename,mmap_mode='r'))
+    print('  merging %d walkers'%len(data))
+    with colvar.Writer(args.outfilename,fields,fmt,cache=False if args.text_only else None) as out:
+      for rows in walkers.merge(data):
+        out.write(rows)
+    print('  %d lines written to %s'%(out.nrows,args.outfilename))
+  finally:
+    shutil.rmtree(tmp_dir,ignore_errors=True)
@@ -0,0 +1,129 @@
+#! /usr/bin/env python3
+
+### Joint multistate (MBAR-style) estimate of the OPES_EXPANDED DeltaFs, from many independent replicas and walkers ###
+# usage: ./Multistate-DeltaFs.py --plumed plumed.dat --kbt 1 -n 10
+# uses Colvar.i.data of the replicas i=0...n-1, each with its own bias, and starts from the last line of DeltaFs.i.data
+# instead of averaging the deltaF of each replica, as analyze_all.sh does, all the samples enter the same estimate
+# any Colvar files can be given with -f, e.g. the multiple walkers of chignolin, which share the bias:
+#   ../model/Multistate-DeltaFs.py --plumed plumed.dat --map ene=full_ene,vol=vol -f all_Colvar.data --deltaFs DeltaFs.data
+# with --jackknife also the error, leaving out one replica at a time
+# the output has the format of a DeltaFs file, with a single line
+
+import sys
+import numpy as np
+import argparse
+import os
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),'..'))
+from opes_analysis import colvar
+from opes_analysis import expanded
+from opes_analysis import multistate
+from opes_analysis import backup
+from opes_analysis import profiling
+
+#parser
+parser = argparse.ArgumentParser(description='estimate the DeltaFs of all the OPES_EXPANDED states jointly from many Colvar files')
+parser.add_argument('--plumed',dest='plumed',type=str,default=None,required=False,help='take the ECVs from this plumed input, they must be the ones of the simulations')
+parser.add_argument('--ecv',dest='ecvs',type=str,action='append',default=[],required=False,help='an ECV action, as in plumed.dat, can be repeated')
+parser.add_argument('--set',dest='set',type=str,action='append',default=[],required=False,help='keyword added to the ECVs that support it, e.g. TEMP_STEPS=10, can be repeated')
+parser.add_argument('--map',dest='map',type=str,default='',required=False,help='comma separated ARG=column pairs, for ECV arguments with another name in the Colvar file, e.g. ene=full_ene')
+parser.add_argument('--bias',dest='bias',type=str,default='opes.bias',required=False,help='name of the bias column')
+parser.add_argument('--temp',dest='temp',type=float,default=None,required=False,help='the simulation temperature, if not given by the ECVs')
+parser.add_argument('--kbt',dest='kbt',type=float,default=None,required=False,help='the simulation temperature in energy units, e.g. 1 in natural units')
+parser.add_argument('-n',dest='replicas',type=int,default=0,required=False,help='number of replicas, using Colvar.i.data and DeltaFs.i.data from 0 to n-1')
+parser.add_argument('-b',dest='bck',type=str,default='',required=False,help='backup prefix of the files of -n, e.g. \"bck.0.\"')
+parser.add_argument('-f',dest='filenames',type=str,action='append',default=[],required=False,help='a Colvar file, with its own bias, can be repeated')
+parser.add_argument('--deltaFs',dest='deltaFs',type=str,action='append',default=[],required=False,help='start from the average of the last lines of these DeltaFs files, can be repeated')
+parser.add_argument('--skip',dest='skip',type=int,default=0,required=False,help='rows at the start of each Colvar file that are only used to replay the bias, as a transient')
+parser.add_argument('--tol',dest='tol',type=float,default=1e-8,required=False,help='convergence threshold, in kBT units')
+parser.add_argument('--jackknife',dest='jackknife',action='store_true',default=False,help='also estimate the error, leaving out one replica at a time')
+parser.add_argument('-o',dest='outfilename',type=str,default='DeltaFs.multistate.data',required=False,help='output file name')
+args = parser.parse_args()
+
+#ECVs
+lines=list(args.ecvs)
+if args.plumed:
+  lines=expanded.read_plumed(args.plumed)+lines
+if len(lines)==0:
+  sys.exit(' no ECVs given, use --plumed or --ecv')
+lines=[expanded.with_set(line,args.set) for line in lines]
+kbt=expanded.simulation_kbt(lines,args.temp,args.kbt)
+if kbt is None:
+  sys.exit(' the simulation temperature is needed, use --temp or --kbt')
+try:
+  expansion=expanded.Expansion([expanded.parse(line,kbt) for line in lines])
+except ValueError as err:
+  sys.exit(' '+str(err))
+print('  %d ECV actions, %d states, kbt=%g'%(len(lines),expansion.nstates,kbt))
+
+#files
+filenames=[args.bck+'Colvar.%d.data'%i for i in range(args.replicas)]+args.filenames
+deltaFs_files=args.deltaFs
+if len(deltaFs_files)==0 and args.replicas>0:
+  deltaFs_files=[f for f in [args.bck+'DeltaFs.%d.data'%i for i in range(args.replicas)] if os.path.isfile(f)]
+if len(filenames)==0:
+  sys.exit(' no Colvar files given, use -n or -f')
+if args.jackknife and len(filenames)<2:
+  sys.exit(' --jackknife needs at least two Colvar files')
+
+#samples
+profiling.mark('load')
+names=dict(pair.split('=') for pair in args.map.split(',') if pair)
+solver=multistate.Multistate(expansion)
+last_time=-np.inf
+for filename in filenames:
+  fields=colvar.fields(filename)
+  usecols=['time',args.bias]+[names.get(a,a) for a in expansion.args]
+  for name in usecols:
+    if name not in fields:
+      sys.exit(' column %s not found in %s, available: %s (see --map)'%(name,filename,' '.join(fields)))
+  time,bias,*cols=colvar.read_columns(filename,usecols)
+  try:
+    solver.add(time,bias/kbt,dict(zip(expansion.args,cols)),skip=args.skip)
+  except ValueError as err:
+    sys.exit(' %s: %s'%(filename,err))
+  last_time=max(last_time,time[-1])
+  nwalkers=int(np.searchsorted(time,time[0],side='right'))
+  print('  %s: %d rows used%s'%(filename,solver.nrows[-1],', %d walkers'%nwalkers if nwalkers>1 else ''))
+
+profiling.rows(sum(solver.nrows))
+
+#warm start
+if len(deltaFs_files)>0:
+  start=[]
+  for filename in deltaFs_files:
+    if colvar.fields(filename)[2:]!=expansion.labels:
+      sys.exit(' the states of %s are not those of the ECVs'%filename)
+    start.append(np.array([c[-1] for c in colvar.read_columns(filename,expansion.labels)])/kbt)
+  f0=np.mean(start,axis=0)
+  print('  starting from the average of %d DeltaFs files'%len(start))
+else:
+  f0=np.mean(solver.deltaF,axis=0)
+  print('  starting from the average of the replayed deltaF')
+
+#solve
+profiling.mark('multistate')
+deltaF=solver.solve(f0,tol=args.tol)
+print('  converged in %d iterations, %d passes over the data'%(solver.iterations,solver.passes))
+print('  max deviation from the starting deltaF: %g'%(kbt*np.amax(np.abs(deltaF-f0))))
+neff=solver.neff(deltaF)
+print('  smallest effective sample size: %g, of state %s'%(np.amin(neff),expansion.labels[np.argmin(neff)]))
+if np.amin(neff)<10:
+  print(' +++ WARNING some states have very few effective samples +++')
+
+#output
+profiling.mark('output')
+out_fmt=' %22.16g'
+header='#! FIELDS time rct '+' '.join(expansion.labels)+'\n'
+backup.backup(args.outfilename)
+with open(args.outfilename,'w') as f:
+  f.write(header)
+  np.savetxt(f,expanded.rows([(last_time,solver.rct(),deltaF)],kbt),fmt=out_fmt,delimiter='')
+if args.jackknife:
+  profiling.mark('jackknife')
+  error=solver.jackknife(deltaF,tol=args.tol)
+  errfilename=os.path.join(os.path.dirname(args.outfilename),'error-'+os.path.basename(args.outfilename))
+  backup.backup(errfilename)
+  with open(errfilename,'w') as f:
+    f.write(header)
+    np.savetxt(f,np.c_[[[last_time,0]],[kbt*error]],fmt=out_fmt,delimiter='')
+  print('  max jackknife error: %g'%(kbt*np.amax(error)))
@@ -0,0 +1,134 @@
+#! /usr/bin/env python3
+
+### Replay OPES_EXPANDED on a Colvar file, to get the DeltaFs of other ECVs without running the simulation again ###
+# usage: ./Replay-DeltaFs.py --plumed plumed.dat -f Colvar.0.data --check
+#    or: ./Replay-DeltaFs.py --ecv 'ECV_UMBRELLAS_LINE ARG=p.x CV_MIN=-2 CV_MAX=2 SIGMA=0.1' -f Colvar.0.data
+# it works with any of the systems, e.g. from the alanine folder:
+#   ../model/Replay-DeltaFs.py --plumed plumed.dat --set TEMP_STEPS=3 --set NO_GEOM_SPACING --temp 300 -f Colvar.data
+# with --checkpoint the state is saved at the end, and a following run only reads the lines added to the Colvar file
+
+import sys
+import numpy as np
+import argparse
+import os
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),'..'))
+from opes_analysis import colvar
+from opes_analysis import stream
+from opes_analysis import reweight
+from opes_analysis import backup
+from opes_analysis import expanded
+from opes_analysis import profiling
+
+#parser
+parser = argparse.ArgumentParser(description='recompute the OPES_EXPANDED DeltaFs from a Colvar file, for any ECVs')
+parser.add_argument('--plumed',dest='plumed',type=str,default=None,required=False,help='take the ECVs from this plumed input')
+parser.add_argument('--ecv',dest='ecvs',type=str,action='append',default=[],required=False,help='an ECV action, as in plumed.dat, can be repeated')
+parser.add_argument('--set',dest='set',type=str,action='append',default=[],required=False,help='keyword added to the ECVs that support it, e.g. TEMP_STEPS=10, can be repeated')
+parser.add_argument('--map',dest='map',type=str,default='',required=False,help='comma separated ARG=column pairs, for ECV arguments with another name in the Colvar file, e.g. ene=full_ene')
+parser.add_argument('--bias',dest='bias',type=str,default='opes.bias',required=False,help='name of the bias column')
+parser.add_argument('--temp',dest='temp',type=float,default=None,required=False,help='the simulation temperature, if not given by the ECVs')
+parser.add_argument('--kbt',dest='kbt',type=float,default=None,required=False,help='the simulation temperature in energy units, e.g. 1 in natural units')
+parser.add_argument('--print_stride',dest='print_stride',type=int,default=100,required=False,help='print every this many updates, as print_stride in the DeltaFs file')
+parser.add_argument('--check',dest='check',action='store_true',default=False,help='also recompute the bias from the replayed DeltaFs and compare it with the Colvar file')
+parser.add_argument('--checkpoint',dest='checkpoint',type=str,default='',required=False,help='file to save the state at the end, and to continue from if it exists')
+parser.add_argument('-f',dest='filename',type=str,default='Colvar.data',required=False,help='input file name')
+parser.add_argument('-o',dest='outfilename',type=str,default='DeltaFs.replay.data',required=False,help='output file name')
+args = parser.parse_args()
+
+#ECVs
+lines=list(args.ecvs)
+if args.plumed:
+  lines=expanded.read_plumed(args.plumed)+lines
+if len(lines)==0:
+  sys.exit(' no ECVs given, use --plumed or --ecv')
+lines=[expanded.with_set(line,args.set) for line in lines]
+kbt=expanded.simulation_kbt(lines,args.temp,args.kbt)
+if kbt is None:
+  sys.exit(' the simulation temperature is needed, use --temp or --kbt')
+try:
+  expansion=expanded.Expansion([expanded.parse(line,kbt) for line in lines])
+except ValueError as err:
+  sys.exit(' '+str(err))
+print('  %d ECV actions, %d states, kbt=%g'%(len(lines),expansion.nstates,kbt))
+
+#columns
+names=dict(pair.split('=') for pair in args.map.split(',') if pair)
+fields=colvar.fields(args.filename)
+usecols=[]
+for name in ['time',args.bias]+[names.get(a,a) for a in expansion.args]:
+  if name not in fields:
+    sys.exit(' column %s not found in %s, available: %s (see --map)'%(name,args.filename,' '.join(fields)))
+  usecols.append(fields.index(name))
+
+#state
+replay=expanded.Replay(expansion.nstates,args.print_stride)
+spec={'ecvs':lines,'kbt':kbt,'bias':args.bias,'print_stride':args.print_stride}
+done=0 #rows already replayed
+if args.checkpoint and os.path.isfile(args.checkpoint):
+  info=replay.load(args.checkpoint)
+  if info['spec']!=spec:
+    sys.exit(' checkpoint %s was obtained with different ECVs or options'%args.checkpoint)
+  done=info['rows']
+  print('  continuing from %s: %d rows, %d updates'%(args.checkpoint,done,replay.updates))
+out_fmt=' %22.16g'
+if done==0:
+  backup.backup(args.outfilename)
+  with open(args.outfilename,'w') as f:
+    f.write(expanded.header(expansion.labels,args.print_stride))
+
+def write(rows):
+  if len(rows)>0:
+    with open(args.outfilename,'a') as f:
+      np.savetxt(f,expanded.rows(rows,kbt),fmt=out_fmt,delimiter='')
+
+def process(time,bias,cols):
+  # rows ending with a complete update
+  ecv=expansion(dict(zip(expansion.args,cols)))
+  deviation=0
+  if args.check:
+    deviation=np.amax(np.abs(replay.bias(time,ecv,bias)-bias),initial=0)*kbt
+  write(replay.add(time,bias,ecv))
+  return deviation
+
+profiling.mark('replay')
+size=max(1,min(stream.chunk_size,reweight.max_size//expansion.nstates))
+pending=None
+skip=done
+max_deviation=0
+for chunk in stream.iter_chunks(args.filename,usecols,size=size):
+  if skip>=len(chunk[0]):
+    skip-=len(chunk[0])
+    continue
+  chunk=[c[skip:] for c in chunk]
+  skip=0
+  if pending is not None:
+    chunk=[np.r_[p,c] for p,c in zip(pending,chunk)]
+  time,bias=chunk[0],chunk[1]/kbt
+  if replay.counter==0:
+    #the first update initializes deltaF with the ECVs of the first row, counted once for each walker
+    nwalkers=int(np.searchsorted(time,time[0],side='right'))
+    if nwalkers==len(time):
+      pending=chunk
+      continue
+    ecv=expansion(dict(zip(expansion.args,[c[:1] for c in chunk[2:]])))[0]
+    write([replay.start(time[0],ecv,nwalkers)])
+    if nwalkers>1:
+      print('  %d walkers'%nwalkers)
+    done+=nwalkers
+    chunk=[c[nwalkers:] for c in chunk]
+    time,bias=chunk[0],chunk[1]/kbt
+  #the last update might continue in the next chunk
+  n=int(np.searchsorted(time,time[-1],side='left'))
+  pending=[c[n:] for c in chunk]
+  if n>0:
+    max_deviation=max(max_deviation,process(time[:n],bias[:n],[c[:n] for c in chunk[2:]]))
+    done+=n
+if pending is not None and len(pending[0])>0 and replay.counter>0:
+  max_deviation=max(max_deviation,process(pending[0],pending[1]/kbt,pending[2:]))
+  done+=len(pending[0])
+profiling.rows(done)
+print('  %d rows, %d updates replayed'%(done,replay.updates))
+if args.check:
+  print('  max deviation of the recomputed bias from the Colvar file: %g'%max_deviation)
+if args.checkpoint:
+  replay.save(args.checkpoint,spec=spec,rows=done)
@@ -4,9 +4,15 @@
 
 import sys
 import numpy as np
-import pandas as pd
-import subprocess
 import argparse
+import os
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),'..'))
+from opes_analysis import colvar
+from opes_analysis import kde
+from opes_analysis import convergence
+from opes_analysis import backup
+from opes_analysis import output
+from opes_analysis import profiling
 
 #toggles
 sigma=0.03
@@ -22,88 +28,99 @@ grid_bin=100
 transition_s=0
 cv_grid=np.linspace(grid_min,grid_max,grid_bin)
 
-#parser
-parser = argparse.ArgumentParser(description='reweight')
-parser.add_argument('-r',dest='replica',type=int,default=-1,required=False,help='replica number')
-parser.add_argument('-b',dest='bck',type=str,default='',required=False,help='backup prefix, e.g. \"bck.0.\"')
-parser.add_argument('-t',dest='tran',type=int,default=0,required=False,help='transient to be skipped')
-parser.add_argument('-f',dest='flip',action='store_true',default=False,required=False,help='flip time')
-args = parser.parse_args()
-wk=''
-if args.replica != -1:
-  wk='.'+str(args.replica)
-  print('  replica: '+wk)
-bck=args.bck
-if bck:
-  print('  backup: '+bck)
-tran=args.tran
-flip=args.flip
-sub_dir=''
-if tran and flip:
-  sys.exit(' choose either tran of flip')
-if tran:
-  sub_dir='tran'+str(tran)+'/'
-  print('  tran=',tran)
-if flip:
-  sub_dir='tran-1/'
-  print('  flip')
+def reweight(replica=-1,bck='',tran=0,flip=False,exact=False,verbose=True,both=False):
+  # writes the running FES and the deltaF time series of a replica, which is also returned as (time,deltaF)
+  # flipped time uses the windows shrinking from the end of the data, with both=True the normal and flipped ones
+  # are obtained from the same kernel sums, and a list of the two (time,deltaF) is returned
+  wk=''
+  if replica != -1:
+    wk='.'+str(replica)
 
-#get colvar
-filename=bck+'Colvar'+wk+'.data'
-cv_col=1
-bias_col=3
-data=pd.read_csv(filename,sep='\s+',comment='#',header=None,usecols=[cv_col,bias_col])
-if flip:
-  data=data.iloc[::-1]
-cv=np.array(data.ix[:,cv_col])
-bias=np.array(data.ix[:,bias_col])
-del data
+  #get colvar
+  filename=bck+'Colvar'+wk+'.data'
+  cv_col=1
+  bias_col=3
+  profiling.mark('load')
+  cv,bias=colvar.read_columns(filename,[cv_col,bias_col])
+  profiling.rows(len(cv))
+  bias-=np.amax(bias) #the FES is normalized anyway, this avoids overflows
 
-#output files
-file_ext='.data'
-fes_running_file='FES_rew'
-head='cv_bin  fes'
-current_fes_running=sub_dir+fes_running_file+wk+'/'+fes_running_file+'.t-%d'+file_ext
-create_dir='bck.meup.sh {0}; mkdir -p {0}'
-cmd=subprocess.Popen(create_dir.format(sub_dir+fes_running_file+wk),shell=True)
-cmd.wait()
+  #build all the running fes at once, from the kernel sums over segments of print_stride samples
+  profiling.mark('kde')
+  first=int(tran/pace_to_time)
+  windows=convergence.Windows(len(cv),print_stride)
+  sums=kde.window_sums(cv,np.exp(bias/kbt),cv_grid,sigma,windows,first=first,exact=exact)
+  profiling.mark('output')
+  modes=[False,True] if both else [flip]
+  results=[]
+  for mode in modes:
+    probs=(windows.shrinking if mode else windows.growing)(sums.T,log=False).T
+    results.append(_write(wk,probs,tran,mode,verbose))
+  if not (flip or tran):
+    prob=np.sum(sums,axis=0)
+    fes=-kbt*np.log(prob/max(prob))
+    filename='FES_rew'+wk+'.data'
+    head='cv_bin  fes'
+    backup.backup(filename)
+    np.savetxt(filename,np.c_[cv_grid,fes],header=head,fmt='%14.9f')
+  return results if both else results[0]
 
+def _write(wk,probs,tran,flip,verbose):
+  sub_dir=''
+  if tran:
+    sub_dir='tran'+str(tran)+'/'
+  if flip:
+    sub_dir='tran-1/'
 
-n_tot=int(len(cv)/print_stride)
-time=np.zeros(n_tot)
-deltaF=np.zeros(n_tot)
-prob=np.zeros(grid_bin)
-def print_fes(it):
-  fes=-kbt*np.log(prob/max(prob))
-  np.savetxt(current_fes_running%((it+1)*pace_to_time),np.c_[cv_grid,fes],header=head,fmt='%14.9f')
-  n=int(it/print_stride)
-  time[n]=(it+1)*pace_to_time
-  deltaF[n]=kbt*np.log((np.exp(-fes[cv_grid<transition_s]/kbt)).sum()/(np.exp(-fes[cv_grid>transition_s]/kbt)).sum())
+  #output files
+  file_ext='.data'
+  fes_running_file='FES_rew'
+  head='cv_bin  fes'
+  current_fes_running=sub_dir+fes_running_file+wk+'/'+fes_running_file+'.t-%d'+file_ext
+  backup.create_dir(sub_dir+fes_running_file+wk)
 
-#build fes
-for i in range(int(tran/pace_to_time),len(cv)):
-  print('    working... {:.0%}'.format(i/len(cv)),end='\r')
-  arg=(cv_grid-cv[i])/sigma
-  prob+=np.exp(bias[i]/kbt)*np.exp(-0.5*arg**2)
-  if (i+1)%print_stride==0:
-    print_fes(i)
+  n_tot=len(probs)
+  time=np.zeros(n_tot)
+  deltaF=np.zeros(n_tot)
+  first=int(tran/pace_to_time)
+  progress=output.Progress(n_tot)
+  for n in range(first//print_stride,n_tot):
+    if verbose:
+      progress.update(n)
+    fes=-kbt*np.log(probs[n]/max(probs[n]))
+    time[n]=(n+1)*print_stride*pace_to_time
+    np.savetxt(current_fes_running%time[n],np.c_[cv_grid,fes],header=head,fmt='%14.9f')
+    deltaF[n]=kbt*np.log((np.exp(-fes[cv_grid<transition_s]/kbt)).sum()/(np.exp(-fes[cv_grid>transition_s]/kbt)).sum())
 
-#output files
-file_ext=wk+'.data'
-filename=sub_dir+'fes_deltaF.rew'+file_ext
-head='time  deltaF'
-if flip:
-  head+=' # flip'
-  time-=time[0]
-  time=time[::-1]
-cmd=subprocess.Popen('bck.meup.sh -i '+filename,shell=True)
-cmd.wait()
-np.savetxt(filename,np.c_[time,deltaF],header=head,fmt='%14.9f')
-if not (flip or tran):
-  fes=-kbt*np.log(prob/max(prob))
-  filename='FES_rew'+file_ext
-  head='cv_bin  fes'
-  cmd=subprocess.Popen('bck.meup.sh -i '+filename,shell=True)
-  cmd.wait()
-  np.savetxt(filename,np.c_[cv_grid,fes],header=head,fmt='%14.9f')
+  #output files
+  file_ext=wk+'.data'
+  filename=sub_dir+'fes_deltaF.rew'+file_ext
+  head='time  deltaF'
+  if flip:
+    head+=' # flip'
+    time-=time[0]
+    time=time[::-1]
+  backup.backup(filename)
+  np.savetxt(filename,np.c_[time,deltaF],header=head,fmt='%14.9f')
+  return time,deltaF
 
+if __name__=='__main__':
+  #parser
+  parser = argparse.ArgumentParser(description='reweight')
+  parser.add_argument('-r',dest='replica',type=int,default=-1,required=False,help='replica number')
+  parser.add_argument('-b',dest='bck',type=str,default='',required=False,help='backup prefix, e.g. \"bck.0.\"')
+  parser.add_argument('-t',dest='tran',type=int,default=0,required=False,help='transient to be skipped')
+  parser.add_argument('-f',dest='flip',action='store_true',default=False,required=False,help='flip time')
+  parser.add_argument('--exact',dest='exact',action='store_true',default=False,required=False,help='sum the kernels directly, instead of binning and FFT convolution')
+  args = parser.parse_args()
+  if args.replica != -1:
+    print('  replica: .'+str(args.replica))
+  if args.bck:
+    print('  backup: '+args.bck)
+  if args.tran and args.flip:
+    sys.exit(' choose either tran of flip')
+  if args.tran:
+    print('  tran=',args.tran)
+  if args.flip:
+    print('  flip')
+  reweight(args.replica,args.bck,args.tran,args.flip,args.exact)
@@ -0,0 +1,165 @@
+#! /usr/bin/env python3
+
+### Run the model system without PLUMED, with many walkers at once and the OPES_EXPANDED bias of plumed.dat ###
+# usage: ./Simulate-md.py --nstep 1000000
+# reads md_input.dat and plumed.dat as ves_md_linearexpansion does, and writes Colvar.N.data and DeltaFs.N.data in the same format
+# e.g. 1000 independent replicas: ./Simulate-md.py --replicas 1000 --nstep 200000
+# with --walkers the replicas share the bias, as with WALKERS_MPI, and only DeltaFs.0.data is written
+# natural units, kbt is the temperature of md_input.dat, and each replica has its own random_seed of md_input.dat
+# each step costs about 80 us with 10 replicas, mostly the fixed overhead of the array operations, plus about 1 us
+# for each replica beyond a few hundred: the 20M steps of md_input.dat take about half an hour, use --nstep for shorter runs
+
+import sys
+import numpy as np
+import argparse
+import os
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),'..'))
+from opes_analysis import langevin
+from opes_analysis import expanded
+from opes_analysis import backup
+
+#parser
+parser = argparse.ArgumentParser(description='vectorized Langevin dynamics of the model system, with on-the-fly OPES_EXPANDED')
+parser.add_argument('--input',dest='input',type=str,default='md_input.dat',required=False,help='the ves_md_linearexpansion input file')
+parser.add_argument('--plumed',dest='plumed',type=str,default=None,required=False,help='the plumed input, default is plumed_input of md_input.dat')
+parser.add_argument('--nstep',dest='nstep',type=int,default=None,required=False,help='number of steps, default is nstep of md_input.dat')
+parser.add_argument('--replicas',dest='replicas',type=int,default=None,required=False,help='number of replicas, the initial positions of md_input.dat are repeated if needed')
+parser.add_argument('--walkers',dest='walkers',action='store_true',default=False,help='the replicas share the bias, as multiple walkers')
+parser.add_argument('--overdamped',dest='overdamped',action='store_true',default=False,help='overdamped Langevin dynamics')
+parser.add_argument('--unbiased',dest='unbiased',action='store_true',default=False,help='ignore the OPES_EXPANDED bias')
+parser.add_argument('--seed',dest='seed',type=int,default=None,required=False,help='random seed, from which those of the replicas are derived, default is the random_seed of md_input.dat, one for each replica')
+parser.add_argument('--suffix',dest='suffix',type=str,default='',required=False,help='added to the output file names, e.g. \"sim.\" gives Colvar.sim.0.data')
+args = parser.parse_args()
+
+#md input
+md=langevin.read_input(args.input)
+folder=os.path.dirname(args.input)
+dim=int(md.get('dimension',1))
+nstep=args.nstep if args.nstep is not None else int(float(md['nstep']))
+tstep=float(md['tstep'])
+kbt=float(md['temperature'])
+friction=float(md['friction'])
+replicas=args.replicas or int(md.get('replicas',1))
+seeds=[args.seed] if args.seed is not None else [int(s) for s in md.get('random_seed','0').split()]
+potential=langevin.Potential(os.path.join(folder,md['input_coeffs']))
+if potential.dim!=dim:
+  sys.exit(' the potential has dimension %d instead of %d'%(potential.dim,dim))
+x0=langevin.read_positions(md['initial_position'],dim)
+x0=x0[np.arange(replicas)%len(x0)]
+if replicas>len(x0):
+  print(' +++ WARNING only %d initial positions for %d replicas +++'%(len(x0),replicas))
+
+#plumed input
+plumed=args.plumed or os.path.join(folder,md.get('plumed_input','plumed.dat'))
+position=expanded.read_plumed(plumed,('POSITION',))
+if len(position)==0:
+  sys.exit(' no POSITION action found in '+plumed)
+label=position[0].split()[0].rstrip(':') if position[0].split()[0].endswith(':') else expanded.keywords(position[0])['LABEL']
+pos_names=[label+'.'+c for c in 'xyz'[:dim]]
+energy=expanded.read_plumed(plumed,('ENERGY',))
+ene_name=energy[0].split()[0].rstrip(':') if energy else None
+print_line=expanded.read_plumed(plumed,('PRINT',))
+colvar_stride=int(expanded.keywords(print_line[0]).get('STRIDE',1)) if print_line else 1
+colvar_fmt=' '+expanded.keywords(print_line[0]).get('FMT','%f') if print_line else ' %f'
+opes=expanded.read_plumed(plumed,('OPES_EXPANDED',))
+biased=len(opes)>0 and not args.unbiased
+if biased:
+  opes_keys=expanded.keywords(opes[0])
+  pace=int(opes_keys['PACE'])
+  print_stride=int(opes_keys.get('PRINT_STRIDE',100))
+  try:
+    expansion=expanded.Expansion([expanded.parse(line,kbt) for line in expanded.read_plumed(plumed)])
+  except ValueError as err:
+    sys.exit(' '+str(err))
+  for a in expansion.args:
+    if a not in pos_names+[ene_name]:
+      sys.exit(' ECV argument %s is not supported, only %s'%(a,' '.join(pos_names+([ene_name] if ene_name else []))))
+  print('  OPES_EXPANDED with %d states, PACE=%d'%(expansion.nstates,pace))
+  nbias=1 if args.walkers else replicas
+  replays=[expanded.Replay(expansion.nstates,print_stride) for i in range(nbias)]
+  deltaF=np.zeros((nbias,expansion.nstates))
+  applied=False #as in PLUMED, the bias acts only after its first update, the first PACE steps are unbiased
+else:
+  pace=colvar_stride
+if len(seeds)>=replicas:
+  rngs=[np.random.default_rng(s) for s in seeds[:replicas]]
+else:
+  if len(seeds)>1:
+    print(' +++ WARNING only %d random seeds for %d replicas, all are derived from them +++'%(len(seeds),replicas))
+  rngs=[np.random.default_rng(s) for s in np.random.SeedSequence(seeds).spawn(replicas)]
+print('  %d replicas, %d steps, seeds=%s'%(replicas,nstep,' '.join(str(s) for s in seeds[:replicas])))
+
+def columns(x):
+  cols=dict(zip(pos_names,x.T))
+  if ene_name:
+    cols[ene_name]=potential.energy(x)
+  return cols
+
+def force(x):
+  F=potential.forces(x)
+  if not biased or not applied:
+    return F
+  V,grad=expansion.bias(deltaF,columns(x),gradient=True)
+  if ene_name in grad:
+    F*=(1+kbt*grad[ene_name])[:,np.newaxis]
+  for d,name in enumerate(pos_names):
+    if name in grad:
+      F[:,d]-=kbt*grad[name]
+  return F
+
+#output
+names=['time']+pos_names+([ene_name] if ene_name else [])+(['opes.bias'] if biased else [])
+colvar_files=['Colvar.%s%d.data'%(args.suffix,i) for i in range(replicas)]
+deltaFs_files=['DeltaFs.%s%d.data'%(args.suffix,i) for i in range(nbias)] if biased else []
+for filename in colvar_files+deltaFs_files:
+  backup.backup(filename)
+for filename in colvar_files:
+  with open(filename,'w') as f:
+    f.write('#! FIELDS '+' '.join(names)+'\n')
+for filename in deltaFs_files:
+  with open(filename,'w') as f:
+    f.write(expanded.header(expansion.labels,print_stride))
+colvar_rows=[]
+deltaFs_rows=[[] for f in deltaFs_files]
+
+def flush():
+  if len(colvar_rows)>0:
+    rows=np.array(colvar_rows) #shape (nrows,replicas,ncols)
+    for i,filename in enumerate(colvar_files):
+      with open(filename,'a') as f:
+        np.savetxt(f,rows[:,i],fmt=[' %f']+[colvar_fmt]*(len(names)-1),delimiter='')
+    colvar_rows.clear()
+  for filename,printed in zip(deltaFs_files,deltaFs_rows):
+    if len(printed)>0:
+      with open(filename,'a') as f:
+        np.savetxt(f,expanded.rows(printed,kbt),fmt=' %22.16g',delimiter='')
+      printed.clear()
+
+#run
+if biased:
+  ecv=expansion(columns(x0))
+  for i,replay in enumerate(replays):
+    deltaFs_rows[i].append(replay.start(0.,ecv[i],replicas if args.walkers else 1))
+    deltaF[i]=replay.deltaF()
+sim=langevin.Langevin(x0,force,tstep,kbt,friction,rngs,args.overdamped)
+stride=int(np.gcd(colvar_stride,pace))
+for step in range(0,nstep+1,stride):
+  if step>0:
+    sim.run(stride)
+  time=step*tstep
+  if step%colvar_stride==0 or (biased and step%pace==0):
+    cols=columns(sim.x)
+    if biased:
+      V=expansion.bias(deltaF,cols)
+  if step%colvar_stride==0:
+    colvar_rows.append(np.c_[np.full(replicas,time),sim.x,*[cols[n] for n in names[1+dim:] if n in cols],*([kbt*V+0.] if biased else [])])
+  if biased and step%pace==0 and step>0:
+    ecv=expansion(cols)
+    for i,replay in enumerate(replays):
+      walkers=slice(None) if args.walkers else slice(i,i+1)
+      deltaFs_rows[i]+=replay.add(np.full(replicas if args.walkers else 1,time),V[walkers],ecv[walkers])
+      deltaF[i]=replay.deltaF()
+    applied=True
+  if len(colvar_rows)*replicas>=2**20:
+    flush()
+flush()
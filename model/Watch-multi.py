@@ -0,0 +1,111 @@
+#! /usr/bin/env python3
+
+### Follow the running simulations and keep updated the reweighted FES and deltaF ###
+# Same analysis as Reweight-multi.py, but only the lines appended to Colvar.N.data are read at each update,
+# the on-the-fly deltaF from the OPES_EXPANDED DeltaFs.N.data file is also reported.
+# Stop it with Ctrl-C, or with --idle when the simulations are over
+
+import sys
+import numpy as np
+import argparse
+import os
+import time
+import asyncio
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),'..'))
+from opes_analysis import backup
+from opes_analysis.watch import Tail,follow,RunningFES
+
+#toggles
+sigma=0.03
+
+#setup
+kbt=1
+grid_min=-3
+grid_max=3
+grid_bin=100
+transition_s=0
+cv_grid=np.linspace(grid_min,grid_max,grid_bin)
+
+#parser
+parser = argparse.ArgumentParser(description='live reweighting of growing Colvar files')
+parser.add_argument('-r',dest='replicas',type=str,default='-1',required=False,help='comma separated list of replica numbers, -1 for no replica')
+parser.add_argument('--every',dest='every',type=float,default=60,required=False,help='seconds between snapshots')
+parser.add_argument('--poll',dest='poll',type=float,default=1,required=False,help='seconds between checks for new lines')
+parser.add_argument('--idle',dest='idle',type=float,default=0,required=False,help='stop after this many seconds without new lines, 0 to never stop')
+args = parser.parse_args()
+replicas=[int(r) for r in args.replicas.split(',')]
+
+class Replica:
+  def __init__(self,replica):
+    self.wk='' if replica==-1 else '.'+str(replica)
+    self.colvar=Tail('Colvar'+self.wk+'.data')
+    self.deltafs=Tail('DeltaFs'+self.wk+'.data')
+    self.fes=RunningFES(cv_grid,sigma,kbt)
+    self.time=0
+    self.opes_deltaF=np.nan
+    self.fes_file='FES_rew.live'+self.wk+'.data'
+    self.deltaF_file='fes_deltaF.live'+self.wk+'.data'
+    backup.backup(self.fes_file)
+    backup.backup(self.deltaF_file)
+    with open(self.deltaF_file,'w') as f:
+      f.write('# time  deltaF  neff  opes_deltaF\n')
+    self.written=-1
+
+  async def read_colvar(self):
+    cv_col=1
+    bias_col=3
+    async for data in follow(self.colvar,args.poll):
+      if self.colvar.reset:
+        self.fes.clear()
+        self.colvar.reset=False
+      self.fes.add(data[:,cv_col],data[:,bias_col])
+      self.time=data[-1,0]
+      last_update[0]=time.time()
+
+  async def read_deltafs(self):
+    async for data in follow(self.deltafs,args.poll):
+      fields=self.deltafs.fields
+      cols=[i for i,f in enumerate(fields) if f.startswith('deltaF_')]
+      ecv=np.array([float(fields[i][len('deltaF_'):]) for i in cols])
+      dF=data[-1,cols]
+      self.opes_deltaF=kbt*np.log(np.sum(np.exp(-dF[ecv<transition_s]/kbt))/np.sum(np.exp(-dF[ecv>transition_s]/kbt)))
+      last_update[0]=time.time()
+
+  def snapshot(self):
+    if self.fes.size==0 or self.fes.size==self.written:
+      return
+    tmp=self.fes_file+'.tmp'
+    np.savetxt(tmp,np.c_[cv_grid,self.fes.fes()],header='cv_bin  fes  # time=%g'%self.time,fmt='%14.9f')
+    os.replace(tmp,self.fes_file)
+    with open(self.deltaF_file,'a') as f:
+      f.write('%14.9f %14.9f %14.9f %14.9f\n'%(self.time,self.fes.deltaF(transition_s),self.fes.neff(),self.opes_deltaF))
+    self.written=self.fes.size
+
+last_update=[time.time()]
+
+async def snapshots(runs):
+  while True:
+    await asyncio.sleep(args.every)
+    for run in runs:
+      run.snapshot()
+    print('  time: %s'%' '.join('%g'%run.time for run in runs),end='\r')
+
+async def main():
+  runs=[Replica(r) for r in replicas]
+  tasks=[asyncio.create_task(run.read_colvar()) for run in runs]
+  tasks+=[asyncio.create_task(run.read_deltafs()) for run in runs]
+  tasks.append(asyncio.create_task(snapshots(runs)))
+  try:
+    while args.idle<=0 or time.time()-last_update[0]<args.idle:
+      await asyncio.sleep(args.poll)
+  finally:
+    for task in tasks:
+      task.cancel()
+    for run in runs:
+      run.snapshot()
+    print('')
+
+try:
+  asyncio.run(main())
+except KeyboardInterrupt:
+  pass
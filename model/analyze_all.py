@@ -0,0 +1,57 @@
+#! /usr/bin/env python3
+
+# Used for Fig.S4
+# Same as analyze_all.sh: runs Reweight-multi.py on all the replicas, concurrently in a process pool,
+# and writes the average and std deviation over the replicas of the deltaF time series
+
+import sys
+import numpy as np
+import argparse
+import os
+import importlib.util
+import multiprocessing
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),'..'))
+from opes_analysis import backup
+from opes_analysis import profiling
+
+#load Reweight-multi.py as a module
+spec=importlib.util.spec_from_file_location('reweight_multi',os.path.join(os.path.dirname(os.path.realpath(__file__)),'Reweight-multi.py'))
+reweight_multi=importlib.util.module_from_spec(spec)
+spec.loader.exec_module(reweight_multi)
+
+def run(job):
+  # with flip, the normal and flipped time series come from the same pass over the data
+  replica,bck,exact,flip=job
+  res=reweight_multi.reweight(replica,bck,0,False,exact,verbose=False,both=flip)
+  return res if flip else [res]
+
+def make_stats(results,filename):
+  # population std deviation over the replicas, as in the awk script of analyze_all.sh
+  # replicas of different length are cut to the shortest one
+  size=min(len(res[1]) for res in results)
+  if any(len(res[1])!=size for res in results):
+    print(' +++ WARNING: replicas have different length, using the first %d points +++'%size)
+  time=results[0][0][:size]
+  deltaF=np.array([res[1][:size] for res in results])
+  av=np.mean(deltaF,axis=0)
+  std=np.sqrt(np.maximum(np.mean(deltaF**2,axis=0)-av**2,0))
+  backup.backup(filename)
+  np.savetxt(filename,np.c_[time,av,std],header='average std_dev',comments='#',fmt=['%.9f','%g','%g'])
+
+if __name__=='__main__':
+  #parser
+  parser = argparse.ArgumentParser(description='reweight all the replicas and get the deltaF statistics')
+  parser.add_argument('-n',dest='replicas',type=int,default=10,required=False,help='number of replicas, from 0 to n-1')
+  parser.add_argument('-b',dest='bck',type=str,default='',required=False,help='backup prefix, e.g. \"bck.0.\"')
+  parser.add_argument('--flip',dest='flip',action='store_true',default=False,required=False,help='also reweight with flipped time, in tran-1/')
+  parser.add_argument('--nproc',dest='nproc',type=int,default=None,required=False,help='number of processes, default is all the cores')
+  parser.add_argument('--exact',dest='exact',action='store_true',default=False,required=False,help='sum the kernels directly, instead of binning and FFT convolution')
+  args = parser.parse_args()
+  profiling.mark('reweight')
+  print('  running %d jobs'%args.replicas)
+  with multiprocessing.Pool(args.nproc) as pool:
+    results=pool.map(run,[(r,args.bck,args.exact,args.flip) for r in range(args.replicas)],chunksize=1)
+  profiling.mark('output')
+  make_stats([res[0] for res in results],'Stats-fes_deltaF.rew.data')
+  if args.flip:
+    make_stats([res[1] for res in results],'Stats-flip-fes_deltaF.rew.data')
@@ -0,0 +1,2 @@
+# Shared analysis tools for the OPES expanded scripts
+# The scripts in each system folder add the repository root to sys.path and import from here
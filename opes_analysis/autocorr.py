@@ -0,0 +1,99 @@
+# Autocorrelation of the time series of each walker, via FFT, and the resulting statistical inefficiency
+#
+# The walkers of a time-sorted all_Colvar.data come from a walker column or, since the merge keeps the order
+# of the walkers for rows with the same time, from the rank of each row among those with its time.
+# For a reweighted average <x>=sum(w*x)/sum(w) the relevant series is y=w/mean(w)*(x-<x>), linearizing the ratio.
+# Its autocovariance is summed over the walkers, each zero-padded so that the FFT gives the linear correlation in O(N log N),
+# and divided by the number of pairs at each lag.
+# The integrated autocorrelation time tau=1/2+sum_t rho(t) is cut with Sokal's automatic window, the smallest M>=c*tau(M),
+# the statistical inefficiency is 2*tau and the number of independent samples is N/(2*tau).
+# Blocks of len_block steps of each walker (nwalkers*len_block rows of the time-sorted file) are correlated with the
+# nearby ones, block_correction is the factor for the block error that accounts for this, from the same rho.
+
+import numpy as np
+
+from opes_analysis import reweight
+
+def walker_labels(time):
+  # walker index of each row of a time-sorted file, as its rank among the rows with the same time
+  # the first time can be cut by the transient, thus its rows are the last walkers
+  time=np.asarray(time)
+  n=len(time)
+  if n==0:
+    return np.zeros(0,dtype=int)
+  idx=np.arange(n)
+  new=np.r_[True,time[1:]!=time[:-1]]
+  labels=idx-np.maximum.accumulate(np.where(new,idx,0))
+  nwalkers=np.amax(labels)+1
+  first=np.flatnonzero(new)[1] if np.count_nonzero(new)>1 else n
+  labels[:first]+=nwalkers-first
+  return labels
+
+def autocovariance(y,walker=None):
+  # autocovariance of y (already centered) at each lag, up to the length of the longest walker
+  if walker is None:
+    walker=np.zeros(len(y),dtype=int)
+  walker=np.asarray(walker).astype(int)
+  order=np.argsort(walker,kind='stable')
+  lengths=np.bincount(walker)
+  lengths=lengths[lengths>0]
+  parts=np.split(np.asarray(y,dtype=np.float64)[order],np.cumsum(lengths)[:-1])
+  L=np.amax(lengths)
+  nfft=2**int(np.ceil(np.log2(2*L)))
+  power=np.zeros(nfft//2+1)
+  step=max(1,reweight.max_size//nfft)
+  for k in range(0,len(parts),step):
+    #a few walkers at a time, all padded to nfft
+    buf=np.zeros((len(parts[k:k+step]),nfft))
+    for i,p in enumerate(parts[k:k+step]):
+      buf[i,:len(p)]=p
+    f=np.fft.rfft(buf,axis=-1)
+    power+=np.sum(f.real**2+f.imag**2,axis=0)
+  acov=np.fft.irfft(power,n=nfft)[:L]
+  pairs=np.sum(np.maximum(lengths[:,np.newaxis]-np.arange(L),0),axis=0)
+  return acov/pairs
+
+def integrated_time(rho,c=5):
+  # integrated autocorrelation time and its window M, the smallest with M>=c*tau(M)
+  if len(rho)<2:
+    return 0.5,0
+  tau=0.5+np.cumsum(rho[1:])
+  M=np.arange(1,len(rho))
+  ok=np.flatnonzero(M>=c*tau)
+  m=ok[0] if len(ok)>0 else len(tau)-1
+  return max(0.5,tau[m]),M[m]
+
+class Autocorrelation:
+  # autocorrelation of x over the walkers, optionally for the average reweighted with log-weights log_w
+  def __init__(self,x,walker=None,log_w=None,c=5):
+    x=np.asarray(x,dtype=np.float64)
+    self.nsamples=len(x)
+    if log_w is None:
+      w=np.ones(len(x))
+    else:
+      w=np.exp(log_w-np.amax(log_w))
+      w/=np.mean(w)
+    self.mean=np.sum(w*x)/np.sum(w)
+    acov=autocovariance(w*(x-self.mean),walker)
+    self.var=acov[0]
+    with np.errstate(divide='ignore',invalid='ignore'):
+      self.rho=acov/acov[0] if acov[0]>0 else np.r_[1,np.zeros(len(acov)-1)]
+    self.tau,self.window=integrated_time(self.rho,c)
+    self.n_ind=self.nsamples/(2*self.tau)
+    self.error=np.sqrt(self.var/self.n_ind)
+
+  def block_correction(self,len_block,num_blocks):
+    # factor for the error of num_blocks blocks of len_block steps of each walker, for the covariance between the blocks
+    # i.e. the square root of the variance of the sum over all the blocks over num_blocks times that of a single block
+    if len_block<1:
+      raise ValueError('blocks shorter than one step of each walker')
+    return np.sqrt(self._sum_var(num_blocks*len_block)/(num_blocks*self._sum_var(len_block)))
+
+  def _sum_var(self,n):
+    # variance of the sum of n consecutive samples, in units of var, with rho cut at the window
+    t=np.arange(1,min(n,self.window+1,len(self.rho)))
+    return n+2*np.sum((n-t)*self.rho[t])
+
+def num_blocks(nrows,nwalkers,tau,factor=10):
+  # largest number of blocks, at least 2, each at least factor*tau steps of each walker
+  return max(2,nrows//(nwalkers*int(np.ceil(factor*tau))))
@@ -0,0 +1,24 @@
+# In-process equivalent of 'bck.meup.sh -i', as used by the scripts before writing their outputs
+#
+# An existing file or directory is renamed to bck.N.name in the same folder, with N the first free index,
+# so that nothing is overwritten. Avoids spawning a shell for each output file.
+
+import os
+
+def backup(path):
+  # returns the new name of the backup, or None if there was nothing to back up
+  path=path.rstrip('/')
+  if not os.path.lexists(path):
+    return None
+  dirname,basename=os.path.split(path)
+  n=0
+  while os.path.lexists(os.path.join(dirname,'bck.%d.%s'%(n,basename))):
+    n+=1
+  new=os.path.join(dirname,'bck.%d.%s'%(n,basename))
+  os.rename(path,new)
+  return new
+
+def create_dir(path):
+  # backup and then create a new empty directory
+  backup(path)
+  os.makedirs(path,exist_ok=True)
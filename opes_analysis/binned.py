@@ -0,0 +1,146 @@
+# Compressed (ene,vol) index for fast reweighting over many targets
+#
+# The log-weight depends on a sample only through ene, vol and bias, thus samples are binned in (ene,vol),
+# separately for each label, and each bin stores the log-sum-exp of p*beta*bias together with the
+# mean, covariance and range of (ene,vol) weighted by exp(p*beta*bias), for the powers p of the weights.
+# For a target, each bin contributes log(sum(w**p))=L+p*(a*mu_e+c*mu_v)+log<exp(X)>, where X=p*(a*de+c*dv)
+# has zero mean and range h, so that 0<=log<exp(X)><=h**2/8 (Jensen and Hoeffding).
+# The second order cumulant 0.5*var(X) is used as estimate, thus the error on each bin, and on the total,
+# is bounded by (p*h)**2/8. Bin widths are chosen so that the bound is below tol over the given targets,
+# any target that still exceeds tol falls back to the exact Reweighter.
+
+import numpy as np
+
+from opes_analysis import reweight
+from opes_analysis import profiling
+from opes_analysis.reweight import LogSumExp
+
+class BinnedReweighter:
+  # rw is a Reweighter, rew_beta and rew_pres the targets used to size the bins
+  def __init__(self,rw,rew_beta,rew_pres=0,tol=1e-3,powers=(1,2)):
+    self.rw=rw
+    self.tol=tol
+    self.nlabels=rw.nlabels
+    self.size=rw.size
+    a,c=self._coeffs(rew_beta,rew_pres)[:2]
+    h=np.sqrt(8*tol/(2+max(powers)**2)) #maximum range of a*de+c*dv within a bin, such that also neff is within tol
+    ene=rw.ene.astype(rw.dtype,copy=False)
+    vol=rw.vol.astype(rw.dtype,copy=False) if rw.vol is not None else np.zeros(1)
+    with np.errstate(divide='ignore'):
+      if rw.vol is None:
+        d_ene=h/np.amax(np.abs(a))
+        d_vol=np.inf
+      else:
+        d_ene=0.5*h/np.amax(np.abs(a))
+        d_vol=0.5*h/np.amax(np.abs(c))
+    n_ene=1 if not np.isfinite(d_ene) else int(np.ceil((np.amax(ene)-np.amin(ene))/d_ene))+1
+    n_vol=1 if not np.isfinite(d_vol) else int(np.ceil((np.amax(vol)-np.amin(vol))/d_vol))+1
+    i_ene=np.zeros(len(ene),dtype=np.int64) if n_ene==1 else ((ene-np.amin(ene))/d_ene).astype(np.int64)
+    i_vol=np.zeros(len(ene),dtype=np.int64) if n_vol==1 else ((vol-np.amin(vol))/d_vol).astype(np.int64)
+    key=i_ene*n_vol+i_vol
+    if self.nlabels>0:
+      key+=rw.labels.astype(np.int64)*(n_ene*n_vol) #label-major, so bins of the same label are contiguous
+    order=np.argsort(key,kind='stable')
+    key=key[order]
+    starts=np.flatnonzero(np.r_[True,key[1:]!=key[:-1]])
+    sizes=np.diff(np.append(starts,len(key)))
+    self.nbins=len(starts)
+    if self.nlabels>0:
+      bin_labels=rw.labels[order][starts]
+      self.label_starts=np.flatnonzero(np.r_[True,bin_labels[1:]!=bin_labels[:-1]])
+      self.label_groups=bin_labels[self.label_starts]
+    else:
+      self.label_starts=None
+      self.label_groups=None
+
+    ene=ene[order]
+    vol=None if rw.vol is None else vol[order]
+    x=rw.beta*rw.bias[order].astype(rw.dtype,copy=False)
+    self.stats={}
+    for p in powers:
+      m=np.maximum.reduceat(p*x,starts)
+      u=np.exp(p*x-np.repeat(m,sizes))
+      S=np.add.reduceat(u,starts)
+      def mean(y):
+        return np.add.reduceat(u*y,starts)/S
+      st={'L':np.log(S)+m}
+      st['mu_e']=mean(ene)
+      de=ene-np.repeat(st['mu_e'],sizes)
+      st['s_ee']=mean(de*de)
+      st['h_e']=np.maximum.reduceat(de,starts)-np.minimum.reduceat(de,starts)
+      if vol is not None:
+        st['mu_v']=mean(vol)
+        dv=vol-np.repeat(st['mu_v'],sizes)
+        st['s_vv']=mean(dv*dv)
+        st['s_ev']=mean(de*dv)
+        st['h_v']=np.maximum.reduceat(dv,starts)-np.minimum.reduceat(dv,starts)
+      self.stats[p]=st
+
+  def _coeffs(self,rew_beta,rew_pres):
+    dtype=self.rw.dtype
+    rew_beta,rew_pres=np.broadcast_arrays(np.asarray(rew_beta,dtype=dtype),np.asarray(rew_pres,dtype=dtype))
+    a=np.ravel(self.rw.beta-rew_beta)
+    c=np.ravel(self.rw.beta*self.rw.pres-rew_beta*rew_pres)
+    return a,c,rew_beta.shape
+
+  @profiling.kernel('binned')
+  def _reduce(self,a,c,p):
+    # approximated log(sum(w**p)) for each target and label, plus the error bound
+    st=self.stats[p]
+    npoints=len(a)
+    log_z=LogSumExp((npoints,max(1,self.nlabels)))
+    bound=np.zeros(npoints)
+    batch=max(1,reweight.max_size//self.nbins)
+    for k in range(0,npoints,batch):
+      pts=slice(k,k+batch)
+      aa=a[pts,None]
+      est=st['L']+p*aa*st['mu_e']
+      var=aa**2*st['s_ee']
+      h=np.abs(aa)*st['h_e']
+      if 'mu_v' in st:
+        cc=c[pts,None]
+        est+=p*cc*st['mu_v']
+        var+=2*aa*cc*st['s_ev']+cc**2*st['s_vv']
+        h+=np.abs(cc)*st['h_v']
+      width=(p*h)**2/8
+      est+=np.minimum(0.5*p**2*var,width)
+      log_z.add(est,self.label_starts,self.label_groups,rows=pts)
+      bound[pts]=np.amax(width,axis=1)
+    return log_z.result(),bound
+
+  def _shape(self,res,shape):
+    if self.nlabels==0:
+      return res[:,0].reshape(shape)
+    return np.moveaxis(res,-1,0).reshape((self.nlabels,)+shape)
+
+  def error_bound(self,rew_beta,rew_pres=0,power=1):
+    # upper bound on the error of log(sum(w**power)) for each target
+    a,c,shape=self._coeffs(rew_beta,rew_pres)
+    return self._reduce(a,c,power)[1].reshape(shape)
+
+  def log_sums(self,rew_beta,rew_pres=0,power=1):
+    # same as Reweighter.log_sums, within tol
+    a,c,shape=self._coeffs(rew_beta,rew_pres)
+    res,bound=self._reduce(a,c,power)
+    exact=np.flatnonzero(bound>self.tol)
+    if len(exact)>0:
+      b=np.ravel(np.broadcast_to(rew_beta,shape))[exact]
+      pr=np.ravel(np.broadcast_to(rew_pres,shape))[exact]
+      ex=self.rw.log_sums(b,pr,power)
+      res[exact]=ex[:,None] if self.nlabels==0 else ex.T
+    return self._shape(res,shape)
+
+  def neff(self,rew_beta,rew_pres=0):
+    # same as Reweighter.neff, within tol on log(neff)
+    a,c,shape=self._coeffs(rew_beta,rew_pres)
+    log_z,bound=self._reduce(a,c,1)
+    log_z2,bound2=self._reduce(a,c,2)
+    log_z=np.logaddexp.reduce(log_z,axis=1)
+    log_z2=np.logaddexp.reduce(log_z2,axis=1)
+    neff=np.exp(2*log_z-log_z2)
+    exact=np.flatnonzero(2*bound+bound2>self.tol)
+    if len(exact)>0:
+      b=np.ravel(np.broadcast_to(rew_beta,shape))[exact]
+      pr=np.ravel(np.broadcast_to(rew_pres,shape))[exact]
+      neff[exact]=self.rw.neff(b,pr)
+    return neff.reshape(shape)
@@ -0,0 +1,84 @@
+# Weighted block averages for many block sizes at once
+#
+# The rows are split into segments at the block boundaries of every requested number of blocks,
+# so that log-sums are accumulated only once per segment (e.g. as labels of a Reweighter),
+# and the block log-sums for any number of blocks are log-sum-exp reductions over contiguous segments.
+# As in the scripts, when nrows is not a multiple of num_blocks the first rows are thrown away
+# (or the last ones, with skip_first=False).
+# The error of a weighted block average is sqrt(var/(blocks_neff-1)), the recommended block size
+# is the smallest one such that no larger block size gives a significantly larger error.
+# For a grid of observables (e.g. temperatures or FES bins) the recommended one is the largest over the grid,
+# so that all of them are converged, ignoring the grid points without any valid error (e.g. empty bins).
+
+import numpy as np
+
+class BlockScan:
+  def __init__(self,nrows,counts,skip_first=True):
+    self.nrows=nrows
+    self.skip_first=skip_first
+    self.counts=sorted(set(int(c) for c in counts if 0<c<=nrows))
+    bounds=[[0,nrows]]
+    for c in self.counts:
+      bounds.append(self._bounds(c))
+    self.bounds=np.unique(np.concatenate(bounds))
+    self.nsegments=len(self.bounds)-1
+
+  def len_blocks(self,num_blocks):
+    return self.nrows//num_blocks
+
+  def skip(self,num_blocks):
+    # number of rows thrown away
+    return self.nrows-num_blocks*self.len_blocks(num_blocks)
+
+  def _bounds(self,num_blocks):
+    first=self.skip(num_blocks) if self.skip_first else 0
+    return first+self.len_blocks(num_blocks)*np.arange(num_blocks+1)
+
+  def labels(self,first,n):
+    # segment index of the rows [first,first+n)
+    return np.searchsorted(self.bounds,np.arange(first,first+n),side='right')-1
+
+  def block_log_sums(self,log_sums,num_blocks):
+    # from log-sums over the segments, shape (...,nsegments), to log-sums over the blocks, shape (...,num_blocks)
+    b=np.searchsorted(self.bounds,self._bounds(num_blocks))
+    return np.logaddexp.reduceat(log_sums[...,:b[-1]],b[:-1],axis=-1)
+
+def normalize(log_block_w):
+  # log of the normalized block weights, over the last axis
+  return log_block_w-np.logaddexp.reduce(log_block_w,axis=-1,keepdims=True)
+
+def blocks_neff(log_block_w):
+  return np.exp(-np.logaddexp.reduce(2*normalize(log_block_w),axis=-1))
+
+def block_error(values,log_block_w,center):
+  # weighted standard error of the block values around center
+  lw=normalize(log_block_w)
+  neff=np.exp(-np.logaddexp.reduce(2*lw,axis=-1))
+  with np.errstate(divide='ignore',invalid='ignore'):
+    return np.sqrt(np.sum(np.exp(lw)*(values-np.expand_dims(center,-1))**2,axis=-1)/(neff-1))
+
+def block_average(values,log_block_w):
+  # weighted average of the block values, its error and blocks_neff
+  av=np.sum(np.exp(normalize(log_block_w))*values,axis=-1)
+  return av,block_error(values,log_block_w,av),blocks_neff(log_block_w)
+
+def plateau(errors,neffs):
+  # index of the recommended block size, with errors and neffs of shape (...,n) sorted by increasing block size
+  # the uncertainty of each error is error/sqrt(2*(blocks_neff-1))
+  errors=np.asarray(errors,dtype=np.float64)
+  neffs=np.asarray(neffs,dtype=np.float64)
+  valid=np.isfinite(errors)&(neffs>1)
+  with np.errstate(divide='ignore',invalid='ignore'):
+    lower=np.where(valid,errors-errors/np.sqrt(2*(neffs-1)),-np.inf)
+  later_max=np.flip(np.maximum.accumulate(np.flip(lower,axis=-1),axis=-1),axis=-1)
+  ok=valid&(errors>=later_max)
+  return np.where(np.any(ok,axis=-1),np.argmax(ok,axis=-1),errors.shape[-1]-1)
+
+def recommended(errors,neffs):
+  # index of the block size recommended for all the grid points, same arguments as plateau
+  errors=np.asarray(errors,dtype=np.float64)
+  neffs=np.broadcast_to(np.asarray(neffs,dtype=np.float64),errors.shape)
+  found=np.any(np.isfinite(errors)&(neffs>1),axis=-1)
+  if not np.any(found):
+    return errors.shape[-1]-1
+  return int(np.amax(plateau(errors,neffs)[found]))
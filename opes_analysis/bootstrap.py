@@ -0,0 +1,120 @@
+# Moving-block bootstrap for reweighted observables
+#
+# The rows are split into segments of segment_len consecutive samples, and the log-sums of the weights
+# are computed once per segment, label and target. A bootstrap replica draws blocks of block_len consecutive
+# segments (moving blocks, starting at any segment) and is fully described by how many times each segment
+# is drawn, so that the replica log-sums are log(counts @ exp(segment log-sums)), without copying any data.
+# Targets are split across a process pool, the ene/vol/bias columns and the resampling counts are placed
+# in shared memory and each worker computes both the segment log-sums and the replicas for its own targets.
+# The pool is forked, so that the calling scripts need no main guard, and where fork is not available
+# the targets are done serially.
+
+import numpy as np
+import multiprocessing
+from multiprocessing import shared_memory
+
+from opes_analysis.reweight import Reweighter
+
+def resample_counts(nsegments,block_len,nrep,seed=None):
+  # number of times each segment is drawn, shape (nrep,nsegments)
+  block_len=max(1,min(block_len,nsegments))
+  nblocks=-(-nsegments//block_len)
+  rng=np.random.default_rng(seed)
+  starts=rng.integers(0,nsegments-block_len+1,size=(nrep,nblocks))
+  idx=(starts[:,:,np.newaxis]+np.arange(block_len)).reshape(nrep,-1)[:,:nsegments] #same total length as the data
+  idx+=nsegments*np.arange(nrep)[:,np.newaxis]
+  return np.bincount(idx.ravel(),minlength=nrep*nsegments).reshape(nrep,nsegments)
+
+def replica_log_sums(seg_log_sums,counts):
+  # seg_log_sums has shape (nsegments,...), returns the log-sums of each replica, shape (nrep,...)
+  shape=seg_log_sums.shape[1:]
+  x=seg_log_sums.reshape(len(seg_log_sums),-1)
+  m=np.amax(x,axis=0)
+  m[~np.isfinite(m)]=0
+  with np.errstate(divide='ignore'):
+    res=np.log(counts@np.exp(x-m))+m
+  return res.reshape((len(counts),)+shape)
+
+def confidence_interval(replicas,level=0.95):
+  # percentile interval over the replicas (first axis)
+  q=100*(1-level)/2
+  return np.nanpercentile(replicas,q,axis=0),np.nanpercentile(replicas,100-q,axis=0)
+
+_shared={}
+
+def _attach(spec):
+  arrays={}
+  for key,(name,shape,dtype) in spec.items():
+    shm=shared_memory.SharedMemory(name=name)
+    _shared[key]=shm #keep it open
+    arrays[key]=np.ndarray(shape,dtype=dtype,buffer=shm.buf)
+  _shared['arrays']=arrays
+
+def _segment_log_sums(arrays,setup,rew_beta,rew_pres):
+  # shape (nsegments,nlabels,len(rew_beta))
+  nlabels,nsegments,segment_len=setup['nlabels'],setup['nsegments'],setup['segment_len']
+  seg=np.arange(len(arrays['ene']))//segment_len
+  labels=seg*nlabels+(arrays['labels'] if 'labels' in arrays else 0)
+  if 'labels' in arrays:
+    labels[arrays['labels']<0]=-1
+  vol=arrays['vol'] if 'vol' in arrays else None
+  rw=Reweighter(arrays['ene'],vol,arrays['bias'],setup['temp'],setup['pres'],labels=labels,nlabels=nsegments*nlabels)
+  return rw.log_sums(rew_beta,rew_pres).reshape(nsegments,nlabels,len(rew_beta))
+
+def _work(task):
+  setup,rew_beta,rew_pres=task
+  seg=_segment_log_sums(_shared['arrays'],setup,rew_beta,rew_pres)
+  return np.logaddexp.reduce(seg,axis=0),replica_log_sums(seg,_shared['arrays']['counts'])
+
+def bootstrap_log_sums(ene,vol,bias,temp,pres,rew_beta,rew_pres=0,labels=None,nlabels=None,
+                       segment_len=1000,block_len=4,nrep=200,seed=None,processes=None):
+  # log-sums over all the data and over each replica, shapes (nlabels,...) and (nrep,nlabels,...)
+  # without labels the label axis is dropped; negative labels are discarded
+  # processes=None uses all the cores, processes=1 runs in the current process
+  rew_beta,rew_pres=np.broadcast_arrays(np.asarray(rew_beta,dtype=np.float64),np.asarray(rew_pres,dtype=np.float64))
+  shape=rew_beta.shape
+  rew_beta=np.ravel(rew_beta)
+  rew_pres=np.ravel(rew_pres)
+  nsegments=-(-len(ene)//segment_len)
+  counts=resample_counts(nsegments,block_len,nrep,seed)
+  columns={'ene':ene,'bias':bias,'counts':counts.astype(np.float64)}
+  if vol is not None:
+    columns['vol']=vol
+  if labels is not None:
+    columns['labels']=np.asarray(labels).astype(np.int64)
+    if nlabels is None:
+      nlabels=np.amax(columns['labels'])+1
+  setup={'temp':temp,'pres':pres,'nlabels':nlabels or 1,'nsegments':nsegments,'segment_len':segment_len}
+  if processes is None:
+    processes=multiprocessing.cpu_count()
+  batches=np.array_split(np.arange(len(rew_beta)),min(len(rew_beta),4*processes))
+  tasks=[(setup,rew_beta[b],rew_pres[b]) for b in batches]
+
+  if processes==1 or 'fork' not in multiprocessing.get_all_start_methods():
+    _shared['arrays']={key:np.asarray(a) for key,a in columns.items()}
+    try:
+      results=[_work(task) for task in tasks]
+    finally:
+      _shared.clear()
+  else:
+    blocks=[]
+    spec={}
+    try:
+      for key,a in columns.items():
+        a=np.ascontiguousarray(a)
+        shm=shared_memory.SharedMemory(create=True,size=max(1,a.nbytes))
+        blocks.append(shm)
+        np.ndarray(a.shape,dtype=a.dtype,buffer=shm.buf)[:]=a
+        spec[key]=(shm.name,a.shape,a.dtype)
+      with multiprocessing.get_context('fork').Pool(processes,initializer=_attach,initargs=(spec,)) as pool:
+        results=pool.map(_work,tasks)
+    finally:
+      for shm in blocks:
+        shm.close()
+        shm.unlink()
+
+  estimate=np.concatenate([r[0] for r in results],axis=-1).reshape((setup['nlabels'],)+shape)
+  replicas=np.concatenate([r[1] for r in results],axis=-1).reshape((nrep,setup['nlabels'])+shape)
+  if labels is None:
+    return estimate[0],replicas[:,0]
+  return estimate,replicas
@@ -0,0 +1,203 @@
+# Adaptive tracing of the coexistence line between two states, e.g. liquid and bcc, over a (temp,pres) range
+#
+# deltaG=-log(Z_1/Z_0), in kBT units, is reweighted as in Phase_diagram.py, and its derivatives are
+# weighted averages obtained from the same weights:
+#   d(deltaG)/d(rew_beta)=<ene+rew_pres*vol>_1-<ene+rew_pres*vol>_0=deltaH
+#   d(deltaG)/d(rew_pres)=rew_beta*(<vol>_1-<vol>_0)=rew_beta*deltaV
+# The line deltaG=0 is followed by predictor-corrector continuation, with Newton steps along the gradient,
+# starting from the sign changes of deltaG on a coarse grid. The coarse grid can also be refined as a quadtree,
+# only in the cells crossed by the line.
+# The error on deltaG comes from the block error on the fraction of state 1, and the error on the line
+# is obtained dividing it by the derivative of deltaG with respect to temp (at fixed pres) or pres (at fixed temp).
+# Points are given in the unit square u=(temp-min_temp,pres-min_pres)/(max_temp-min_temp,max_pres-min_pres)
+
+import numpy as np
+
+from opes_analysis import blocks
+from opes_analysis.reweight import Reweighter,kB
+
+class Coexistence:
+  # labels are 0 or 1 for the two states, negative to discard a sample
+  # box is ((min_temp,max_temp),(min_pres,max_pres)), with the pressures in the same units as pres
+  def __init__(self,ene,vol,bias,temp,pres,labels,box,num_blocks=0):
+    labels=np.asarray(labels).astype(int)
+    self.rw=Reweighter(ene,vol,bias,temp,pres,labels=labels,nlabels=2)
+    self.box=np.asarray(box,dtype=np.float64)
+    self.span=self.box[:,1]-self.box[:,0]
+    self.num_blocks=num_blocks
+    if num_blocks>1:
+      keep=np.flatnonzero(labels>=0)
+      order=keep[np.argsort(labels[keep],kind='stable')] #same order as in the Reweighter
+      self.scan=blocks.BlockScan(len(labels),[num_blocks])
+      self.segments=self.scan.labels(0,len(labels))[order]
+    self.evaluations=0 #number of (temp,pres) targets reweighted so far
+    self.cache={}
+
+  def to_tp(self,u):
+    u=np.asarray(u,dtype=np.float64)
+    return self.box[0,0]+u[...,0]*self.span[0],self.box[1,0]+u[...,1]*self.span[1]
+
+  def grid_deltaG(self,u):
+    # deltaG for a batch of points, with shape (...,2)
+    u=np.asarray(u,dtype=np.float64)
+    keys=[tuple(k) for k in np.round(u.reshape(-1,2),12)]
+    new=[k for k in dict.fromkeys(keys) if k not in self.cache]
+    if len(new)>0:
+      temp,pres=self.to_tp(np.array(new))
+      log_Z=self.rw.log_sums(1/(kB*temp),pres)
+      self.cache.update(zip(new,-(log_Z[1]-log_Z[0])))
+      self.evaluations+=len(new)
+    return np.array([self.cache[k] for k in keys]).reshape(u.shape[:-1])
+
+  def point(self,u):
+    # deltaG at a single point, its gradient with respect to u, deltaH, deltaV and the block error on deltaG
+    temp,pres=self.to_tp(u)
+    rew_beta=1/(kB*temp)
+    rw=self.rw
+    log_w=rw.log_weights(rew_beta,pres)
+    w=np.exp(log_w-np.amax(log_w))
+    ene=rw.ene.astype(rw.dtype,copy=False)
+    vol=rw.vol.astype(rw.dtype,copy=False)
+    z=np.bincount(rw.labels,weights=w,minlength=2)
+    self.evaluations+=1
+    with np.errstate(divide='ignore',invalid='ignore'):
+      av_ene=np.bincount(rw.labels,weights=w*ene,minlength=2)/z
+      av_vol=np.bincount(rw.labels,weights=w*vol,minlength=2)/z
+      deltaG=-np.log(z[1]/z[0])
+    deltaV=av_vol[1]-av_vol[0]
+    deltaH=av_ene[1]-av_ene[0]+pres*deltaV
+    grad=np.array([-deltaH/(kB*temp**2)*self.span[0],rew_beta*deltaV*self.span[1]])
+    return deltaG,grad,deltaH,deltaV,self._error(w)
+
+  def _error(self,w):
+    if self.num_blocks<2:
+      return np.nan
+    nseg=self.scan.nsegments
+    with np.errstate(divide='ignore'):
+      log_seg=np.log(np.bincount(2*self.segments+self.rw.labels,weights=w,minlength=2*nseg)).reshape(nseg,2).T
+    log_z=self.scan.block_log_sums(log_seg,self.num_blocks)
+    log_tot=np.logaddexp(log_z[0],log_z[1])
+    with np.errstate(invalid='ignore'):
+      frac=np.where(np.isfinite(log_tot),np.exp(log_z[1]-log_tot),0)
+    av,err,neff=blocks.block_average(frac,log_tot)
+    return err/(av*(1-av))
+
+  def newton(self,u,tol=1e-6,max_iter=20,axis=None):
+    # moves u to deltaG=0 along the gradient, or only along the given axis (0 for temp, 1 for pres)
+    # returns the new point (None if not converged), the output of point() and the number of iterations
+    u=np.asarray(u,dtype=np.float64)
+    for i in range(max_iter):
+      res=self.point(u)
+      deltaG,grad=res[:2]
+      if abs(deltaG)<tol:
+        return u,res,i
+      if axis is None:
+        step=deltaG*grad/np.dot(grad,grad)
+      else:
+        step=np.zeros(2)
+        step[axis]=deltaG/grad[axis]
+      if not np.all(np.isfinite(step)):
+        break
+      u=u-step
+    return None,res,max_iter
+
+  def _edge(self,inside,outside,tol):
+    # the point of the line on the border of the unit square, between an inside and an outside point
+    with np.errstate(divide='ignore',invalid='ignore'):
+      s=np.amin(np.where(outside<0,inside/(inside-outside),np.where(outside>1,(1-inside)/(outside-inside),1)))
+    guess=inside+s*(outside-inside)
+    fixed=np.argmin(np.minimum(np.abs(guess),np.abs(1-guess)))
+    guess[fixed]=np.round(guess[fixed])
+    u,res,it=self.newton(guess,tol,axis=1-fixed)
+    if u is None or not _inside(u):
+      return None
+    return u,res
+
+  def trace(self,start,step=0.02,tol=1e-6):
+    # follows the line through the point closest to start, in both directions until it leaves the unit square
+    # returns a list of (u,point(u)) along the line
+    u0,res0,it=self.newton(start,tol)
+    if u0 is None or not _inside(u0):
+      return []
+    max_points=int(10/step)
+    branches=[]
+    for sign in (1,-1):
+      pts=[]
+      u,res,h=u0,res0,step
+      t=sign*_tangent(res[1])
+      closed=False
+      while len(pts)<max_points and not closed:
+        new,new_res,it=self.newton(u+h*t,tol)
+        if new is None or np.linalg.norm(new-u)>2*h: #not converged, or jumped to another part of the line
+          if h<step/16:
+            break
+          h/=2
+          continue
+        if not _inside(new):
+          edge=self._edge(u,new,tol)
+          if edge is not None:
+            pts.append(edge)
+          break
+        new_t=_tangent(new_res[1])
+        t=new_t if np.dot(new_t,t)>=0 else -new_t
+        u,res=new,new_res
+        pts.append((u,res))
+        if it<=2:
+          h=min(step,2*h)
+        closed=len(pts)>2 and np.linalg.norm(u-u0)<h
+      if closed:
+        return [(u0,res0)]+pts
+      branches.append(pts)
+    return branches[1][::-1]+[(u0,res0)]+branches[0]
+
+  def lines(self,ncoarse=9,step=0.02,tol=1e-6):
+    # traces all the parts of the line that cross the edges of a coarse ncoarse x ncoarse grid
+    x=np.linspace(0,1,ncoarse)
+    u=np.stack(np.meshgrid(x,x,indexing='ij'),axis=-1)
+    g=self.grid_deltaG(u)
+    starts=[]
+    for axis in (0,1):
+      u0,u1=np.moveaxis(u,axis,0)[:-1],np.moveaxis(u,axis,0)[1:]
+      g0,g1=np.moveaxis(g,axis,0)[:-1],np.moveaxis(g,axis,0)[1:]
+      cross=np.isfinite(g0)&np.isfinite(g1)&((g0>0)!=(g1>0))
+      with np.errstate(divide='ignore',invalid='ignore'):
+        frac=np.where(cross,g0/(g0-g1),0)
+      starts+=list((u0+frac[...,None]*(u1-u0))[cross])
+    lines=[]
+    for s in starts:
+      if any(np.amin(np.linalg.norm(np.array([p[0] for p in line])-s,axis=1))<0.5/(ncoarse-1) for line in lines):
+        continue
+      line=self.trace(s,step,tol)
+      if len(line)>0:
+        lines.append(line)
+    return lines
+
+  def refine(self,ncoarse=9,levels=0):
+    # deltaG on the coarse grid, whose cells are split in four levels times, only where deltaG changes sign
+    # returns all the evaluated points and their deltaG
+    s=2**levels
+    n=(ncoarse-1)*s #intervals of the finest grid
+    keys=[(i*s,j*s) for i in range(ncoarse) for j in range(ncoarse)]
+    values=dict(zip(keys,self.grid_deltaG(np.array(keys)/n)))
+    cells=[(i*s,j*s) for i in range(ncoarse-1) for j in range(ncoarse-1)]
+    for l in range(levels):
+      size=s>>l
+      half=size//2
+      crossed=[]
+      for i,j in cells:
+        g=np.array([values[(i,j)],values[(i+size,j)],values[(i,j+size)],values[(i+size,j+size)]])
+        if np.all(np.isfinite(g)) and np.any(g>0) and np.any(g<=0):
+          crossed.append((i,j))
+      cells=[(i+a,j+b) for i,j in crossed for a in (0,half) for b in (0,half)]
+      new=list(dict.fromkeys((i+a,j+b) for i,j in crossed for a in (0,half,size) for b in (0,half,size) if (i+a,j+b) not in values))
+      if len(new)>0:
+        values.update(zip(new,self.grid_deltaG(np.array(new)/n)))
+    keys=sorted(values)
+    return np.array(keys)/n,np.array([values[k] for k in keys])
+
+def _inside(u,eps=1e-9):
+  return np.all(u>=-eps) and np.all(u<=1+eps)
+
+def _tangent(grad):
+  t=np.array([-grad[1],grad[0]])
+  return t/np.linalg.norm(t)
@@ -0,0 +1,266 @@
+# Binary columnar cache for PLUMED Colvar files
+#
+# The first time a Colvar file is read, each of its columns is stored as a raw float64 file in
+# .colvar_cache/ next to it, named after the '#! FIELDS' header and keyed on a content fingerprint.
+# Later reads memory-map only the requested columns (copy-on-write, so in-place centering is fine),
+# and the cache is rebuilt whenever the text file changes.
+# skiprows has the same meaning as in pd.read_csv, i.e. it counts raw lines, comments included.
+# Set OPES_COLVAR_CACHE=0 to always parse the text file.
+#
+# Writer produces the text file and its cache in a single pass.
+# Usage as a converter:  python3 -m opes_analysis.colvar Colvar.data [...]
+
+import io
+import os
+import re
+import sys
+import json
+import shutil
+import hashlib
+import numpy as np
+import pandas as pd
+
+from opes_analysis import profiling
+
+cache_dir_name='.colvar_cache'
+block_size=2**24 #bytes read at once when scanning
+parse_chunk=2**20 #lines parsed at once
+skip_line=re.compile(rb'^[ \t]*(?:#[^\n]*)?\r?$',re.M) #lines that pd.read_csv does not return
+
+def cache_enabled():
+  return os.environ.get('OPES_COLVAR_CACHE','1')!='0'
+
+def _paths(filename):
+  dirname,basename=os.path.split(os.path.abspath(filename))
+  return os.path.join(dirname,cache_dir_name),basename
+
+def _scan(filename):
+  # single pass over the raw bytes: content hash, FIELDS header and line number of the skipped lines
+  h=hashlib.blake2b(digest_size=16)
+  fields=None
+  skipped=[]
+  line=0
+  rest=b''
+  with open(filename,'rb') as f:
+    while True:
+      block=f.read(block_size)
+      h.update(block)
+      if not block:
+        text=rest+b'\n' if rest else b''
+      else:
+        block=rest+block
+        cut=block.rfind(b'\n')+1
+        text=block[:cut]
+        rest=block[cut:]
+      if text:
+        nl=np.flatnonzero(np.frombuffer(text,dtype=np.uint8)==10)
+        for m in skip_line.finditer(text):
+          if m.start()==len(text):
+            continue
+          if fields is None and m.group().startswith(b'#! FIELDS'):
+            fields=m.group().split()[2:]
+          skipped.append(line+int(np.searchsorted(nl,m.start())))
+        line+=len(nl)
+      if not block:
+        break
+  if fields is not None:
+    fields=[f.decode() for f in fields]
+  return h.hexdigest(),fields,skipped
+
+@profiling.kernel('convert')
+def convert(filename):
+  # parse the text file and store it as binary columns, returns the meta data
+  cache_dir,basename=_paths(filename)
+  stat=os.stat(filename)
+  digest,fields,skipped=_scan(filename)
+  target=os.path.join(cache_dir,basename+'.'+digest)
+  tmp=target+'.tmp%d'%os.getpid()
+  os.makedirs(tmp)
+  try:
+    nrows=0
+    ncols=None
+    outs=[]
+    reader=pd.read_csv(filename,sep=r'\s+',comment='#',header=None,dtype=np.float64,chunksize=parse_chunk)
+    for data in reader:
+      if ncols is None:
+        ncols=data.shape[1]
+        outs=[open(os.path.join(tmp,'%d.f64'%i),'wb') for i in range(ncols)]
+      elif data.shape[1]!=ncols:
+        raise ValueError('inconsistent number of columns in '+filename)
+      values=data.to_numpy(dtype='<f8')
+      for i in range(ncols):
+        np.ascontiguousarray(values[:,i]).tofile(outs[i])
+      nrows+=len(values)
+    for out in outs:
+      out.close()
+    if fields is None or len(fields)!=ncols:
+      fields=[str(i) for i in range(ncols or 0)]
+    meta={'source':basename,'size':stat.st_size,'mtime_ns':stat.st_mtime_ns,'hash':digest,'fields':fields,'nrows':nrows,'skipped':skipped}
+  except (OSError,ValueError):
+    shutil.rmtree(tmp,ignore_errors=True)
+    raise
+  return _install(filename,tmp,meta)
+
+def _install(filename,tmp,meta):
+  # move the binary columns in tmp to their final place and update the index
+  cache_dir,basename=_paths(filename)
+  digest=meta['hash']
+  target=os.path.join(cache_dir,basename+'.'+digest)
+  stat=os.stat(filename)
+  try:
+    with open(os.path.join(tmp,'meta.json'),'w') as f:
+      json.dump(meta,f)
+    if os.path.isdir(target):
+      shutil.rmtree(tmp) #someone else got there first
+    else:
+      os.rename(tmp,target)
+  except (OSError,ValueError):
+    shutil.rmtree(tmp,ignore_errors=True)
+    raise
+  with open(os.path.join(cache_dir,basename+'.json'),'w') as f:
+    json.dump({'size':stat.st_size,'mtime_ns':stat.st_mtime_ns,'hash':digest},f)
+  for old in os.listdir(cache_dir): #invalidate previous versions
+    if old.startswith(basename+'.') and old!=basename+'.'+digest and old!=basename+'.json' and '.tmp' not in old:
+      shutil.rmtree(os.path.join(cache_dir,old),ignore_errors=True)
+  meta['path']=target
+  return meta
+
+def open_cache(filename):
+  # meta data of an up-to-date cache for filename, converting it if needed
+  cache_dir,basename=_paths(filename)
+  index=os.path.join(cache_dir,basename+'.json')
+  stat=os.stat(filename)
+  try:
+    with open(index) as f:
+      quick=json.load(f)
+    target=os.path.join(cache_dir,basename+'.'+quick['hash'])
+    with open(os.path.join(target,'meta.json')) as f:
+      meta=json.load(f)
+    if quick['size']!=stat.st_size or quick['mtime_ns']!=stat.st_mtime_ns:
+      if stat.st_size!=meta['size'] or _scan(filename)[0]!=meta['hash']:
+        return convert(filename)
+      quick.update(size=stat.st_size,mtime_ns=stat.st_mtime_ns) #touched but not changed
+      with open(index,'w') as f:
+        json.dump(quick,f)
+  except (OSError,ValueError,KeyError):
+    return convert(filename)
+  meta['path']=target
+  return meta
+
+def _column_index(col,fields):
+  if isinstance(col,str):
+    return fields.index(col)
+  return col
+
+@profiling.kernel('read_columns')
+def read_columns(filename,usecols,skiprows=0,dtype=None):
+  # list of the requested columns, given as index or FIELDS name, in the given order
+  meta=None
+  if cache_enabled():
+    try:
+      meta=open_cache(filename)
+    except (OSError,ValueError) as err:
+      print(' +++ WARNING cannot use colvar cache: %s'%err,file=sys.stderr)
+  if meta is None:
+    fields=None
+    if any(isinstance(c,str) for c in usecols):
+      fields=_scan(filename)[1]
+    usecols=[_column_index(c,fields) for c in usecols]
+    data=pd.read_csv(filename,sep=r'\s+',comment='#',header=None,usecols=sorted(set(usecols)),skiprows=skiprows,dtype=dtype or np.float64)
+    return [np.array(data[c]) for c in usecols]
+  skipped=np.array(meta['skipped'],dtype=np.int64)
+  start=max(0,skiprows-int(np.searchsorted(skipped,skiprows)))
+  columns=[]
+  for c in usecols:
+    c=_column_index(c,meta['fields'])
+    if c>=len(meta['fields']):
+      raise IndexError('column %d not found in %s'%(c,filename))
+    if meta['nrows']==0:
+      col=np.zeros(0)
+    else:
+      col=np.memmap(os.path.join(meta['path'],'%d.f64'%c),dtype='<f8',mode='c',shape=(meta['nrows'],))[start:]
+    if dtype is not None and np.dtype(dtype)!=col.dtype:
+      col=col.astype(dtype)
+    columns.append(col)
+  return columns
+
+def fingerprint(filename):
+  # content hash of the file, the same used to key the cache
+  if cache_enabled():
+    return open_cache(filename)['hash']
+  return _scan(filename)[0]
+
+def fields(filename):
+  # names of the columns, from the FIELDS header
+  if cache_enabled():
+    return open_cache(filename)['fields']
+  return _scan(filename)[1]
+
+class Writer:
+  # writes a Colvar file in chunks of rows, with a FIELDS header,
+  # and at the same time its binary cache, so that it does not need to be parsed again
+  def __init__(self,filename,fields,fmt,cache=None):
+    self.filename=filename
+    self.fields=list(fields)
+    self.fmt=fmt
+    self.nrows=0
+    self.hash=hashlib.blake2b(digest_size=16)
+    self.out=open(filename,'wb')
+    self.tmp=None
+    if cache is None:
+      cache=cache_enabled()
+    if cache:
+      cache_dir,basename=_paths(filename)
+      self.tmp=os.path.join(cache_dir,basename+'.tmp%d'%os.getpid())
+      shutil.rmtree(self.tmp,ignore_errors=True)
+      os.makedirs(self.tmp)
+      self.cols=[open(os.path.join(self.tmp,'%d.f64'%i),'wb') for i in range(len(self.fields))]
+    self._write(('#! FIELDS '+' '.join(self.fields)+'\n').encode())
+
+  def _write(self,text):
+    self.hash.update(text)
+    self.out.write(text)
+
+  def write(self,data):
+    # data has shape (nrows,len(fields))
+    data=np.asarray(data,dtype='<f8')
+    if len(data)==0:
+      return
+    buf=io.BytesIO()
+    np.savetxt(buf,data,fmt=self.fmt)
+    self._write(buf.getvalue())
+    if self.tmp is not None:
+      buf.seek(0) #the cache must hold the values as written in the text
+      values=pd.read_csv(buf,sep=r'\s+',header=None,dtype=np.float64).to_numpy(dtype='<f8')
+      for i,out in enumerate(self.cols):
+        np.ascontiguousarray(values[:,i]).tofile(out)
+    self.nrows+=len(data)
+
+  def close(self):
+    self.out.close()
+    if self.tmp is None:
+      return None
+    for out in self.cols:
+      out.close()
+    stat=os.stat(self.filename)
+    meta={'source':os.path.basename(self.filename),'size':stat.st_size,'mtime_ns':stat.st_mtime_ns,'hash':self.hash.hexdigest(),
+          'fields':self.fields,'nrows':self.nrows,'skipped':[0]}
+    return _install(self.filename,self.tmp,meta)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self,*exc):
+    if exc[0] is None:
+      self.close()
+    else:
+      self.out.close()
+      if self.tmp is not None:
+        for out in self.cols:
+          out.close()
+        shutil.rmtree(self.tmp,ignore_errors=True)
+
+if __name__=='__main__':
+  for filename in sys.argv[1:]:
+    meta=open_cache(filename)
+    print('  %s: %d rows, fields: %s'%(filename,meta['nrows'],' '.join(meta['fields'])))
@@ -0,0 +1,44 @@
+# Estimates as a function of the simulation length, from a single pass over the data
+#
+# The rows are split into segments at the bounds of both the growing windows [first,first+(k+1)*stride)
+# and the shrinking windows [nrows-(k+1)*stride,nrows), so that sums are accumulated only once per segment
+# (e.g. as labels of a Reweighter), and the sums over every window are prefix or suffix cumulative sums over the segments.
+# Shrinking windows are the same as the growing windows of the time-reversed data.
+# Other bounds can be added, e.g. those of a BlockScan, and coarsen() gives back the sums over their segments.
+
+import numpy as np
+
+class Windows:
+  def __init__(self,nrows,stride,first=0,bounds=()):
+    self.nrows=nrows
+    self.stride=stride
+    self.first=first
+    nwindows=max(0,(nrows-first)//stride)
+    self.lengths=stride*np.arange(1,nwindows+1)
+    self.ends=first+self.lengths
+    self.starts=nrows-self.lengths
+    self.bounds=np.unique(np.concatenate([[first,nrows],self.ends,self.starts,np.asarray(bounds,dtype=int)]))
+    self.nsegments=len(self.bounds)-1
+
+  def labels(self,first,n):
+    # segment index of the rows [first,first+n), -1 for the rows outside [bounds[0],bounds[-1])
+    rows=np.arange(first,first+n)
+    labels=np.searchsorted(self.bounds,rows,side='right')-1
+    labels[(rows<self.bounds[0])|(rows>=self.bounds[-1])]=-1
+    return labels
+
+  def growing(self,sums,log=True):
+    # from sums over the segments, shape (...,nsegments), to sums over the growing windows, shape (...,len(lengths))
+    acc=np.logaddexp.accumulate if log else np.cumsum
+    return acc(sums,axis=-1)[...,np.searchsorted(self.bounds,self.ends)-1]
+
+  def shrinking(self,sums,log=True):
+    # same as growing, for the shrinking windows
+    acc=np.logaddexp.accumulate if log else np.cumsum
+    return np.flip(acc(np.flip(sums,axis=-1),axis=-1),axis=-1)[...,np.searchsorted(self.bounds,self.starts)]
+
+  def coarsen(self,sums,bounds,log=True):
+    # from sums over the segments to sums over the segments between the given bounds, which must be a subset of bounds
+    reduce=np.logaddexp.reduceat if log else np.add.reduceat
+    b=np.searchsorted(self.bounds,bounds)
+    return reduce(sums[...,:b[-1]],b[:-1],axis=-1)
@@ -0,0 +1,398 @@
+# Offline replay of OPES_EXPANDED, to get the DeltaFs of any set of expansion collective variables (ECVs) from a Colvar file
+#
+# ECVs are given as in plumed.dat, e.g. 'ECV_UMBRELLAS_LINE ARG=p.x CV_MIN=-2.5 CV_MAX=2.5 SIGMA=0.185815',
+# and the states are all the combinations of the states of each ECV action, as with OPES_EXPANDED ARG=mtp.*,umb.*
+# The ECVs are dimensionless (in kBT units), and those of all the states are a single array operation, shape (n,nstates).
+# At each PACE step OPES_EXPANDED updates, with c the number of samples so far and V the bias (in kBT units):
+#   deltaF_i-=log1p(exp(V-rct+deltaF_i-ECV_i)/(c-1))-log1p(exp(V-rct)/(c-1))
+#   rct+=log1p(exp(V-rct)/(c-1))+log1p(-1/c)
+# starting from deltaF_i=ECV_i of the first sample, c=nwalkers and rct=0. This is the same as
+#   deltaF_i=-log(A_i/B), rct=log(B/c), with A_i=sum_k exp(V_k-ECV_i(x_k)) and B=sum_k exp(V_k)
+# where the first sample counts nwalkers times with V=0, thus the replay is a running log-sum-exp over the samples,
+# and its state (A,B,c) can be saved as a checkpoint and continued when the Colvar file grows.
+# V is the bias in the Colvar file, i.e. the one the samples were drawn with, so that any other ECVs can be used.
+# With the ECVs of the simulation, the bias can also be recomputed from the replayed deltaF, as a check of the input.
+# Rows with the same time of a merged multiple-walkers file are the walkers of a single update, in their order.
+# The Colvar file must be printed every PACE steps. The number of steps of each ECV must be given explicitly,
+# since PLUMED would obtain it from the first steps of the simulation (e.g. TEMP_STEPS of ECV_MULTITHERMAL).
+
+import re
+import json
+import numpy as np
+
+from opes_analysis import backup
+from opes_analysis.reweight import kB
+
+def _number(s):
+  # a number, or a product of numbers as in plumed.dat, e.g. 0.06022140857*2000
+  value=1.
+  for i,f in enumerate(re.split(r'([*/])',s)):
+    if i%2==1:
+      op=f
+    elif i==0:
+      value=float(f)
+    else:
+      value=value*float(f) if op=='*' else value/float(f)
+  return value
+
+def _steps(vmin,vmax,steps,geometric=False):
+  if steps<1:
+    raise ValueError('the number of steps must be positive')
+  if steps==1:
+    return np.array([vmin])
+  if geometric:
+    return vmin*(vmax/vmin)**np.linspace(0,1,steps)
+  return np.linspace(vmin,vmax,steps)
+
+class ECV:
+  # base of the ECV actions: keywords as a dict, args are the names of the Colvar columns, labels one per state
+  keywords=()
+  flags=()
+
+  def __init__(self,kind,keys,kbt):
+    self.kind=kind
+    self.keys=dict(keys)
+    self.kbt=kbt
+    for k in self.keys:
+      if k not in self.keywords+self.flags+('ARG','LABEL'):
+        raise ValueError('%s: keyword %s is not supported'%(kind,k))
+    self.args=self.keys['ARG'].split(',')
+    if 'TEMP' in self.keys:
+      self.kbt=kB*_number(self.keys['TEMP'])
+
+  def get(self,key,default=None):
+    if key not in self.keys:
+      if default is None:
+        raise ValueError('%s: keyword %s is needed'%(self.kind,key))
+      return default
+    return _number(self.keys[key])
+
+  def values(self,key,vmin,vmax,geometric=False):
+    # the list in key_SET_ALL, otherwise key_STEPS values from vmin to vmax
+    if key+'_SET_ALL' in self.keys:
+      return np.array([_number(v) for v in self.keys[key+'_SET_ALL'].split(',')])
+    return _steps(vmin,vmax,int(self.get(key+'_STEPS')),geometric)
+
+class MultiThermal(ECV):
+  keywords=('TEMP','TEMP_MIN','TEMP_MAX','TEMP_STEPS','TEMP_SET_ALL')
+  flags=('NO_GEOM_SPACING',)
+
+  def __init__(self,kind,keys,kbt):
+    super().__init__(kind,keys,kbt)
+    temp=self.kbt/kB
+    self.temps=self.values('TEMP',self.get('TEMP_MIN',temp),self.get('TEMP_MAX',temp),'NO_GEOM_SPACING' not in self.keys)
+    self.labels=['%g'%t for t in self.temps]
+
+  def __call__(self,ene):
+    return np.multiply.outer(ene,1/(kB*self.temps)-1/self.kbt)
+
+  def gradient(self,ene):
+    return [np.multiply.outer(np.ones_like(ene),1/(kB*self.temps)-1/self.kbt)]
+
+class MultiThermalMultiBaric(ECV):
+  keywords=('TEMP','TEMP_MIN','TEMP_MAX','TEMP_STEPS','TEMP_SET_ALL','PRESSURE','PRESSURE_MIN','PRESSURE_MAX','PRESSURE_STEPS','PRESSURE_SET_ALL','CUT_CORNER')
+  flags=('NO_GEOM_SPACING',)
+
+  def __init__(self,kind,keys,kbt):
+    super().__init__(kind,keys,kbt)
+    temp=self.kbt/kB
+    self.pres=self.get('PRESSURE')
+    temps=self.values('TEMP',self.get('TEMP_MIN',temp),self.get('TEMP_MAX',temp),'NO_GEOM_SPACING' not in self.keys)
+    press=self.values('PRESSURE',self.get('PRESSURE_MIN',self.pres),self.get('PRESSURE_MAX',self.pres))
+    t,p=np.meshgrid(temps,press,indexing='ij') #pressure is the inner index
+    i,j=np.meshgrid(np.arange(1,len(temps)+1),np.arange(1,len(press)+1),indexing='ij')
+    keep=np.ones(t.shape,dtype=bool)
+    if 'CUT_CORNER' in self.keys:
+      #the states below the line from (temp_low,pres_low) to (temp_high,pres_high) are removed, e.g. high temp and low pres
+      t_low,p_low,t_high,p_high=[_number(v) for v in self.keys['CUT_CORNER'].split(',')]
+      keep=(p-p_low)*(t_high-t_low)>=(t-t_low)*(p_high-p_low)
+    self.temps=t[keep]
+    self.press=p[keep]
+    self.labels=['%d_%d'%ij for ij in zip(i[keep],j[keep])]
+
+  def __call__(self,ene,vol):
+    beta0=1/self.kbt
+    betas=1/(kB*self.temps)
+    return np.multiply.outer(ene,betas-beta0)+np.multiply.outer(vol,betas*self.press-beta0*self.pres)
+
+  def gradient(self,ene,vol):
+    beta0=1/self.kbt
+    betas=1/(kB*self.temps)
+    return [np.multiply.outer(np.ones_like(ene),betas-beta0),np.multiply.outer(np.ones_like(vol),betas*self.press-beta0*self.pres)]
+
+class UmbrellasLine(ECV):
+  keywords=('TEMP','CV_MIN','CV_MAX','SIGMA','SPACING')
+
+  def __init__(self,kind,keys,kbt):
+    super().__init__(kind,keys,kbt)
+    cv_min=self.get('CV_MIN')
+    cv_max=self.get('CV_MAX')
+    self.sigma=self.get('SIGMA')
+    n=int(np.ceil((cv_max-cv_min)/(self.sigma*self.get('SPACING',1.))))+1
+    self.centers=np.linspace(cv_min,cv_max,n)
+    self.labels=['%f'%c for c in self.centers]
+
+  def __call__(self,cv):
+    return 0.5*(np.subtract.outer(cv,self.centers)/self.sigma)**2
+
+  def gradient(self,cv):
+    return [np.subtract.outer(cv,self.centers)/self.sigma**2]
+
+class Linear(ECV):
+  keywords=('TEMP','LAMBDA','LAMBDA_MIN','LAMBDA_MAX','LAMBDA_STEPS','LAMBDA_SET_ALL')
+  flags=('DIMENSIONLESS',)
+
+  def __init__(self,kind,keys,kbt):
+    super().__init__(kind,keys,kbt)
+    self.lambdas=self.values('LAMBDA',self.get('LAMBDA_MIN',0.),self.get('LAMBDA_MAX',1.))
+    self.lambda0=self.get('LAMBDA',0.)
+    self.labels=['%g'%l for l in self.lambdas]
+
+  def __call__(self,x):
+    beta0=1 if 'DIMENSIONLESS' in self.keys else 1/self.kbt
+    return np.multiply.outer(x,(self.lambdas-self.lambda0)*beta0)
+
+  def gradient(self,x):
+    beta0=1 if 'DIMENSIONLESS' in self.keys else 1/self.kbt
+    return [np.multiply.outer(np.ones_like(x),(self.lambdas-self.lambda0)*beta0)]
+
+ecv_types={'ECV_MULTITHERMAL':MultiThermal,'ECV_MULTITHERMAL_MULTIBARIC':MultiThermalMultiBaric,'ECV_UMBRELLAS_LINE':UmbrellasLine,'ECV_LINEAR':Linear}
+
+def parse(line,kbt=None):
+  # an ECV action from a line of plumed.dat, e.g. 'umb: ECV_UMBRELLAS_LINE ARG=cv CV_MIN=0 CV_MAX=1 SIGMA=0.1'
+  words=line.split('#')[0].split()
+  if len(words)>0 and words[0].endswith(':'):
+    words=words[1:]
+  if len(words)==0 or words[0] not in ecv_types:
+    raise ValueError('unknown ECV action: %s, available: %s'%(line.strip(),', '.join(ecv_types)))
+  keys={}
+  for w in words[1:]:
+    k,_,v=w.partition('=')
+    keys[k]=v
+  return ecv_types[words[0]](words[0],keys,kbt)
+
+def read_plumed(filename,kinds=ecv_types):
+  # the lines of all the actions of the given kinds in a plumed.dat file, by default the ECVs, joining the '...' blocks
+  actions=[]
+  block=None
+  with open(filename) as f:
+    for line in f:
+      line=line.split('#')[0].strip()
+      if line.startswith('ENDPLUMED'):
+        break
+      if block is not None:
+        if line.startswith('...'):
+          actions.append(' '.join(block))
+          block=None
+        else:
+          block.append(line)
+      elif line.endswith('...'):
+        block=[line[:-3]]
+      elif line:
+        actions.append(line)
+  return [a for a in actions if any(w in kinds for w in a.split()[:2])]
+
+def with_set(line,keys):
+  # the line of an ECV action, with the keywords in keys (e.g. 'TEMP_STEPS=10') that it supports and does not have yet
+  cls=[ecv_types[w] for w in line.split()[:2] if w in ecv_types][0]
+  for key in keys:
+    if key.split('=')[0] in cls.keywords+cls.flags and ' '+key.split('=')[0] not in line:
+      line+=' '+key
+  return line
+
+def simulation_kbt(lines,temp=None,kbt=None):
+  # the temperature of the simulation in energy units: kbt, or from temp, or from the first TEMP= of the ECV lines
+  if kbt is not None:
+    return kbt
+  if temp is not None:
+    return kB*temp
+  temps=[w.split('=')[1] for line in lines for w in line.split() if w.startswith('TEMP=')]
+  return kB*_number(temps[0]) if temps else None
+
+def keywords(line):
+  # the KEY=value pairs of an action line, as a dict of strings
+  return dict(w.split('=',1) for w in line.split() if '=' in w)
+
+def header(labels,print_stride):
+  # the header of a DeltaFs file
+  return '#! FIELDS time rct '+' '.join(labels)+'\n#! SET print_stride %d\n'%print_stride
+
+def rows(printed,kbt):
+  # the (time,rct,deltaF) returned by Replay as rows of a DeltaFs file, in energy units
+  return np.array([np.r_[t,kbt*rct,kbt*dF] for t,rct,dF in printed])
+
+class Expansion:
+  # all the states of a list of ECV actions, as in OPES_EXPANDED
+  def __init__(self,ecvs):
+    self.ecvs=ecvs
+    self.args=list(dict.fromkeys(a for e in ecvs for a in e.args))
+    sizes=[len(e.labels) for e in ecvs]
+    self.nstates=int(np.prod(sizes))
+    if len(ecvs)==1:
+      self.labels=['deltaF_'+l for l in ecvs[0].labels]
+    else:
+      idx=np.indices(sizes).reshape(len(sizes),-1).T+1
+      self.labels=['deltaF_'+'_'.join('%d'%i for i in row) for row in idx]
+
+  def __call__(self,columns):
+    # ECVs of the samples, columns is a dict with the arrays of args, returns shape (n,nstates)
+    if len(self.ecvs)==1:
+      return self.ecvs[0](*[columns[a] for a in self.ecvs[0].args])
+    n=len(columns[self.args[0]])
+    total=np.zeros((n,1))
+    for e in self.ecvs:
+      u=e(*[columns[a] for a in e.args])
+      total=(total[:,:,np.newaxis]+u[:,np.newaxis,:]).reshape(n,-1)
+    return total
+
+  def gradient(self,columns):
+    # derivatives of the ECVs with respect to each of args, as a dict of arrays with shape (n,nstates)
+    if len(self.ecvs)==1:
+      return dict(zip(self.ecvs[0].args,self.ecvs[0].gradient(*[columns[a] for a in self.ecvs[0].args])))
+    n=len(columns[self.args[0]])
+    grads={a:np.zeros((n,1)) for a in self.args}
+    for e in self.ecvs:
+      g=e.gradient(*[columns[a] for a in e.args])
+      for a in self.args:
+        d=g[e.args.index(a)] if a in e.args else np.zeros((n,len(e.labels)))
+        grads[a]=(grads[a][:,:,np.newaxis]+d[:,np.newaxis,:]).reshape(n,-1)
+    return grads
+
+  def bias(self,deltaF,columns,gradient=False):
+    # the OPES_EXPANDED bias in kBT units, V=-log(sum_i exp(deltaF_i-ECV_i)/nstates), for deltaF of shape (nstates,) or (n,nstates)
+    # with gradient=True also its derivatives with respect to args, dV/da=sum_i p_i*dECV_i/da with p_i=exp(deltaF_i-ECV_i+V)/nstates
+    z=deltaF-self(columns)
+    if not gradient:
+      return -(_logsumexp(z,axis=1)-np.log(self.nstates))
+    #a single exp for both V and p, this is called at every step of the simulator
+    m=np.amax(z,axis=1,keepdims=True)
+    m[~np.isfinite(m)]=0
+    e=np.exp(z-m)
+    s=e.sum(axis=1,keepdims=True)
+    with np.errstate(divide='ignore',invalid='ignore'):
+      V=-(np.log(s[:,0])+m[:,0]-np.log(self.nstates))
+      p=e/s
+    return V,{a:np.einsum('ns,ns->n',p,g) for a,g in self.gradient(columns).items()}
+
+def _logsumexp(x,axis=0):
+  m=np.amax(x,axis=axis,keepdims=True)
+  m[~np.isfinite(m)]=0
+  with np.errstate(divide='ignore'):
+    return np.squeeze(np.log(np.sum(np.exp(x-m),axis=axis,keepdims=True))+m,axis=axis)
+
+def _log_reduceat(x,starts):
+  # log(sum(exp(x))) over the rows of each group beginning at starts, along axis 0
+  if len(starts)==len(x):
+    return x
+  m=np.maximum.reduceat(x,starts,axis=0)
+  m[~np.isfinite(m)]=0
+  rows=np.repeat(np.arange(len(starts)),np.diff(np.r_[starts,len(x)]))
+  with np.errstate(divide='ignore'):
+    return np.log(np.add.reduceat(np.exp(x-m[rows]),starts,axis=0))+m
+
+def _log_cumsum(x,initial,block=1024):
+  # running log(exp(initial)+sum(exp(x))) along axis 0, as a plain cumsum in blocks shifted by their max,
+  # much faster than np.logaddexp.accumulate, which is used only for a block whose values would underflow
+  out=np.empty(x.shape)
+  prev=np.asarray(initial,dtype=np.float64)
+  for s in range(0,len(x),block):
+    y=x[s:s+block]
+    m=np.maximum(np.amax(y,axis=0),prev)
+    c=np.cumsum(np.exp(y-m),axis=0)
+    c+=np.exp(prev-m)
+    if np.all(c[0]>0):
+      out[s:s+block]=np.log(c)+m
+    else:
+      out[s:s+block]=np.logaddexp(prev,np.logaddexp.accumulate(y,axis=0))
+    prev=out[s+len(y)-1]
+  return out
+
+class Replay:
+  # the running OPES_EXPANDED estimate of deltaF, fed with chunks of (time,bias,ECVs) of consecutive samples
+  def __init__(self,nstates,print_stride=100):
+    self.nstates=nstates
+    self.print_stride=print_stride
+    self.log_A=np.full(nstates,-np.inf)
+    self.log_B=-np.inf
+    self.counter=0
+    self.updates=0
+    self.nwalkers=0
+    self.last_time=np.nan
+
+  def deltaF(self):
+    return -(self.log_A-self.log_B)
+
+  def rct(self):
+    return self.log_B-np.log(self.counter)
+
+  def start(self,time,ecv,nwalkers):
+    # initialization from the ECVs of the first sample, counted as nwalkers samples with bias=0
+    self.nwalkers=nwalkers
+    self.counter=nwalkers
+    self.log_A=np.log(nwalkers)-np.asarray(ecv,dtype=np.float64)
+    self.log_B=np.log(nwalkers)
+    self.last_time=time
+    return time,0.,self.deltaF()
+
+  def _starts(self,time):
+    # first row of each update, i.e. of the rows with the same time
+    return np.flatnonzero(np.r_[True,time[1:]!=time[:-1]])
+
+  def add(self,time,bias,ecv):
+    # bias (in kBT units) and ECVs, shape (n,nstates), of consecutive rows ending with a complete update
+    # returns the list of (time,rct,deltaF) to be printed, every print_stride updates
+    if len(time)==0:
+      return []
+    starts=self._starts(time)
+    update=self.updates+np.arange(1,len(starts)+1)
+    #the chunk is split after each update to be printed
+    ends=np.r_[starts[1:],len(time)]
+    ends=np.unique(np.r_[ends[update%self.print_stride==0],len(time)])
+    out=[]
+    start=0
+    for end in ends:
+      self.log_A=np.logaddexp(self.log_A,_logsumexp(bias[start:end,np.newaxis]-ecv[start:end]))
+      self.log_B=np.logaddexp(self.log_B,_logsumexp(bias[start:end]))
+      self.counter+=end-start
+      self.updates+=np.count_nonzero((starts>=start)&(starts<end))
+      if self.updates%self.print_stride==0:
+        out.append((time[end-1],self.rct(),self.deltaF()))
+      start=end
+    self.last_time=time[-1]
+    return out
+
+  def deltaFs(self,time,ecv,bias):
+    # the deltaF before the update of each row, shape (n,nstates), i.e. the one of the bias the row was sampled with
+    # the bias of the Colvar file is needed for the running sums, and this must be called before add
+    starts=self._starts(time)
+    log_A=np.empty((len(starts),self.nstates))
+    log_B=np.empty(len(starts))
+    log_A[0]=self.log_A
+    log_B[0]=self.log_B
+    if len(starts)>1:
+      #running sums up to each update
+      a=_log_reduceat(bias[:starts[-1],np.newaxis]-ecv[:starts[-1]],starts[:-1])
+      b=_log_reduceat(bias[:starts[-1]],starts[:-1])
+      log_A[1:]=_log_cumsum(a,self.log_A)
+      log_B[1:]=_log_cumsum(b,self.log_B)
+    rows=np.repeat(np.arange(len(starts)),np.diff(np.r_[starts,len(time)]))
+    return -(log_A-log_B[:,np.newaxis])[rows]
+
+  def bias(self,time,ecv,bias):
+    # bias of the simulation recomputed from the deltaF before each update, in kBT units, for a check of the ECVs
+    return -(_logsumexp(self.deltaFs(time,ecv,bias)-ecv,axis=1)-np.log(self.nstates))
+
+  def save(self,filename,**info):
+    backup.backup(filename)
+    np.savez(filename,log_A=self.log_A,log_B=self.log_B,counter=self.counter,updates=self.updates,
+             nwalkers=self.nwalkers,last_time=self.last_time,info=json.dumps(info))
+
+  def load(self,filename):
+    with np.load(filename) as f:
+      self.log_A=f['log_A']
+      self.log_B=float(f['log_B'])
+      self.counter=int(f['counter'])
+      self.updates=int(f['updates'])
+      self.nwalkers=int(f['nwalkers'])
+      self.last_time=float(f['last_time'])
+      return json.loads(str(f['info']))
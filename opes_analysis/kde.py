@@ -0,0 +1,337 @@
+# Gaussian kernel density estimates on a uniform grid, for the reweighted FES
+#
+# Each sample deposits w*exp(-0.5*((grid-x)/sigma)**2), with samples grouped by integer labels
+# (e.g. time blocks, so that running estimates are cumulative sums over the groups).
+# gaussian_sums is the exact sum, in memory-bounded chunks, while binned_gaussian_sums
+# deposits the weights on a finer histogram with linear binning and convolves it with the kernel via FFT.
+# Linear binning has an error of order (dx/sigma)**2/12 relative to the kernel, with dx the fine bin width,
+# while the FFT round-off and the kernel cutoff give an absolute error, for each label, estimated as
+# eps*log2(size)*|hist|_2*|kernel|_2 (above the measured one) plus the total weight times exp(-0.5*cutoff**2).
+# Where this is above tol times the sum, i.e. an error above tol in the FES (in kBT), only those (label,grid point)
+# pairs are recomputed exactly. For the running sums the check is on the cumulative sums, and for each grid point
+# only the labels up to the last one that fails it, and themselves above tol, are recomputed.
+# The 2D periodic version does the same for each set of weights, on the subgrid of the rows and columns to recompute.
+# truncated_log_sums works in log space, as the reweighting, and uses only the samples within cutoff*sigma
+# of each grid point (any grid), found by binary search on the samples sorted once by label and x.
+# The dropped kernels are less than exp(-0.5*cutoff**2) times the total weight of the label, and the grid points
+# where this bound is above tol relative to the truncated sum are recomputed exactly.
+# stacked_log_sums does the same for a stack of log-weights, e.g. one row per (T,P) target, as a single matrix
+# product of the weights with the kernels for each label, after shifting the log-weights by their max for each target
+# and the log-kernels by their max for each grid point. The sums where the products may have underflowed
+# (more than -floor below the shifts) are recomputed in log space.
+
+import numpy as np
+
+from opes_analysis import reweight
+from opes_analysis import profiling
+from opes_analysis.reweight import LogSumExp
+
+def _groups(x,labels,nlabels):
+  if labels is None:
+    return np.zeros(len(x),dtype=np.int64),1
+  labels=np.asarray(labels).astype(np.int64)
+  if nlabels is None:
+    nlabels=np.amax(labels)+1 if len(labels)>0 else 0
+  return labels,nlabels
+
+def _shape(sums,labels):
+  return sums[0] if labels is None else sums
+
+@profiling.kernel('kde.gaussian_sums')
+def gaussian_sums(x,w,grid,sigma,labels=None,nlabels=None):
+  # exact kernel sums on grid, shape (nlabels,len(grid)), or (len(grid),) without labels
+  # samples with negative labels are discarded
+  labels_,nlabels=_groups(x,labels,nlabels)
+  grid=np.asarray(grid,dtype=np.float64)
+  sums=np.zeros((nlabels,len(grid)))
+  chunk=max(1,reweight.max_size//len(grid))
+  for n in range(0,len(x),chunk):
+    lab=labels_[n:n+chunk]
+    keep=lab>=0
+    arg=(grid-x[n:n+chunk,np.newaxis][keep])/sigma
+    kernel=np.exp(-0.5*arg**2)
+    kernel*=w[n:n+chunk,np.newaxis][keep]
+    lab=lab[keep]
+    order=np.argsort(lab,kind='stable')
+    lab=lab[order]
+    starts=np.flatnonzero(np.r_[True,lab[1:]!=lab[:-1]]) if len(lab)>0 else []
+    if len(starts)>0:
+      sums[lab[starts]]+=np.add.reduceat(kernel[order],starts,axis=0)
+  return _shape(sums,labels)
+
+def fine_spacing(grid,sigma,oversample=32):
+  # fine bin width, a divisor of the grid spacing of at most sigma/oversample
+  dgrid=grid[1]-grid[0]
+  return dgrid/max(1,int(np.ceil(dgrid*oversample/sigma)))
+
+def _exact_pairs(sums,x,w,grid,sigma,labels,nlabels,need):
+  # exact kernel sums for the (label,grid point) pairs where need, shape (nlabels,len(grid)), is True
+  order=np.argsort(labels,kind='stable')
+  bounds=np.searchsorted(labels[order],np.arange(nlabels+1))
+  counts=np.diff(bounds)
+  for j in np.flatnonzero(np.any(need,axis=0)):
+    ks=np.flatnonzero(need[:,j]&(counts>0))
+    c=counts[ks]
+    if len(c)==0:
+      continue
+    starts=np.cumsum(c)-c
+    smp=order[np.arange(np.sum(c))-np.repeat(starts,c)+np.repeat(bounds[ks],c)]
+    sums[ks,j]=np.add.reduceat(w[smp]*np.exp(-0.5*((grid[j]-x[smp])/sigma)**2),starts)
+  return sums
+
+def _refine(sums,error,x,w,grid,sigma,labels,nlabels,tol,cumulative=False,reverse=False):
+  # exact values where the absolute error estimate of each label is above tol times the sums
+  # with cumulative only up to the last label where this holds for the cumulative sums of error and sums,
+  # since the running sums are accurate once the labels with an accurate sum dominate (with reverse, also from the last label)
+  need=error[:,np.newaxis]>tol*sums
+  if cumulative:
+    last=np.amax(np.where(np.cumsum(error)[:,np.newaxis]>tol*np.cumsum(sums,axis=0),np.arange(nlabels)[:,np.newaxis],-1),axis=0)
+    prefix=np.arange(nlabels)[:,np.newaxis]<=last
+    if reverse:
+      r_error=np.cumsum(error[::-1])[::-1]
+      r_sums=np.cumsum(sums[::-1],axis=0)[::-1]
+      first=np.amin(np.where(r_error[:,np.newaxis]>tol*r_sums,np.arange(nlabels)[:,np.newaxis],nlabels),axis=0)
+      prefix|=np.arange(nlabels)[:,np.newaxis]>=first
+    need&=prefix
+  if np.any(need):
+    sums=_exact_pairs(sums,x,w,grid,sigma,labels,nlabels,need)
+  return sums
+
+@profiling.kernel('kde.binned_gaussian_sums')
+def binned_gaussian_sums(x,w,grid,sigma,labels=None,nlabels=None,oversample=32,cutoff=12,tol=1e-3,cumulative=False,reverse=False):
+  # same as gaussian_sums, for a uniform grid, via linear binning and FFT convolution
+  # samples farther than cutoff*sigma from the grid are discarded, their contribution is below exp(-0.5*cutoff**2)
+  # the sums with an estimated round-off error above tol (relative) are recomputed exactly, tol=None disables this
+  # with cumulative (and reverse) the check is on the running sums over the labels, see _refine
+  labels_,nlabels=_groups(x,labels,nlabels)
+  grid=np.asarray(grid,dtype=np.float64)
+  if len(grid)<2:
+    return gaussian_sums(x,w,grid,sigma,labels,nlabels)
+  dx=fine_spacing(grid,sigma,oversample)
+  step=int(round((grid[1]-grid[0])/dx))
+  pad=int(np.ceil(cutoff*sigma/dx))
+  origin=grid[0]-pad*dx
+  nfine=(len(grid)-1)*step+2*pad+1
+
+  pos=(x-origin)/dx
+  keep=(labels_>=0)&(pos>=0)&(pos<nfine-1)
+  pos=pos[keep]
+  lab=labels_[keep]
+  wk=w[keep]
+  left=np.floor(pos).astype(np.int64)
+  frac=pos-left
+  idx=lab*nfine+left
+  hist=np.bincount(idx,weights=wk*(1-frac),minlength=nlabels*nfine)
+  hist+=np.bincount(idx+1,weights=wk*frac,minlength=nlabels*nfine)
+  hist=hist.reshape(nlabels,nfine)
+
+  kernel=np.exp(-0.5*(np.arange(-pad,pad+1)*dx/sigma)**2)
+  size=1<<int(np.ceil(np.log2(nfine+len(kernel)-1)))
+  conv=np.fft.irfft(np.fft.rfft(hist,size,axis=1)*np.fft.rfft(kernel,size),size,axis=1)
+  sums=conv[:,2*pad:2*pad+(len(grid)-1)*step+1:step]
+  np.maximum(sums,0,out=sums) #FFT round-off
+  if tol is not None:
+    used=labels_>=0
+    error=np.finfo(np.float64).eps*np.log2(size)*np.linalg.norm(hist,axis=1)*np.linalg.norm(kernel)
+    error+=np.exp(-0.5*cutoff**2)*np.bincount(labels_[used],weights=w[used],minlength=nlabels)
+    sums=_refine(sums,error,x,w,grid,sigma,labels_,nlabels,tol,cumulative,reverse)
+  return _shape(sums,labels)
+
+def running_sums(x,w,grid,sigma,stride,first=0,exact=False,tol=1e-3):
+  # kernel sums of the samples [first,(n+1)*stride) for each n, followed by the sums over all samples
+  # returns an array of shape (len(x)//stride+1,len(grid)), used for the running FES snapshots
+  # each block of samples is deposited once, and the snapshots are cumulative sums over the blocks
+  nblocks=len(x)//stride
+  labels=np.arange(len(x))//stride
+  labels[:first]=-1
+  if exact:
+    sums=gaussian_sums(x,w,grid,sigma,labels,nblocks+1)
+  else:
+    sums=binned_gaussian_sums(x,w,grid,sigma,labels,nblocks+1,tol=tol,cumulative=True)
+  return np.cumsum(sums,axis=0)
+
+def window_sums(x,w,grid,sigma,windows,first=0,exact=False,tol=1e-3):
+  # kernel sums over the segments of a convergence.Windows, shape (nsegments,len(grid)), discarding the samples before first
+  # windows.growing and windows.shrinking (with log=False) give from them the running sums in both directions
+  labels=windows.labels(0,len(x))
+  labels[:first]=-1
+  if exact:
+    return gaussian_sums(x,w,grid,sigma,labels,windows.nsegments)
+  return binned_gaussian_sums(x,w,grid,sigma,labels,windows.nsegments,tol=tol,cumulative=True,reverse=True)
+
+@profiling.kernel('kde.truncated_log_sums')
+def truncated_log_sums(x,log_w,grid,sigma,labels,nlabels,cutoff=12,tol=1e-16):
+  # log of the kernel sums on grid, shape (nlabels,len(grid)), with log-weights log_w, discarding negative labels
+  # the kernels of the samples farther than cutoff*sigma are dropped, for each label and grid point
+  # returns also the largest bound on the relative error of the sums, after the exact recomputation
+  dtype=np.result_type(log_w.dtype,np.float64)
+  grid=np.asarray(grid,dtype=np.float64)
+  labels=np.asarray(labels).astype(np.int64)
+  nbins=len(grid)
+  log_sums=np.full(nlabels*nbins,-np.inf,dtype=dtype)
+  keep=np.flatnonzero(labels>=0)
+  if len(keep)==0 or nbins==0:
+    return log_sums.reshape(nlabels,nbins),0.
+  width=cutoff*sigma
+  origin=min(np.amin(x[keep]),grid[0])-width
+  span=max(np.amax(x[keep]),grid[-1])+width-origin+1 #labels are placed side by side along x
+  key=labels[keep]*span+(x[keep]-origin)
+  order=np.argsort(key,kind='stable')
+  samples=keep[order]
+  key=key[order]
+  offset=np.arange(nlabels)[:,np.newaxis]*span-origin
+  lo=np.searchsorted(key,np.ravel(offset+grid-width),side='left')
+  counts=np.searchsorted(key,np.ravel(offset+grid+width),side='right')-lo
+  ends=np.cumsum(counts)
+  first=0
+  while first<len(counts):
+    #chunks of (label,grid point) pairs with at most max_size kernels
+    last=max(first+1,int(np.searchsorted(ends,ends[first]-counts[first]+reweight.max_size,side='right')))
+    c=counts[first:last]
+    nz=np.flatnonzero(c)
+    if len(nz)>0:
+      starts=np.cumsum(c)-c
+      pos=np.arange(np.sum(c))-np.repeat(starts,c)+np.repeat(lo[first:last],c)
+      smp=samples[pos]
+      g=np.repeat(grid[np.arange(first,last)%nbins],c).astype(dtype)
+      log_k=log_w[smp].astype(dtype)-0.5*((g-x[smp].astype(dtype))/sigma)**2
+      m=np.maximum.reduceat(log_k,starts[nz])
+      log_k-=np.repeat(m,c[nz])
+      np.exp(log_k,out=log_k)
+      log_sums[first+nz]=np.log(np.add.reduceat(log_k,starts[nz]))+m
+    first=last
+  log_sums=log_sums.reshape(nlabels,nbins)
+
+  #error bound, and exact sums where it is above tol
+  log_tot=LogSumExp(nlabels,dtype=dtype)
+  log_tot.add_unsorted(log_w.astype(dtype),labels)
+  with np.errstate(invalid='ignore'):
+    log_bound=-0.5*cutoff**2+log_tot.result()[:,np.newaxis]-log_sums
+  log_bound[~np.isfinite(log_tot.result())]=-np.inf #empty labels
+  cols=np.flatnonzero(np.any(log_bound>np.log(tol),axis=0))
+  if len(cols)>0:
+    exact=LogSumExp((len(cols),nlabels),dtype=dtype)
+    chunk=max(1,reweight.max_size//len(cols))
+    for n in range(0,len(x),chunk):
+      log_k=log_w[n:n+chunk].astype(dtype)-0.5*((grid[cols,np.newaxis].astype(dtype)-x[n:n+chunk].astype(dtype))/sigma)**2
+      exact.add_unsorted(log_k,labels[n:n+chunk])
+    log_sums[:,cols]=exact.result().T
+    log_bound[:,cols]=-np.inf
+  return log_sums,float(np.exp(np.amax(log_bound)))
+
+@profiling.kernel('kde.stacked_log_sums')
+def stacked_log_sums(x,log_w,grid,sigma,labels,nlabels,floor=-600):
+  # log of the kernel sums on grid for each row of log_w, shape (ntargets,n), discarding negative labels
+  # returns shape (ntargets,nlabels,len(grid))
+  dtype=np.result_type(log_w.dtype,np.float64)
+  grid=np.asarray(grid,dtype=np.float64)
+  labels=np.asarray(labels).astype(np.int64)
+  log_sums=np.full((len(log_w),nlabels,len(grid)),-np.inf,dtype=dtype)
+  keep=np.flatnonzero(labels>=0)
+  if len(keep)==0:
+    return log_sums
+  order=keep[np.argsort(labels[keep],kind='stable')]
+  lab=labels[order]
+  starts=np.flatnonzero(np.r_[True,lab[1:]!=lab[:-1]])
+  ends=np.append(starts[1:],len(order))
+  for s,e in zip(starts,ends):
+    smp=order[s:e]
+    lw=log_w[:,smp].astype(dtype)
+    lk=-0.5*((grid[:,np.newaxis]-x[smp].astype(dtype))/sigma)**2
+    mw=np.amax(lw,axis=1,keepdims=True)
+    mk=np.amax(lk,axis=1,keepdims=True)
+    with np.errstate(divide='ignore'):
+      res=np.log(np.matmul(np.exp(lw-mw),np.exp(lk-mk).T))
+    t,b=np.nonzero(res<floor)
+    res+=mw+mk.T
+    chunk=max(1,reweight.max_size//len(smp))
+    for i in range(0,len(t),chunk):
+      res[t[i:i+chunk],b[i:i+chunk]]=np.logaddexp.reduce(lw[t[i:i+chunk]]+lk[b[i:i+chunk]],axis=1)
+    log_sums[:,lab[s]]=res
+  return log_sums
+
+def _periodic_kernel(grid,x,sigma,period):
+  # kernel with minimum image distance, shape (len(grid),len(x))
+  d=(grid[:,np.newaxis]-x)%period
+  np.minimum(d,period-d,out=d)
+  d*=d
+  d*=-0.5/sigma**2
+  return np.exp(d,out=d)
+
+@profiling.kernel('kde.periodic_gaussian_sums_2d')
+def periodic_gaussian_sums_2d(x,y,w,grid_x,grid_y,sigma,period):
+  # exact 2D kernel sums on the torus, shape (len(w),len(grid_y),len(grid_x)) for a 2D array of weights w
+  # the kernel is separable, thus each chunk of samples is a single matrix product
+  w=np.atleast_2d(w)
+  grid_x=np.asarray(grid_x,dtype=np.float64)
+  grid_y=np.asarray(grid_y,dtype=np.float64)
+  sums=np.zeros((len(w),len(grid_y),len(grid_x)))
+  chunk=max(1,reweight.max_size//max(len(grid_x),len(grid_y)))
+  for n in range(0,len(x),chunk):
+    k_x=_periodic_kernel(grid_x,x[n:n+chunk],sigma,period)
+    k_y=_periodic_kernel(grid_y,y[n:n+chunk],sigma,period)
+    for t in range(len(w)):
+      sums[t]+=(k_y*w[t,n:n+chunk])@k_x.T
+  return sums
+
+def _periodic_fine(grid,sigma,period,oversample):
+  # number of fine bins over the period and grid step in fine bins, None if the grid does not fit the period
+  dgrid=grid[1]-grid[0]
+  nper=int(round(period/dgrid))
+  if nper<1 or abs(nper*dgrid-period)>1e-6*period or not np.allclose(np.diff(grid),dgrid):
+    return None
+  step=max(1,int(np.ceil(dgrid*oversample/sigma)))
+  return nper*step,step
+
+@profiling.kernel('kde.binned_periodic_gaussian_sums_2d')
+def binned_periodic_gaussian_sums_2d(x,y,w,grid_x,grid_y,sigma,period,oversample=32,tol=1e-3):
+  # same as periodic_gaussian_sums_2d, via bilinear binning on the torus and circular FFT convolution
+  # the grid points with an estimated round-off error above tol (relative) are recomputed exactly, tol=None disables this
+  w=np.atleast_2d(w)
+  grid_x=np.asarray(grid_x,dtype=np.float64)
+  grid_y=np.asarray(grid_y,dtype=np.float64)
+  fine_x=_periodic_fine(grid_x,sigma,period,oversample) if len(grid_x)>1 else None
+  fine_y=_periodic_fine(grid_y,sigma,period,oversample) if len(grid_y)>1 else None
+  if fine_x is None or fine_y is None:
+    return periodic_gaussian_sums_2d(x,y,w,grid_x,grid_y,sigma,period)
+  (n_x,step_x),(n_y,step_y)=fine_x,fine_y
+  dx=period/n_x
+  dy=period/n_y
+  pos_x=((x-grid_x[0])/dx)%n_x
+  pos_y=((y-grid_y[0])/dy)%n_y
+  left_x=np.floor(pos_x).astype(np.int64)
+  left_y=np.floor(pos_y).astype(np.int64)
+  frac_x=pos_x-left_x
+  frac_y=pos_y-left_y
+  left_x%=n_x
+  left_y%=n_y
+  right_x=(left_x+1)%n_x
+  right_y=(left_y+1)%n_y
+  corners=[(left_y*n_x+left_x,(1-frac_y)*(1-frac_x)),(left_y*n_x+right_x,(1-frac_y)*frac_x),
+           (right_y*n_x+left_x,frac_y*(1-frac_x)),(right_y*n_x+right_x,frac_y*frac_x)]
+
+  def kernel(n,d):
+    i=np.arange(n)
+    return np.exp(-0.5*(np.minimum(i,n-i)*d/sigma)**2)
+  fft_kernel=np.fft.rfft2(np.outer(kernel(n_y,dy),kernel(n_x,dx)))
+  norm_kernel=np.linalg.norm(kernel(n_y,dy))*np.linalg.norm(kernel(n_x,dx))
+  ix=(np.arange(len(grid_x))*step_x)%n_x
+  iy=(np.arange(len(grid_y))*step_y)%n_y
+  sums=np.zeros((len(w),len(grid_y),len(grid_x)))
+  error=np.zeros(len(w))
+  for t in range(len(w)):
+    hist=np.zeros(n_x*n_y)
+    for idx,frac in corners:
+      hist+=np.bincount(idx,weights=w[t]*frac,minlength=n_x*n_y)
+    conv=np.fft.irfft2(np.fft.rfft2(hist.reshape(n_y,n_x))*fft_kernel,s=(n_y,n_x))
+    sums[t]=np.maximum(conv[np.ix_(iy,ix)],0) #FFT round-off
+    error[t]=np.finfo(np.float64).eps*np.log2(n_x*n_y)*np.linalg.norm(hist)*norm_kernel
+  if tol is not None:
+    t,r,c=np.nonzero(error[:,np.newaxis,np.newaxis]>tol*sums)
+    if len(t)>0:
+      #exact on the smallest subgrid with all of them, the kernels are shared by the weights
+      rows,r=np.unique(r,return_inverse=True)
+      cols,c=np.unique(c,return_inverse=True)
+      ts,t=np.unique(t,return_inverse=True)
+      sums[ts[t],rows[r],cols[c]]=periodic_gaussian_sums_2d(x,y,w[ts],grid_x[cols],grid_y[rows],sigma,period)[t,r,c]
+  return sums
@@ -0,0 +1,108 @@
+# Langevin dynamics of many independent walkers at once, on the polynomial potential of ves_md_linearexpansion
+#
+# The potential is a linear expansion in BF_POWERS, U(x)=sum_k c_k prod_d x_d^i_kd, with the coefficients
+# of an md_potential.dat file. Positions have shape (nwalkers,dim) and each step is a few array operations,
+# so that many walkers cost about as much as a single one. Unit masses, as in ves_md_linearexpansion.
+# The Langevin integrator is velocity Verlet between two half steps of the Bussi-Parrinello thermostat,
+#   v=c1*v+c2*R, with c1=exp(-friction*tstep/2) and c2=sqrt((1-c1^2)*kbt)
+# and the overdamped one is Euler-Maruyama, x+=tstep/friction*F+sqrt(2*kbt*tstep/friction)*R.
+# The polynomial is used also outside the interval of the basis functions, where it is usually steep enough.
+
+import numpy as np
+
+def read_input(filename):
+  # keywords of an md_input.dat file, as a dict of strings
+  keys={}
+  with open(filename) as f:
+    for line in f:
+      words=line.split('#')[0].split(None,1)
+      if len(words)==2:
+        keys[words[0]]=words[1].strip()
+  return keys
+
+def read_positions(value,dim):
+  # the initial_position of md_input.dat, one comma separated position per walker
+  return np.array([[float(x) for x in w.split(',')] for w in value.split()]).reshape(-1,dim)
+
+class Potential:
+  # from the columns idx_dim1 ... idx_dimN pot.coeffs of md_potential.dat
+  # the coefficients are stored as a dense tensor, indexed by the power of each dimension, so that the energy
+  # and all the force components are a few matrix products with the powers of the positions
+  def __init__(self,filename):
+    with open(filename) as f:
+      fields=[line.split()[2:] for line in f if line.startswith('#! FIELDS')][0]
+    self.dim=len([f for f in fields if f.startswith('idx_dim')])
+    data=np.loadtxt(filename,comments='#',usecols=range(self.dim+1),ndmin=2)
+    self.powers=data[:,:self.dim].astype(int)
+    self.coeffs=data[:,self.dim]
+    self.order=np.amax(self.powers)
+    k=self.order+1
+    self.tensor=np.zeros((k,)*self.dim)
+    np.add.at(self.tensor,tuple(self.powers.T),self.coeffs)
+    #minus the derivative along each dimension, as a last axis
+    self.force_tensor=np.zeros((k,)*self.dim+(self.dim,))
+    for d in range(self.dim):
+      dT=np.moveaxis(self.tensor,d,0)[1:]*np.arange(1,k).reshape((-1,)+(1,)*(self.dim-1))
+      np.moveaxis(self.force_tensor[...,d],d,0)[:-1]=-dT
+
+  def _contract(self,tensor,x):
+    # sum over all the powers of tensor*prod_d x_d^i_d, keeping the trailing axes of tensor
+    n=len(x)
+    k=self.order+1
+    P=np.ones(x.shape+(k,))
+    P[...,1:]=x[...,np.newaxis]
+    np.cumprod(P,axis=-1,out=P) #x^i, faster than a power
+    res=P[:,0]@tensor.reshape(k,-1)
+    for d in range(1,self.dim):
+      res=np.einsum('nij,ni->nj',res.reshape(n,k,-1),P[:,d])
+    return res
+
+  def energy(self,x):
+    return self._contract(self.tensor,x)[:,0]
+
+  def forces(self,x):
+    # minus the gradient, shape (n,dim)
+    return self._contract(self.force_tensor,x)
+
+class Langevin:
+  # integrates all the walkers, force(x) gives the total forces, shape (nwalkers,dim)
+  # rng is a numpy Generator, or a list with one Generator for each walker, e.g. from its own seed
+  def __init__(self,x,force,tstep,kbt,friction,rng,overdamped=False):
+    self.x=np.array(x,dtype=np.float64)
+    self.force=force
+    self.tstep=tstep
+    self.kbt=kbt
+    self.friction=friction
+    self.rng=rng
+    self.overdamped=overdamped
+    self.batch=max(1,2**20//self.x.size) #steps of noise drawn at once
+    self.c1=np.exp(-0.5*friction*tstep)
+    self.c2=np.sqrt((1-self.c1**2)*kbt)
+    self.v=np.sqrt(kbt)*self._normal(())
+    self.f=force(self.x)
+
+  def _normal(self,shape):
+    # standard normal numbers of the given shape for each walker, shape+(nwalkers,dim)
+    if isinstance(self.rng,np.random.Generator):
+      return self.rng.standard_normal(shape+self.x.shape)
+    return np.stack([r.standard_normal(shape+self.x.shape[1:]) for r in self.rng],axis=-2)
+
+  def run(self,nsteps):
+    # the noise is drawn for many steps at once, in the same order as step by step
+    dt=self.tstep
+    for first in range(0,nsteps,self.batch):
+      n=min(self.batch,nsteps-first)
+      if self.overdamped:
+        noise=np.sqrt(2*self.kbt*dt/self.friction)*self._normal((n,))
+        for R in noise:
+          self.x+=dt/self.friction*self.f+R
+          self.f=self.force(self.x)
+        continue
+      noise=self.c2*self._normal((n,2))
+      for R in noise:
+        self.v=self.c1*self.v+R[0]
+        self.v+=0.5*dt*self.f
+        self.x+=dt*self.v
+        self.f=self.force(self.x)
+        self.v+=0.5*dt*self.f
+        self.v=self.c1*self.v+R[1]
@@ -0,0 +1,249 @@
+# Multistate (MBAR-style) estimate of the deltaF of all the OPES_EXPANDED states, jointly from many replicas and walkers
+#
+# Each row of a Colvar file was sampled with the bias of its time, V_n(x)=-log(sum_i exp(a_ni-u_i(x))/nstates),
+# with u_i the ECVs of the states (in kBT units) and a_n the deltaF before its update, which is known exactly
+# from the replay of the bias column (see expanded.Replay.deltaFs). So row n comes from a known mixture of the states,
+# with weights exp(a_ni-f_i)/zeta_n, where f_i=-log<exp(-u_i)> are the unknown free energies and zeta_n=sum_i exp(a_ni-f_i).
+# As in MBAR with a sampled state for each row, the unbiased weight of row n is 1/D_n, with
+#   D_n=sum_m exp(-V_m(x_n))/zeta_m=sum_i c_i*exp(-u_ni), c_i=sum_m exp(a_mi)/zeta_m
+# and f is a stationary point of the MBAR objective, as a function of f:
+#   F(f)=sum_n log(D_n)+sum_n log(zeta_n), gradient_i=sum_n pi_ni*(zeta'_n/zeta_n-1)
+# where pi_ni=exp(a_ni-f_i)/zeta_n, and zeta' is zeta with the new estimate f'_i=-log(sum_n exp(-u_ni)/D_n).
+# There f'=f, i.e. the self-consistent MBAR equations. The rows of all the replicas (each with its own bias)
+# and walkers (sharing one) enter the same sums. For a converged OPES_EXPANDED a_n=f, and this is the plain MBAR
+# of an expanded ensemble with the same number of samples for each state.
+# F is convex only close to the solution, so the equations are solved with Newton steps, with the exact Hessian
+#   H=diag(sum_n (1-R_n)*pi_n)+sum_n (2*R_n-1)*pi_n*pi_n^T-J^T*Q*J
+# with R_n=zeta'_n/zeta_n, Q=sum_n rho_n*rho_n^T, rho_ni=c_i*exp(-u_ni)/D_n, J_ij=sum_n exp(a_ni)/(zeta_n*c_i)*pi_nj,
+# falling back to the self-consistent step f=f' when needed. The Hessian costs O(nstates**2) per row, so with more than
+# newton_states states (e.g. the temperatures and pressures of chignolin) the self-consistent steps are used instead,
+# with Anderson acceleration, i.e. f+r minus the combination of the previous steps that best cancels the residual r=f'-f.
+# Each evaluation is two passes, or three with the Hessian, over chunks of at most max_size values: pi_n and rho_n
+# are normalized in each row after a max shift, so that the sums over the rows are plain sums and (nstates,nstates)
+# matrix products, only needed with the Hessian. u_n is recomputed at each pass, and a_n too, since it needs the replay,
+# unless all of them fit in cache_size.
+# The result is relative to the unbiased ensemble (u=0), as the deltaF of OPES_EXPANDED.
+# The first update of each replica, sampled without bias, is left out.
+
+import copy
+import numpy as np
+
+from opes_analysis import expanded
+from opes_analysis import reweight
+from opes_analysis import profiling
+from opes_analysis.reweight import LogSumExp
+
+cache_size=2**25 #max number of values of a kept in memory between the passes
+newton_states=100 #max number of states for the Newton iterations
+anderson_memory=10 #previous steps used by the Anderson acceleration
+
+class Multistate:
+  # the rows of any number of replicas of an OPES_EXPANDED simulation, with the states of expansion
+  def __init__(self,expansion):
+    self.expansion=expansion
+    self.nstates=expansion.nstates
+    self.chunks=[] #(replica,replay at the start of the chunk,time,bias,columns,first row used)
+    self.deltaF=[] #replayed deltaF at the end of each replica
+    self.nrows=[] #rows used of each replica
+    self.log_sum_bias=[] #log(sum(exp(bias))) over the rows used of each replica
+    self.iterations=0
+    self.evaluations=0
+    self.passes=0
+    self._cache=None
+
+  def add(self,time,bias,columns,skip=0):
+    # a replica with its own bias, its walkers are the rows with the same time
+    # bias in kBT units, columns is a dict with the arrays of the ECV args, the first skip rows are only replayed
+    nwalkers=int(np.searchsorted(time,time[0],side='right'))
+    if nwalkers==len(time):
+      raise ValueError('a replica needs at least two updates')
+    replica=len(self.deltaF)
+    replay=expanded.Replay(self.nstates,print_stride=len(time))
+    replay.start(time[0],self.expansion({a:c[:1] for a,c in columns.items()})[0],nwalkers)
+    starts=np.flatnonzero(np.r_[True,time[1:]!=time[:-1]])
+    size=max(1,reweight.max_size//self.nstates)
+    acc=LogSumExp((1,))
+    begin=nwalkers
+    while begin<len(time):
+      #chunks of complete updates
+      end=starts[np.searchsorted(starts,begin+size,side='right')-1] if begin+size<len(time) else len(time)
+      if end<=begin:
+        end=starts[np.searchsorted(starts,begin,side='right')] if starts[-1]>begin else len(time)
+      cols={a:c[begin:end] for a,c in columns.items()}
+      state=copy.copy(replay)
+      replay.add(time[begin:end],bias[begin:end],self.expansion(cols))
+      first=max(0,skip-begin)
+      if first<end-begin:
+        self.chunks.append((replica,state,time[begin:end],bias[begin:end],cols,first))
+        acc.add(np.asarray(bias[np.newaxis,begin+first:end],dtype=np.float64))
+      begin=end
+    self.deltaF.append(replay.deltaF())
+    self.nrows.append(max(0,len(time)-max(skip,nwalkers)))
+    self.log_sum_bias.append(float(acc.result()[0]))
+    self._cache=None
+
+  def rct(self,replicas=None):
+    # log of the average exp(bias) over the rows used, as the rct of OPES_EXPANDED
+    replicas=range(len(self.deltaF)) if replicas is None else replicas
+    return np.logaddexp.reduce([self.log_sum_bias[r] for r in replicas])-np.log(sum(self.nrows[r] for r in replicas))
+
+  def _values(self,replicas=None):
+    # a and u of the rows used, chunk by chunk
+    if self._cache is None and len(self.chunks)>0 and sum(self.nrows)*self.nstates<=cache_size:
+      self._cache=[state.deltaFs(time,self.expansion(cols),bias)[first:] for replica,state,time,bias,cols,first in self.chunks]
+    for k,(replica,state,time,bias,cols,first) in enumerate(self.chunks):
+      if replicas is not None and replica not in replicas:
+        continue
+      u=self.expansion(cols)
+      if self._cache is not None:
+        yield self._cache[k],u[first:]
+      else:
+        yield state.deltaFs(time,u,bias)[first:],u[first:]
+
+  def _pi(self,a,f):
+    # pi_n, the weights of the states in the mixture sampled by each row
+    pi=a-f
+    pi-=np.amax(pi,axis=1,keepdims=True)
+    np.exp(pi,out=pi)
+    pi/=np.sum(pi,axis=1,keepdims=True)
+    return pi
+
+  def _rho(self,u,log_c):
+    # rho_n and log(D_n)
+    rho=log_c-u
+    m=np.amax(rho,axis=1,keepdims=True)
+    rho-=m
+    np.exp(rho,out=rho)
+    D=np.sum(rho,axis=1,keepdims=True)
+    rho/=D
+    return rho,np.log(D[:,0])+m[:,0]
+
+  def _log_c(self,f,replicas=None,second=False):
+    # log(c)=f+log(sum_n pi_n), and optionally sum_n pi_n*pi_n^T, in a pass over a
+    s=np.zeros(self.nstates)
+    second_moment=np.zeros((self.nstates,self.nstates))
+    for a,u in self._values(replicas):
+      pi=self._pi(a,f)
+      s+=np.sum(pi,axis=0)
+      if second:
+        second_moment+=pi.T@pi
+    with np.errstate(divide='ignore'):
+      log_c=f+np.log(s)
+    return (log_c,second_moment) if second else log_c
+
+  @profiling.kernel('multistate')
+  def evaluate(self,f,replicas=None,hessian=True):
+    # gradient and Hessian of F, and the new estimate f' relative to the unbiased ensemble
+    # with hessian=False only f', with gradient and Hessian None
+    # with Pi=sum_n pi_n*pi_n^T, v=exp(f-f') (in the same gauge as f), R_n=pi_n.v and the Hessian terms
+    #   diag(sum_n (1-R_n)*pi_n)=-diag(gradient), J=diag(exp(f-log(c)))*Pi
+    f=np.asarray(f,dtype=np.float64)
+    self.evaluations+=1
+    self.passes+=3 if hessian else 2
+    if hessian:
+      log_c,Pi=self._log_c(f,replicas,second=True)
+    else:
+      log_c=self._log_c(f,replicas)
+    rho_sum=np.zeros(self.nstates)
+    Q=np.zeros((self.nstates,self.nstates))
+    acc=LogSumExp((1,1)) #sum_n 1/D_n, of the unbiased ensemble
+    for a,u in self._values(replicas):
+      rho,log_D=self._rho(u,log_c)
+      rho_sum+=np.sum(rho,axis=0)
+      if hessian:
+        Q+=rho.T@rho
+      acc.add(-log_D[np.newaxis])
+    with np.errstate(divide='ignore'):
+      log_Z=np.log(rho_sum)-log_c
+    new_f=-(log_Z-acc.result()[0,0])
+    if not hessian:
+      return None,None,new_f
+    v=np.exp(f+log_Z)
+    grad=np.zeros(self.nstates)
+    P=-Pi
+    for a,u in self._values(replicas):
+      pi=self._pi(a,f)
+      ratio=pi@v
+      grad+=pi.T@(ratio-1)
+      P+=(2*ratio[:,np.newaxis]*pi).T@pi
+    J=np.exp(f-log_c)[:,np.newaxis]*Pi
+    return grad,P-np.diag(grad)-J.T@Q@J,new_f
+
+  def solve(self,f0=None,replicas=None,tol=1e-8,max_iter=100):
+    # Newton iterations from f0 (e.g. from the DeltaFs files) or from the replayed deltaF, with the self-consistent
+    # step f=f' when a Newton step does not reduce the residual max|f'-f| (apart from a constant)
+    # above newton_states states Anderson-accelerated self-consistent steps
+    # stops when the residual is below tol (in kBT), and returns f'
+    if f0 is None:
+      f0=np.mean([self.deltaF[r] for r in (range(len(self.deltaF)) if replicas is None else replicas)],axis=0)
+    f=np.array(f0,dtype=np.float64)
+    self.iterations=0
+    if self.nstates>newton_states:
+      return self._anderson(f,replicas,tol,max_iter)
+    def residual(new_f,f):
+      step=new_f-f
+      return np.amax(np.abs(step-np.mean(step)))
+    grad,hessian,new_f=self.evaluate(f,replicas)
+    res=residual(new_f,f)
+    while res>=tol:
+      if self.iterations==max_iter:
+        print(' +++ WARNING multistate solver not converged after %d iterations, residual %g +++'%(max_iter,res))
+        break
+      self.iterations+=1
+      #the Hessian is singular along a constant shift of f, the min-norm solution has no such component
+      d=np.linalg.lstsq(hessian,-grad,rcond=None)[0]
+      trial=f+d
+      grad_t,hessian_t,new_f_t=self.evaluate(trial,replicas)
+      res_t=residual(new_f_t,trial)
+      if not res_t<res:
+        trial=new_f
+        grad_t,hessian_t,new_f_t=self.evaluate(trial,replicas)
+        res_t=residual(new_f_t,trial)
+      f,grad,hessian,new_f,res=trial,grad_t,hessian_t,new_f_t,res_t
+    return new_f
+
+  def _anderson(self,f,replicas,tol,max_iter):
+    # self-consistent steps f+r, with r=f'-f without its mean, corrected with the last anderson_memory steps
+    # the history is dropped when the residual grows
+    X,R=[],[]
+    prev=np.inf
+    while True:
+      new_f=self.evaluate(f,replicas,hessian=False)[2]
+      r=new_f-f
+      r-=np.mean(r)
+      res=np.amax(np.abs(r))
+      if res<tol:
+        return new_f
+      if self.iterations==max_iter:
+        print(' +++ WARNING multistate solver not converged after %d iterations, residual %g +++'%(max_iter,res))
+        return new_f
+      self.iterations+=1
+      if res>prev:
+        X,R=[],[]
+      prev=res
+      X.append(f)
+      R.append(r)
+      X,R=X[-anderson_memory-1:],R[-anderson_memory-1:]
+      f=f+r
+      if len(R)>1:
+        dX=np.diff(X,axis=0).T
+        dR=np.diff(R,axis=0).T
+        gamma=np.linalg.lstsq(dR,r,rcond=None)[0]
+        f-=(dX+dR)@gamma
+
+  def neff(self,deltaF,replicas=None):
+    # Kish effective sample size of each state, sum(w)**2/sum(w**2) with w_ni=exp(-u_ni)/D_n=rho_ni/c_i
+    log_c=self._log_c(np.asarray(deltaF,dtype=np.float64),replicas)
+    s=np.zeros((2,self.nstates))
+    for a,u in self._values(replicas):
+      rho=self._rho(u,log_c)[0]
+      s+=[np.sum(rho,axis=0),np.sum(rho**2,axis=0)]
+    return s[0]**2/s[1]
+
+  def jackknife(self,deltaF,**kwargs):
+    # error of deltaF from the estimates leaving out one replica at a time, each starting from deltaF
+    nreplicas=len(self.deltaF)
+    if nreplicas<2:
+      raise ValueError('the jackknife needs at least two replicas')
+    est=np.array([self.solve(deltaF,[r for r in range(nreplicas) if r!=k],**kwargs) for k in range(nreplicas)])
+    return np.sqrt((nreplicas-1)/nreplicas*np.sum((est-np.mean(est,axis=0))**2,axis=0))
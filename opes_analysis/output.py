@@ -0,0 +1,84 @@
+# Output of results on a grid, and rate-limited progress lines
+#
+# write_grid takes whole 2D arrays, one per column, and writes them with a single formatting pass
+# in the gnuplot blocked layout (a blank line after each row of the grid), 1D arrays are written as plain columns.
+# The same arrays can also be saved as compressed .npz or HDF5 (if h5py is available),
+# together with the column names and the run metadata, e.g. temp, pres, N, tran, blocks_neff.
+
+import io
+import os
+import sys
+import json
+import time
+import numpy as np
+
+from opes_analysis import backup
+from opes_analysis import profiling
+
+try:
+  import h5py
+except ImportError:
+  h5py=None
+
+formats=('text','npz','hdf5')
+
+def parse_formats(arg):
+  # comma separated list of formats, as given on the command line
+  fmts=[f.strip() for f in arg.split(',') if f.strip()]
+  for f in fmts:
+    if f not in formats:
+      sys.exit(' unknown output format "%s", choose among: %s'%(f,', '.join(formats)))
+  if 'hdf5' in fmts and h5py is None:
+    sys.exit(' hdf5 output needs the h5py module')
+  return fmts
+
+def blocked_text(columns,fmt='%.12g'):
+  # text of the columns, with a blank line after every row of the grid
+  # fmt is a single format or one per column, as in np.savetxt
+  columns=[np.asarray(c) for c in columns]
+  buf=io.StringIO()
+  np.savetxt(buf,np.column_stack([np.ravel(c) for c in columns]),fmt=fmt)
+  if columns[0].ndim<2:
+    return buf.getvalue()
+  lines=buf.getvalue().splitlines(keepends=True)
+  nrows=len(columns[0])
+  size=len(lines)//nrows if nrows>0 else 0
+  return ''.join(''.join(lines[i*size:(i+1)*size])+'\n' for i in range(nrows))
+
+@profiling.kernel('write_grid')
+def write_grid(filename,names,columns,comment='',metadata=None,fmts=('text',),fmt='%.12g'):
+  # writes the arrays in columns, all of the same shape, in each of the given formats
+  # text goes to filename, the others replace its extension with .npz or .h5
+  metadata=dict(metadata or {})
+  base=os.path.splitext(filename)[0]
+  if 'text' in fmts:
+    backup.backup(filename)
+    with open(filename,'w') as f:
+      f.write('#'+'  '.join(names)+('  '+comment if comment else '')+'\n')
+      f.write(blocked_text(columns,fmt))
+  if 'npz' in fmts:
+    backup.backup(base+'.npz')
+    arrays={name:np.asarray(c) for name,c in zip(names,columns)}
+    np.savez_compressed(base+'.npz',**arrays,metadata=json.dumps(metadata,default=lambda x:x.item()),comment=comment)
+  if 'hdf5' in fmts:
+    backup.backup(base+'.h5')
+    with h5py.File(base+'.h5','w') as f:
+      for name,c in zip(names,columns):
+        f.create_dataset(name,data=np.asarray(c),compression='gzip')
+      for key,value in metadata.items():
+        f.attrs[key]=value
+      f.attrs['comment']=comment
+
+class Progress:
+  # prints '    working... xx%' at most every interval seconds
+  def __init__(self,total,interval=0.5,file=sys.stdout):
+    self.total=max(1,total)
+    self.interval=interval
+    self.file=file
+    self.last=-np.inf
+
+  def update(self,done):
+    now=time.monotonic()
+    if now-self.last>=self.interval:
+      self.last=now
+      print('    working... {:.0%}'.format(done/self.total),end='\r',file=self.file)
@@ -0,0 +1,130 @@
+# Opt-in instrumentation of the analysis scripts: wall time, CPU time, peak RSS and rows per second of each stage
+#
+# Set OPES_PROFILE=1 to print a report at the end of a run, or OPES_PROFILE=report.json to also save it as JSON.
+# Scripts split their run with mark('load'), mark('reweight'), ..., mark('output'), each mark ending the previous stage,
+# and the library kernels (read_columns, LogSumExp, KDE, output) are timed on their own, whatever stage calls them,
+# with inclusive times, e.g. read_columns includes the parsing of convert.
+# Set OPES_PROFILE_SAMPLE to an interval in ms to also sample the stack on CPU time (SIGPROF): each sample is counted
+# for the innermost opes_analysis function, i.e. the kernel line being executed, or for the script line otherwise.
+# When not enabled, mark() and the kernel timers only check a flag.
+
+import os
+import sys
+import time
+import json
+import atexit
+import signal
+import resource
+import functools
+
+enabled=os.environ.get('OPES_PROFILE','0') not in ('','0')
+package_dir=os.path.dirname(os.path.realpath(__file__))
+
+_pid=os.getpid()
+_rows=None
+_stages=[] #[name,wall,cpu,peak_rss] of the closed stages
+_current=None #(name,wall,cpu) of the running stage
+_kernels={} #name: [calls,wall,cpu]
+_active=set() #kernels running, a kernel calling itself is counted once
+_samples={}
+_start=(time.perf_counter(),time.process_time())
+
+def _peak_rss():
+  # peak resident memory of the process so far, in MB
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+
+def rows(n):
+  # number of rows processed, for the rows per second
+  global _rows
+  _rows=n
+
+def mark(name):
+  # end the running stage and start a new one
+  global _current
+  if not enabled:
+    return
+  now=(time.perf_counter(),time.process_time())
+  if _current is not None:
+    _stages.append([_current[0],now[0]-_current[1],now[1]-_current[2],_peak_rss()])
+  _current=(name,now[0],now[1])
+
+def kernel(name):
+  # decorator timing a library function, under the given name
+  def wrap(func):
+    @functools.wraps(func)
+    def timed(*args,**kwargs):
+      if not enabled or name in _active:
+        return func(*args,**kwargs)
+      _active.add(name)
+      wall,cpu=time.perf_counter(),time.process_time()
+      try:
+        return func(*args,**kwargs)
+      finally:
+        _active.discard(name)
+        k=_kernels.setdefault(name,[0,0.,0.])
+        k[0]+=1
+        k[1]+=time.perf_counter()-wall
+        k[2]+=time.process_time()-cpu
+    return timed
+  return wrap
+
+def _sample(signum,frame):
+  where=None
+  f=frame
+  while f is not None:
+    if os.path.dirname(os.path.realpath(f.f_code.co_filename))==package_dir and f.f_code.co_filename!=__file__:
+      where=f
+      break
+    f=f.f_back
+  where=where or frame
+  key='%s:%s:%d'%(os.path.basename(where.f_code.co_filename),where.f_code.co_name,where.f_lineno)
+  stage=_current[0] if _current is not None else ''
+  _samples[(stage,key)]=_samples.get((stage,key),0)+1
+
+def report():
+  # the results so far, as a dict
+  mark(None)
+  wall,cpu=time.perf_counter()-_start[0],time.process_time()-_start[1]
+  def rate(t):
+    return _rows/t if _rows and t>0 else None
+  stages=[{'stage':s[0],'wall':s[1],'cpu':s[2],'peak_rss_mb':s[3],'rows_per_s':rate(s[1]) if s[0]!='start' else None} for s in _stages]
+  kernels=[{'kernel':k,'calls':v[0],'wall':v[1],'cpu':v[2],'rows_per_s':rate(v[1])} for k,v in sorted(_kernels.items(),key=lambda kv:-kv[1][1])]
+  nsamples=sum(_samples.values())
+  samples=[{'stage':s,'where':w,'count':c,'fraction':c/nsamples} for (s,w),c in sorted(_samples.items(),key=lambda kv:-kv[1])]
+  return {'script':' '.join(sys.argv),'rows':_rows,'wall':wall,'cpu':cpu,'peak_rss_mb':_peak_rss(),'stages':stages,'kernels':kernels,'samples':samples}
+
+def _print(rep,file=sys.stderr):
+  print('#--- profile: %s'%rep['script'],file=file)
+  print('#  total: wall %.3fs  cpu %.3fs  peak RSS %.1f MB  rows %s'%(rep['wall'],rep['cpu'],rep['peak_rss_mb'],rep['rows']),file=file)
+  print('#  %-22s %10s %10s %12s %12s'%('stage','wall(s)','cpu(s)','peak_RSS(MB)','rows/s'),file=file)
+  for s in rep['stages']:
+    print('#  %-22s %10.4f %10.4f %12.1f %12s'%(s['stage'],s['wall'],s['cpu'],s['peak_rss_mb'],'%.4g'%s['rows_per_s'] if s['rows_per_s'] else '-'),file=file)
+  print('#  %-22s %10s %10s %12s'%('kernel','wall(s)','cpu(s)','calls'),file=file)
+  for k in rep['kernels']:
+    print('#  %-22s %10.4f %10.4f %12d'%(k['kernel'],k['wall'],k['cpu'],k['calls']),file=file)
+  if rep['samples']:
+    print('#  %-22s %-40s %8s'%('stage','sampled line','fraction'),file=file)
+    for s in rep['samples'][:20]:
+      print('#  %-22s %-40s %8.3f'%(s['stage'],s['where'],s['fraction']),file=file)
+
+def _at_exit():
+  if os.getpid()!=_pid:
+    return
+  if sampling:
+    signal.setitimer(signal.ITIMER_PROF,0)
+  rep=report()
+  _print(rep)
+  target=os.environ.get('OPES_PROFILE')
+  if target!='1':
+    with open(target,'w') as f:
+      json.dump(rep,f,indent=1)
+
+sampling=False
+if enabled:
+  mark('start')
+  atexit.register(_at_exit)
+  interval=float(os.environ.get('OPES_PROFILE_SAMPLE','0'))
+  if interval>0:
+    sampling=True
+    signal.signal(signal.SIGPROF,_sample)
+    signal.setitimer(signal.ITIMER_PROF,interval/1000,interval/1000)
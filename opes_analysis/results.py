@@ -0,0 +1,153 @@
+# Persistent cache of analysis results, so that repeated runs do not start from zero
+#
+# Results are stored in .opes_results/ next to the Colvar file, keyed by the content fingerprint of the file
+# (the same of the colvar cache) and by the analysis parameters, e.g. columns, tran, temp, pres, sigma, blocks.
+# Per-point results, such as the log partition sums at each (rew_beta,rew_pres), are stored point by point,
+# so that an overlapping grid computes only the missing points. Points are matched up to a relative 2**-40.
+# Whole results, such as the block sums of a KDE grid, are stored as they are.
+# The least recently used entries are removed when the total size exceeds OPES_RESULT_CACHE_SIZE (in MB, default 512).
+# Set OPES_RESULT_CACHE=0 to always recompute.
+
+import os
+import sys
+import json
+import hashlib
+import numpy as np
+
+from opes_analysis import colvar
+
+cache_dir_name='.opes_results'
+
+def cache_enabled():
+  return os.environ.get('OPES_RESULT_CACHE','1')!='0'
+
+def max_size():
+  return float(os.environ.get('OPES_RESULT_CACHE_SIZE','512'))*2**20
+
+def _round(x):
+  m,e=np.frexp(np.asarray(x,dtype=np.float64))
+  return np.ldexp(np.round(m*2**40)/2**40,e)
+
+class ResultCache:
+  # filename is the Colvar file the results come from, params are those shared by all its results
+  def __init__(self,filename,enabled=True,**params):
+    self.enabled=enabled and cache_enabled()
+    self.params=params
+    self.hits=0
+    self.misses=0
+    if self.enabled:
+      try:
+        self.fingerprint=colvar.fingerprint(filename)
+        self.dir=os.path.join(os.path.dirname(os.path.abspath(filename)),cache_dir_name)
+        os.makedirs(self.dir,exist_ok=True)
+      except OSError as err:
+        print(' +++ WARNING cannot use result cache: %s'%err,file=sys.stderr)
+        self.enabled=False
+
+  def _path(self,kind,params):
+    key=json.dumps([self.fingerprint,kind,self.params,params],sort_keys=True,default=str)
+    return os.path.join(self.dir,kind+'.'+hashlib.blake2b(key.encode(),digest_size=16).hexdigest()+'.npz')
+
+  def _load(self,path):
+    try:
+      with np.load(path) as f:
+        data={k:f[k] for k in f.files}
+      os.utime(path) #most recently used
+      return data
+    except (OSError,ValueError,KeyError):
+      return None
+
+  def _save(self,path,data):
+    tmp=path+'.tmp%d.npz'%os.getpid()
+    try:
+      np.savez(tmp,**data)
+      os.replace(tmp,path)
+    except OSError as err:
+      print(' +++ WARNING cannot write result cache: %s'%err,file=sys.stderr)
+      if os.path.exists(tmp):
+        os.remove(tmp)
+      return
+    self._evict(path)
+
+  def _evict(self,keep):
+    entries=[]
+    for name in os.listdir(self.dir):
+      path=os.path.join(self.dir,name)
+      try:
+        stat=os.stat(path)
+      except OSError:
+        continue
+      entries.append((stat.st_mtime,stat.st_size,path))
+    total=sum(e[1] for e in entries)
+    for mtime,size,path in sorted(entries):
+      if total<=max_size():
+        break
+      if path==keep:
+        continue
+      try:
+        os.remove(path)
+        total-=size
+      except OSError:
+        pass
+
+  def points(self,kind,targets,compute,**params):
+    # targets has shape (...,k), one k-tuple of parameters per point
+    # compute takes the missing targets, with shape (n,k), and returns their values, with shape (n,...)
+    targets=np.asarray(targets,dtype=np.float64)
+    shape=targets.shape[:-1]
+    flat=targets.reshape(-1,targets.shape[-1])
+    if not self.enabled:
+      values=compute(flat)
+      return values.reshape(shape+values.shape[1:])
+    path=self._path(kind,params)
+    keys=_round(flat)
+    stored=self._load(path)
+    if stored is None:
+      stored_keys=np.zeros((0,flat.shape[1]))
+      stored_values=None
+      pos=np.full(len(flat),-1)
+    else:
+      stored_keys=stored['keys']
+      stored_values=stored['values']
+      index={row.tobytes():i for i,row in enumerate(stored_keys)}
+      pos=np.array([index.get(row.tobytes(),-1) for row in keys],dtype=int)
+    missing=np.flatnonzero(pos<0)
+    self.hits+=len(flat)-len(missing)
+    self.misses+=len(missing)
+    if len(missing)>0:
+      new_keys,first,inverse=np.unique(keys[missing],axis=0,return_index=True,return_inverse=True)
+      new_values=np.asarray(compute(flat[missing[first]]))
+      pos[missing]=len(stored_keys)+np.ravel(inverse)
+      stored_keys=np.concatenate([stored_keys,new_keys])
+      stored_values=new_values if stored_values is None else np.concatenate([stored_values,new_values])
+      self._save(path,{'keys':stored_keys,'values':stored_values})
+    return stored_values[pos].reshape(shape+stored_values.shape[1:])
+
+  def get(self,kind,compute,**params):
+    # whole result, compute() returns a tuple of arrays
+    if not self.enabled:
+      return compute()
+    path=self._path(kind,params)
+    stored=self._load(path)
+    if stored is not None:
+      self.hits+=1
+      return tuple(stored['%d'%i] for i in range(len(stored)))
+    self.misses+=1
+    res=compute()
+    self._save(path,{'%d'%i:np.asarray(r) for i,r in enumerate(res)})
+    return res
+
+  def log_sums(self,rw,rew_beta,rew_pres,powers=(1,),**params):
+    # same as rw._reduce, i.e. log(sum(w**power)) for each power, target and label, for a Reweighter rw
+    rew_beta,rew_pres=np.broadcast_arrays(np.asarray(rew_beta,dtype=np.float64),np.asarray(rew_pres,dtype=np.float64))
+    def compute(x):
+      res=rw._reduce(x[:,0],x[:,1],powers)
+      return np.stack([r.T if rw.nlabels>0 else r[:,np.newaxis] for r in res],axis=1)
+    params.update(beta=rw.beta,pres=rw.pres,nlabels=rw.nlabels,size=rw.size,dtype=str(rw.ene.dtype),powers=list(powers))
+    values=self.points('log_sums',np.stack([rew_beta,rew_pres],axis=-1),compute,**params)
+    values=np.moveaxis(values,-1,0)
+    return [values[:,...,i] if rw.nlabels>0 else values[0,...,i] for i in range(len(powers))]
+
+  def report(self):
+    if self.enabled and self.hits>0:
+      print('  result cache: %d reused, %d computed'%(self.hits,self.misses))
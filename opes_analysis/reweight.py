@@ -0,0 +1,181 @@
+# Batched reweighting of multithermal-multibaric simulations
+#
+# The log-weight of a sample for the target (rew_beta,rew_pres) is linear in ene and vol:
+#   (beta-rew_beta)*ene+(beta*pres-rew_beta*rew_pres)*vol+beta*bias
+# so a whole batch of targets is a single outer product, evaluated in memory-bounded chunks
+# All sums are kept in log space with max-shifted log-sum-exp, so that float64 is enough,
+# while the bulk arrays can also be stored in float32 (computations are always at least float64)
+
+import sys
+import numpy as np
+
+from opes_analysis import profiling
+
+kB=0.0083144621 #kj/mol
+from_bar=0.06022140857
+
+max_size=2**22 #max number of log-weights held in memory at once
+
+class LogSumExp:
+  # running log(sum(exp(x))) over the last axis, with an accumulator for each group
+  def __init__(self,shape,dtype=np.float64):
+    self.max=np.full(shape,-np.inf,dtype=dtype)
+    self.sum=np.zeros(shape,dtype=dtype)
+
+  @profiling.kernel('logsumexp')
+  def add(self,x,starts=None,groups=None,rows=Ellipsis):
+    # x has shape (...,n), with samples already sorted by group
+    # starts are the indexes where each of the given groups begins
+    # rows optionally selects the leading accumulators to be updated
+    if starts is None:
+      starts=np.zeros(1,dtype=int)
+      groups=np.zeros(1,dtype=int)
+    if x.shape[-1]==0:
+      return
+    ends=np.append(starts[1:],x.shape[-1])
+    new_max=np.empty(x.shape[:-1]+(len(starts),),dtype=self.max.dtype)
+    new_sum=np.empty_like(new_max)
+    for g,(s,e) in enumerate(zip(starts,ends)):
+      m=np.amax(x[...,s:e],axis=-1,keepdims=True)
+      y=x[...,s:e]-m
+      np.exp(y,out=y)
+      new_max[...,g]=m[...,0]
+      new_sum[...,g]=np.sum(y,axis=-1)
+    idx=(rows,groups)
+    old_max=self.max[idx]
+    tot_max=np.maximum(old_max,new_max)
+    self.sum[idx]=self.sum[idx]*np.exp(old_max-tot_max)+new_sum*np.exp(new_max-tot_max)
+    self.max[idx]=tot_max
+
+  @profiling.kernel('logsumexp')
+  def add_unsorted(self,x,labels,rows=Ellipsis):
+    # same as add, for any integer labels of the samples, negative labels are discarded
+    keep=np.flatnonzero(labels>=0)
+    if len(keep)==0:
+      return
+    order=keep[np.argsort(labels[keep],kind='stable')]
+    lab=labels[order]
+    starts=np.flatnonzero(np.r_[True,lab[1:]!=lab[:-1]])
+    self.add(x[...,order],starts,lab[starts],rows)
+
+  @profiling.kernel('logsumexp')
+  def add_log(self,log_sums):
+    # merges sums already reduced in log space, with the same shape of the accumulators
+    tot_max=np.maximum(self.max,log_sums)
+    with np.errstate(invalid='ignore'):
+      self.sum=np.where(np.isfinite(tot_max),self.sum*np.exp(self.max-tot_max)+np.exp(log_sums-tot_max),self.sum)
+    self.max=tot_max
+
+  def result(self):
+    with np.errstate(divide='ignore'):
+      return np.log(self.sum)+self.max
+
+class Reweighter:
+  # holds the ene/vol/bias columns of a simulation run at (temp,pres)
+  # labels are optional non-negative integers (e.g. basins), samples with negative labels are discarded
+  # nlabels can be given to fix the number of labels, e.g. when working on chunks of a larger dataset
+  # vol can be None for multithermal-only runs
+  def __init__(self,ene,vol,bias,temp,pres=0,labels=None,nlabels=None):
+    self.beta=1/(kB*temp)
+    self.pres=pres
+    self.dtype=np.result_type(ene.dtype,np.float64)
+    if labels is None:
+      self.nlabels=0
+      self.ene=ene
+      self.vol=vol
+      self.bias=bias
+    else:
+      labels=np.asarray(labels).astype(int)
+      keep=np.flatnonzero(labels>=0)
+      order=keep[np.argsort(labels[keep],kind='stable')]
+      if nlabels is None:
+        nlabels=np.amax(labels)+1 if len(keep)>0 else 0
+      self.nlabels=nlabels
+      self.ene=ene[order]
+      self.vol=None if vol is None else vol[order]
+      self.bias=bias[order]
+      self.labels=labels[order]
+    self.size=len(self.ene)
+
+  def log_weights(self,rew_beta,rew_pres=0):
+    # full log-weights for a single target
+    log_w=(self.beta-rew_beta)*self.ene.astype(self.dtype,copy=False)+self.beta*self.bias.astype(self.dtype,copy=False)
+    if self.vol is not None:
+      log_w+=(self.beta*self.pres-rew_beta*rew_pres)*self.vol.astype(self.dtype,copy=False)
+    return log_w
+
+  def _chunk_groups(self,begin,end):
+    if self.nlabels==0:
+      return None,None
+    lab=self.labels[begin:end]
+    starts=np.flatnonzero(np.r_[True,lab[1:]!=lab[:-1]])
+    return starts,lab[starts]
+
+  @profiling.kernel('reweighter')
+  def _reduce(self,rew_beta,rew_pres,powers):
+    # one pass over the data, returns log(sum(w**power)) for each power, target and label
+    rew_beta,rew_pres=np.broadcast_arrays(np.asarray(rew_beta,dtype=self.dtype),np.asarray(rew_pres,dtype=self.dtype))
+    shape=rew_beta.shape
+    a=np.ravel(self.beta-rew_beta)
+    c=np.ravel(self.beta*self.pres-rew_beta*rew_pres)
+    npoints=len(a)
+    acc_shape=(npoints,max(1,self.nlabels))
+    accs=[LogSumExp(acc_shape,dtype=self.dtype) for p in powers]
+    batch=min(npoints,max_size)
+    chunk=max(1,max_size//batch)
+    for k in range(0,npoints,batch):
+      pts=slice(k,k+batch)
+      for n in range(0,self.size,chunk):
+        smp=slice(n,n+chunk)
+        log_w=np.multiply.outer(a[pts],self.ene[smp].astype(self.dtype,copy=False))
+        log_w+=self.beta*self.bias[smp].astype(self.dtype,copy=False)
+        if self.vol is not None:
+          log_w+=np.multiply.outer(c[pts],self.vol[smp].astype(self.dtype,copy=False))
+        starts,groups=self._chunk_groups(n,n+chunk)
+        for acc,p in zip(accs,powers):
+          acc.add(p*log_w if p!=1 else log_w,starts,groups,rows=pts)
+    results=[]
+    for acc in accs:
+      res=acc.result()
+      if self.nlabels==0:
+        results.append(res[:,0].reshape(shape))
+      else:
+        results.append(np.moveaxis(res,-1,0).reshape((self.nlabels,)+shape))
+    return results
+
+  def log_sums(self,rew_beta,rew_pres=0,power=1):
+    # log(sum(w**power)) over all samples (or for each label) for a batch of targets
+    return self._reduce(rew_beta,rew_pres,(power,))[0]
+
+  def neff(self,rew_beta,rew_pres=0):
+    # Kish effective sample size, sum(w)**2/sum(w**2), for a batch of targets
+    log_z,log_z2=self._reduce(rew_beta,rew_pres,(1,2))
+    if self.nlabels>0:
+      log_z=np.logaddexp.reduce(log_z,axis=0)
+      log_z2=np.logaddexp.reduce(log_z2,axis=0)
+    return np.exp(2*log_z-log_z2)
+
+@profiling.kernel('center')
+def center(x,dtype=None):
+  # subtract the mean, computed in double precision, optionally storing the result as dtype (e.g. np.float32)
+  x=x-np.mean(x,dtype=np.result_type(x.dtype,np.float64))
+  return x if dtype is None else x.astype(dtype)
+
+def validate(compute,dtype=np.float64,enabled=True):
+  # compute(dtype) must return the results, using dtype for the bulk arrays
+  # if enabled, the calculation is repeated in float128 and the largest deviations are printed
+  res=compute(dtype)
+  if not enabled:
+    return res
+  ref=profiling.kernel('validate_float128')(compute)(np.float128)
+  single=not isinstance(res,tuple)
+  for i,(r,f) in enumerate(zip((res,) if single else res,(ref,) if single else ref)):
+    r=np.asarray(r,dtype=np.float128)
+    f=np.asarray(f,dtype=np.float128)
+    ok=np.isfinite(f)
+    with np.errstate(divide='ignore',invalid='ignore'):
+      abs_dev=np.amax(np.abs(r-f)[ok]) if np.any(ok) else 0
+      rel_dev=np.amax((np.abs(r-f)/np.abs(f))[ok&(f!=0)]) if np.any(ok&(f!=0)) else 0
+    print('  validation of output %d against float128: max abs deviation %g, max rel deviation %g, non-finite mismatches %d'
+          %(i,abs_dev,rel_dev,np.sum(np.isfinite(r)!=ok)),file=sys.stderr)
+  return res
@@ -0,0 +1,381 @@
+# Many observables from a single load of a dataset
+#
+# A Session holds the centered ene/vol/bias columns of a dataset, with the integer labels of two states
+# (e.g. folded/unfolded basins or liquid/solid phases) and optionally a CV.
+# Jobs first declare what they need: all the jobs on the same (T,P) grid share a single pass over the data,
+# which gives the log-sums of the powers of the weights for each label at once, while other calculations
+# (e.g. block averages) are registered as separate tasks. The distinct tasks then run concurrently in a
+# process pool, forked after loading so that the data is not copied, and finally each job writes its outputs.
+# Jobs are given as command lines, e.g. 'neff --nbins 50', either as arguments or one per line in a file.
+
+import sys
+import copy
+import shlex
+import argparse
+import hashlib
+import multiprocessing
+import numpy as np
+
+from opes_analysis import blocks
+from opes_analysis import reweight
+from opes_analysis import profiling
+from opes_analysis import kde
+from opes_analysis import output
+from opes_analysis.reweight import Reweighter,LogSumExp,kB,from_bar
+
+_tasks=[]
+
+def _run(i):
+  return _tasks[i][1]()
+
+class Session:
+  # ene and vol are centered, their means are kept for the outputs that need the absolute values
+  def __init__(self,ene,vol,bias,temp,pres,labels,cv=None,tran=0,fmts=('text',),mean_ene=0,mean_vol=0):
+    self.ene=ene
+    self.vol=vol
+    self.mean_ene=mean_ene
+    self.mean_vol=mean_vol
+    self.bias=bias
+    self.temp=temp
+    self.pres=pres
+    self.beta=1/(kB*temp)
+    self.labels=np.asarray(labels).astype(int)
+    self.cv=cv
+    self.N=len(ene)
+    self.tran=tran
+    self.first=0 #rows dropped from the loaded ones
+    self.fmts=fmts
+    self.grids={}
+    self.results={}
+
+  def rows(self,skip):
+    # the same session without its first skip rows, sharing the requests and the results
+    if skip==0:
+      return self
+    view=copy.copy(self)
+    for name in ('ene','vol','bias','labels'):
+      setattr(view,name,getattr(self,name)[skip:])
+    if self.cv is not None:
+      view.cv=self.cv[skip:]
+    view.N=self.N-skip
+    view.first=self.first+skip
+    return view
+
+  def outfilename(self,name):
+    return 'tran'+str(self.tran)+'-'+name if self.tran else name
+
+  def grid(self,rew_beta,rew_pres,powers=(1,)):
+    # requests the log-sums for each label over a grid of targets, returns the key of the result
+    rew_beta,rew_pres=np.broadcast_arrays(np.asarray(rew_beta,dtype=np.float64),np.asarray(rew_pres,dtype=np.float64))
+    h=hashlib.blake2b(digest_size=16)
+    h.update(str(self.first).encode())
+    for a in (rew_beta,rew_pres):
+      h.update(str(a.shape).encode())
+      h.update(np.ascontiguousarray(a).tobytes())
+    key='grid-'+h.hexdigest()
+    if key not in self.grids:
+      self.grids[key]=[rew_beta,rew_pres,set(),self]
+    self.grids[key][2].update(powers)
+    return key
+
+  def task(self,key,compute):
+    # requests a generic calculation, compute() is run only once for each key
+    if all(k!=key for k,c in _tasks):
+      _tasks.append((key,compute))
+    return key
+
+  def _grid_task(self,key):
+    rew_beta,rew_pres,powers,view=self.grids[key]
+    powers=tuple(sorted(powers))
+    def compute():
+      rw=Reweighter(view.ene,view.vol,view.bias,view.temp,view.pres,labels=view.labels,nlabels=2)
+      return dict(zip(powers,rw._reduce(rew_beta,rew_pres,powers)))
+    return compute
+
+  def run(self,processes=None):
+    for key in self.grids:
+      self.task(key,self._grid_task(key))
+    todo=[i for i,(key,c) in enumerate(_tasks) if key not in self.results]
+    print('  running %d distinct calculations'%len(todo))
+    if processes is None:
+      processes=multiprocessing.cpu_count()
+    processes=min(processes,len(todo))
+    if processes>1 and 'fork' in multiprocessing.get_all_start_methods():
+      with multiprocessing.get_context('fork').Pool(processes) as pool:
+        res=pool.map(_run,todo,chunksize=1)
+    else:
+      res=[_run(i) for i in todo]
+    for i,r in zip(todo,res):
+      self.results[_tasks[i][0]]=r
+
+  def log_sums(self,key,power=1):
+    # log-sums for each label, shape (2,...)
+    return self.results[key][power]
+
+class Job:
+  # subclasses define name, the options of the command line and the methods setup (what is needed) and write
+  # skip drops the first rows of the session for this job only, as some scripts skip one more line after the transient
+  name=''
+  help=''
+  defaults={}
+  skip=0
+
+  def __init__(self,session,argv):
+    parser=argparse.ArgumentParser(prog=self.name,description=self.help)
+    self.options(parser)
+    parser.set_defaults(**self.defaults)
+    self.args=parser.parse_args(argv)
+    self.session=session.rows(self.skip)
+
+  def options(self,parser):
+    pass
+
+  def setup(self):
+    pass
+
+  def write(self):
+    pass
+
+def grid_options(parser):
+  parser.add_argument('--mintemp',dest='mintemp',type=float,required=False,help='the minimum temperature')
+  parser.add_argument('--maxtemp',dest='maxtemp',type=float,required=False,help='the maximum temperature')
+  parser.add_argument('--minpres',dest='minpres',type=float,required=False,help='the minimum pressure (bar)')
+  parser.add_argument('--maxpres',dest='maxpres',type=float,required=False,help='the maximum pressure (bar)')
+  parser.add_argument('--nbins',dest='nbins',type=int,required=False,help='number of bins')
+  parser.add_argument('-o',dest='outfilename',type=str,required=False,help='output file name')
+
+class TwoStateGrid(Job):
+  # free energy difference between the two states (and optionally the fraction of state 0) over a (T,P) grid
+  fraction=None #name of the fraction column, if any
+
+  def options(self,parser):
+    grid_options(parser)
+
+  def setup(self):
+    a=self.args
+    temp_range=np.linspace(a.mintemp,a.maxtemp,a.nbins)
+    pres_range=np.linspace(a.minpres*from_bar,a.maxpres*from_bar,a.nbins)
+    self.t,self.p=np.meshgrid(temp_range,pres_range)
+    self.key=self.session.grid(1/(kB*self.t),self.p)
+
+  def write(self):
+    s=self.session
+    log_Z=s.log_sums(self.key)
+    deltaG=-(log_Z[1]-log_Z[0])
+    N0=np.sum(s.labels==0)
+    metadata={'temp':s.temp,'pres':s.pres/from_bar,'N':s.N,'tran':s.tran}
+    if self.fraction:
+      names=['temp','pres',self.fraction,'deltaG']
+      columns=[self.t,self.p/from_bar,1/(1+np.exp(log_Z[1]-log_Z[0])),deltaG]
+      comment='# N_fold=%d N_unfold=%d'%(N0,s.N-N0)
+    else:
+      names=['temp','pres','deltaG']
+      columns=[self.t,self.p/from_bar,deltaG]
+      comment='#N=%d'%s.N
+    output.write_grid(s.outfilename(self.args.outfilename),names,columns,comment,metadata,s.fmts)
+
+class NeffGrid(Job):
+  # Kish effective sample size over a (T,P) grid, uniform in temperature or in beta
+  beta_grid=False
+
+  def options(self,parser):
+    grid_options(parser)
+
+  def setup(self):
+    a=self.args
+    if self.beta_grid:
+      temp_range=1/(kB*np.linspace(1/(kB*a.mintemp),1/(kB*a.maxtemp),a.nbins))
+    else:
+      temp_range=np.linspace(a.mintemp,a.maxtemp,a.nbins)
+    pres_range=np.linspace(a.minpres*from_bar,a.maxpres*from_bar,a.nbins)
+    self.t,self.p=np.meshgrid(temp_range,pres_range)
+    self.key=self.session.grid(1/(kB*self.t),self.p,powers=(1,2))
+
+  def write(self):
+    s=self.session
+    log_z=np.logaddexp.reduce(s.log_sums(self.key,1),axis=0)
+    log_z2=np.logaddexp.reduce(s.log_sums(self.key,2),axis=0)
+    neff=np.exp(2*log_z-log_z2)
+    metadata={'temp':s.temp,'pres':s.pres/from_bar,'N':s.N,'tran':s.tran}
+    output.write_grid(s.outfilename(self.args.outfilename),['beta','pres','Neff/N'],[self.t,self.p/from_bar,neff/s.N],'#N=%d'%s.N,metadata,s.fmts)
+
+class Histo2D(Job):
+  # histogram of the sampled energy and volume, not reweighted
+  def options(self,parser):
+    parser.add_argument('--nbins',dest='nbins',type=int,required=False,help='number of bins')
+    parser.add_argument('-o',dest='outfilename',type=str,required=False,help='output file name')
+
+  def write(self):
+    s=self.session
+    histo,xedges,yedges=np.histogram2d(s.ene+s.mean_ene,s.vol+s.mean_vol,self.args.nbins)
+    max_histo=np.max(histo)
+    histo/=max_histo
+    ene_mesh,vol_mesh=np.meshgrid((xedges[:-1]+xedges[1:])/2,(yedges[:-1]+yedges[1:])/2)
+    metadata={'N':s.N,'max_histo':max_histo,'tran':s.tran}
+    output.write_grid(s.outfilename(self.args.outfilename),['ene','vol','histo'],[ene_mesh,vol_mesh,histo.T],'#N=%d  max_histo=%d'%(s.N,max_histo),metadata,s.fmts)
+
+class TempBlocks(Job):
+  # fraction of state 0 as a function of temperature at fixed pressure, with block average uncertainty
+  def options(self,parser):
+    parser.add_argument('--blocks',dest='num_blocks',type=int,required=False,help='number of blocks, 0 to use the recommended one from --scan')
+    parser.add_argument('--scan',dest='scan',type=int,default=0,required=False,help='also print the error for any number of blocks from 2 up to this')
+    parser.add_argument('--mintemp',dest='mintemp',type=float,required=False,help='the minimum temperature')
+    parser.add_argument('--maxtemp',dest='maxtemp',type=float,required=False,help='the maximum temperature')
+    parser.add_argument('--rewpres',dest='rewpres',type=float,required=False,help='the reweighting pressure (bar)')
+    parser.add_argument('--nbins',dest='nbins',type=int,required=False,help='number of bins')
+    parser.add_argument('-o',dest='outfilename',type=str,required=False,help='output file name')
+
+  def setup(self):
+    a=self.args
+    s=self.session
+    if a.num_blocks<=0 and a.scan<2:
+      sys.exit(' %s: --blocks 0 requires --scan'%self.name)
+    self.temp_range=np.linspace(a.mintemp,a.maxtemp,a.nbins)
+    self.scan=blocks.BlockScan(s.N,[a.num_blocks]+list(range(2,a.scan+1)))
+    scan=self.scan
+    rew_beta=1/(kB*self.temp_range)
+    rew_pres=a.rewpres*from_bar
+    def compute():
+      groups=2*scan.labels(0,s.N)+s.labels
+      rw=Reweighter(s.ene,s.vol,s.bias,s.temp,s.pres,labels=groups,nlabels=2*scan.nsegments)
+      return rw.log_sums(rew_beta,rew_pres)
+    self.key=s.task(('temp_blocks',s.first,tuple(scan.bounds),a.mintemp,a.maxtemp,a.nbins,a.rewpres),compute)
+
+  def block_stats(self,num_blocks):
+    log_Z=self.session.results[self.key]
+    log_folded=self.scan.block_log_sums(log_Z[0::2].T,num_blocks)
+    log_block_w=np.logaddexp(log_folded,self.scan.block_log_sums(log_Z[1::2].T,num_blocks))
+    log_p=blocks.normalize(log_block_w)
+    fraction=np.exp(np.logaddexp.reduce(log_p+log_folded,axis=-1)-np.logaddexp.reduce(log_p+log_block_w,axis=-1))
+    error=blocks.block_error(np.exp(log_folded-log_block_w),log_block_w,fraction)
+    return fraction,error,blocks.blocks_neff(log_block_w)
+
+  def write(self):
+    a=self.args
+    s=self.session
+    scan=self.scan
+    outfilename=s.outfilename(a.outfilename)
+    metadata={'temp':s.temp,'pres':s.pres/from_bar,'rewpres':a.rewpres,'N':s.N,'tran':s.tran}
+    num_blocks=a.num_blocks
+    if a.scan:
+      counts=scan.counts[::-1] #increasing block size
+      stats=np.array([self.block_stats(n) for n in counts])
+      best=blocks.plateau(stats[:,1].T,stats[:,2].T)
+      if num_blocks<=0:
+        num_blocks=counts[blocks.recommended(stats[:,1].T,stats[:,2].T)]
+        print(' %s: recommended num_blocks= %d'%(self.name,num_blocks))
+      n=np.array(counts)
+      columns=[np.repeat(self.temp_range[:,np.newaxis],len(n),axis=1),np.tile(n,(a.nbins,1)),np.tile(scan.nrows//n,(a.nbins,1)),
+               stats[:,0].T,stats[:,1].T,stats[:,2].T,best[:,np.newaxis]==np.arange(len(n))]
+      names=['temp','num_blocks','len_blocks','folded_fraction','error','blocks_neff','recommended']
+      output.write_grid('blocks-'+outfilename,names,columns,'',metadata,s.fmts,fmt=['%-9g','%d','%d','%-9g','%-9g','%-9g','%d'])
+    if scan.skip(num_blocks)!=0:
+      print(' +++ WARNING blocks mismatch: throwing away first %d lines'%scan.skip(num_blocks))
+    fraction,error,blocks_neff=self.block_stats(num_blocks)
+    metadata['num_blocks']=num_blocks
+    output.write_grid(outfilename,['temp','folded_fraction','error','blocks_neff'],[self.temp_range,fraction,error,blocks_neff],'#num_blocks=%g'%num_blocks,metadata,s.fmts,fmt='%-9g')
+
+class FESBlocks(Job):
+  # reweighted FES along the CV at a given (T,P), with block average uncertainty
+  def options(self,parser):
+    parser.add_argument('--blocks',dest='num_blocks',type=int,required=True,help='number of blocks, 0 to use the recommended one from --scan')
+    parser.add_argument('--scan',dest='scan',type=int,default=0,required=False,help='also print the error for any number of blocks from 2 up to this')
+    parser.add_argument('--rewtemp',dest='rewtemp',type=float,required=True,help='the reweighting temperature')
+    parser.add_argument('--rewpres',dest='rewpres',type=float,required=True,help='the reweighting pressure (bar)')
+    parser.add_argument('--sigma',dest='sigma',type=float,required=False,help='sigma for KDE')
+    parser.add_argument('--nbins',dest='nbins',type=int,required=False,help='number of bins')
+    parser.add_argument('--cv_min',dest='cv_min',type=float,required=False,help='minimum of the CV grid')
+    parser.add_argument('--cv_max',dest='cv_max',type=float,required=False,help='maximum of the CV grid')
+    parser.add_argument('--cutoff',dest='cutoff',type=float,default=12,required=False,help='neglect the kernels farther than this many sigmas, 0 to sum all of them')
+    parser.add_argument('--nomintozero',dest='nomintozero',action='store_true',default=False,help='do not shift the minimum to zero')
+    parser.add_argument('-o',dest='outfilename',type=str,required=False,help='output file name')
+
+  def setup(self):
+    a=self.args
+    s=self.session
+    if a.num_blocks<=0 and a.scan<2:
+      sys.exit(' %s: --blocks 0 requires --scan'%self.name)
+    self.cv_grid=np.linspace(a.cv_min,a.cv_max,a.nbins)
+    self.scan=blocks.BlockScan(s.N,[a.num_blocks]+list(range(2,a.scan+1)),skip_first=False)
+    scan=self.scan
+    cv_grid=self.cv_grid
+    rew_beta=1/(kB*a.rewtemp)
+    rew_pres=a.rewpres*from_bar
+    def compute():
+      log_block_w=LogSumExp(scan.nsegments)
+      log_prob=LogSumExp((a.nbins,scan.nsegments))
+      size=max(1,reweight.max_size//(1 if a.cutoff>0 else a.nbins))
+      for n in range(0,s.N,size):
+        segments=scan.labels(n,min(size,s.N-n))
+        log_w=(s.beta-rew_beta)*s.ene[n:n+size]+(s.beta*s.pres-rew_beta*rew_pres)*s.vol[n:n+size]+s.beta*s.bias[n:n+size]
+        log_block_w.add_unsorted(log_w,segments)
+        if a.cutoff>0:
+          log_prob.add_log(kde.truncated_log_sums(s.cv[n:n+size],log_w,cv_grid,a.sigma,segments,scan.nsegments,a.cutoff)[0].T)
+        else:
+          log_prob.add_unsorted(log_w-0.5*((cv_grid[:,np.newaxis]-s.cv[n:n+size])/a.sigma)**2,segments)
+      return log_block_w.result(),log_prob.result()
+    self.key=s.task(('fes_blocks',s.first,tuple(scan.bounds),a.rewtemp,a.rewpres,a.sigma,a.nbins,a.cv_min,a.cv_max,a.cutoff),compute)
+
+  def block_stats(self,num_blocks):
+    log_block_w,log_prob=self.session.results[self.key]
+    lbw=self.scan.block_log_sums(log_block_w,num_blocks)
+    lp=self.scan.block_log_sums(log_prob,num_blocks)
+    log_av_prob=np.logaddexp.reduce(lp+blocks.normalize(lbw),axis=-1)
+    error=blocks.block_error(np.exp(lp-log_av_prob[:,np.newaxis]),lbw,np.ones(self.args.nbins))
+    av_fes=-log_av_prob
+    if not self.args.nomintozero:
+      av_fes-=min(av_fes)
+    return av_fes,error,blocks.blocks_neff(lbw)
+
+  def write(self):
+    a=self.args
+    s=self.session
+    scan=self.scan
+    outfilename=s.outfilename(a.outfilename)
+    metadata={'temp':s.temp,'pres':s.pres/from_bar,'rewtemp':a.rewtemp,'rewpres':a.rewpres,'N':s.N,'tran':s.tran}
+    comment='#temp= %g K, pres= %g bar'%(a.rewtemp,a.rewpres)
+    num_blocks=a.num_blocks
+    if a.scan:
+      counts=scan.counts[::-1] #increasing block size
+      stats=[self.block_stats(n) for n in counts]
+      errors=np.array([st[1] for st in stats]).T
+      neffs=np.array([np.full(a.nbins,st[2]) for st in stats]).T
+      best=blocks.plateau(errors,neffs)
+      if num_blocks<=0:
+        num_blocks=counts[blocks.recommended(errors,neffs)]
+        print(' %s: recommended num_blocks= %d'%(self.name,num_blocks))
+      n=np.array(counts)
+      columns=[np.repeat(self.cv_grid[:,np.newaxis],len(n),axis=1),np.tile(n,(a.nbins,1)),np.tile(scan.nrows//n,(a.nbins,1)),
+               np.array([st[0] for st in stats]).T,errors,np.tile([st[2] for st in stats],(a.nbins,1)),best[:,np.newaxis]==np.arange(len(n))]
+      names=['cv','num_blocks','len_blocks','FES','error','blocks_neff','recommended']
+      output.write_grid('blocks-'+outfilename,names,columns,comment,metadata,s.fmts,fmt=['%.12g','%d','%d','%.12g','%.12g','%.12g','%d'])
+    if scan.skip(num_blocks)!=0:
+      print(' +++ WARNING blocks mismatch: throwing away last %d lines'%scan.skip(num_blocks))
+    av_fes,error,blocks_neff=self.block_stats(num_blocks)
+    metadata.update(num_blocks=num_blocks,blocks_neff=blocks_neff)
+    output.write_grid(outfilename,['cv','FES','error'],[self.cv_grid,av_fes,error],comment+', blocks_neff=%g'%blocks_neff,metadata,s.fmts,fmt='%.18e')
+
+def read_jobs(jobs,jobfile=None):
+  # list of argv for each job, from the command line strings and from a file with one job per line
+  lines=list(jobs)
+  if jobfile:
+    with open(jobfile) as f:
+      lines+=[line.split('#',1)[0] for line in f]
+  return [shlex.split(line) for line in lines if line.strip()]
+
+def run_jobs(session,job_types,jobs,processes=None):
+  # creates the jobs from their command lines, runs all the calculations at once and writes the outputs
+  types={j.name:j for j in job_types}
+  created=[]
+  for argv in jobs:
+    if argv[0] not in types:
+      sys.exit(' unknown job "%s", choose among: %s'%(argv[0],', '.join(types)))
+    created.append(types[argv[0]](session,argv[1:]))
+  profiling.mark('reweight')
+  for job in created:
+    job.setup()
+  session.run(processes)
+  profiling.mark('output')
+  for job in created:
+    print('  writing %s'%job.name)
+    job.write()
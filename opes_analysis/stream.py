@@ -0,0 +1,57 @@
+# Out-of-core access to Colvar files, in chunks of fixed size
+#
+# Chunks come from the memory-mapped column cache when available, otherwise from pd.read_csv,
+# so that peak memory only depends on chunk_size and not on the trajectory length.
+# Results are meant to be accumulated with reweight.LogSumExp, per block and per target.
+
+import numpy as np
+import pandas as pd
+
+from opes_analysis import colvar
+
+chunk_size=2**18 #rows per chunk
+
+def _cache(filename):
+  if colvar.cache_enabled():
+    try:
+      return colvar.open_cache(filename)
+    except (OSError,ValueError):
+      pass
+  return None
+
+def iter_chunks(filename,usecols,skiprows=0,dtype=None,size=None):
+  # yields lists with a chunk of each of the requested columns
+  size=size or chunk_size
+  meta=_cache(filename)
+  if meta is None:
+    reader=pd.read_csv(filename,sep=r'\s+',comment='#',header=None,usecols=sorted(set(usecols)),skiprows=skiprows,dtype=dtype or np.float64,chunksize=size)
+    for data in reader:
+      yield [np.array(data[c]) for c in usecols]
+    return
+  columns=colvar.read_columns(filename,usecols,skiprows=skiprows)
+  for n in range(0,len(columns[0]),size):
+    yield [np.array(col[n:n+size],dtype=dtype or np.float64) for col in columns]
+
+def count_rows(filename,skiprows=0):
+  meta=_cache(filename)
+  if meta is not None:
+    return len(colvar.read_columns(filename,[0],skiprows=skiprows)[0])
+  return sum(len(chunk[0]) for chunk in iter_chunks(filename,[0],skiprows))
+
+def means(filename,usecols,skiprows=0,dtype=None):
+  # streaming mean of the given columns, to center them as the in-memory scripts do
+  sums=np.zeros(len(usecols),dtype=dtype or np.float64)
+  count=0
+  for chunk in iter_chunks(filename,usecols,skiprows,dtype):
+    sums+=[np.sum(col) for col in chunk]
+    count+=len(chunk[0])
+  return sums/count,count
+
+def block_ids(first,n,nrows,num_blocks,skip_first=True):
+  # block index of the rows [first,first+n), -1 for the rows thrown away when nrows is not a multiple of num_blocks
+  len_blocks=nrows//num_blocks
+  skip=nrows-num_blocks*len_blocks if skip_first else 0
+  rows=np.arange(first,first+n)-skip
+  ids=rows//len_blocks
+  ids[(rows<0)|(ids>=num_blocks)]=-1
+  return ids
@@ -0,0 +1,163 @@
+# Synthetic Colvar files with the FIELDS layout of each system, at any size and number of walkers, for benchmarks
+#
+# The CVs are drawn from the biased distribution p(x)~exp(-beta*F(x)/gamma), with F a reference FES from figures/,
+# and the bias column is V(x)=-(1-1/gamma)*F(x), as for a well-tempered target, so that reweighting gives back F.
+# For chignolin the folded fraction as a function of temperature comes from a two-state model, each basin with a
+# Gaussian energy distribution, so that log(Z_folded/Z_unfolded)=a+b*dbeta+c*dbeta^2 is fitted to the reference curve.
+# The energies are drawn from a broader Gaussian and the bias restores the model at the simulation temperature.
+# Rows are independent samples; multiple walkers have nwalkers rows with the same time, as in all_Colvar.data.
+# reweighted_nodes gives the infinite-data limit of the reweighted CVs, as quadrature nodes and weights over each bin,
+# so that the output of a KDE can be checked against the same KDE of the exact distribution.
+
+import os
+import numpy as np
+
+from opes_analysis import colvar
+from opes_analysis.reweight import kB
+
+figures=os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))),'figures')
+chunk_size=2**20 #rows generated at once
+
+def _wrap(x,period):
+  return x if period is None else (x+period/2)%period-period/2
+
+def _sample_grid(rng,n,points,log_p,spacing,period=None):
+  # points of a regular grid, shape (npoints,dim), drawn with probability exp(log_p) and spread uniformly over their bin
+  p=np.exp(log_p-np.amax(log_p))
+  idx=rng.choice(len(points),size=n,p=p/np.sum(p))
+  x=points[idx]+spacing*(rng.random((n,points.shape[1]))-0.5)
+  return _wrap(x,period)
+
+def _grid_nodes(sub,points,log_p,spacing,period=None):
+  # the same distribution as _sample_grid, as sub nodes per dimension in each bin, with their log-probabilities
+  offsets=(np.arange(sub)+0.5)/sub-0.5
+  dim=points.shape[1]
+  o=np.stack(np.meshgrid(*[offsets]*dim,indexing='ij'),axis=-1).reshape(-1,dim)
+  x=(points[:,np.newaxis,:]+spacing*o).reshape(-1,dim)
+  return _wrap(x,period),np.repeat(log_p-np.log(len(o)),len(o))
+
+class System:
+  # a Colvar layout, sample(rng,n) gives the columns after time, shape (n,len(fields)-1)
+  fields=()
+  fmt='%.8g'
+  temp=1.
+  gamma=10
+
+  def reweighted_nodes(self,sub=8):
+    # CVs and normalized weights of the reweighted distribution, the bias being -(1-1/gamma) of the FES in kBT
+    x,log_p=_grid_nodes(sub,*self._grid())
+    x,fes=self._cv_fes(x)
+    log_w=log_p+(1-1/self.gamma)*(-fes)
+    w=np.exp(log_w-np.amax(log_w))
+    return x,w/np.sum(w)
+
+  def write(self,filename,nrows,nwalkers=1,seed=0,pace_to_time=2.5):
+    rng=np.random.default_rng(seed)
+    with colvar.Writer(filename,self.fields,self.fmt,cache=False) as out:
+      for n in range(0,nrows,chunk_size):
+        rows=np.arange(n,min(nrows,n+chunk_size))
+        out.write(np.c_[pace_to_time*(rows//nwalkers),self.sample(rng,len(rows))])
+
+class Model(System):
+  fields=('time','p.x','p.y','opes.bias')
+  reference='fig5a.model-fes.data'
+
+  def __init__(self):
+    self.x,self.fes=np.loadtxt(os.path.join(figures,self.reference),usecols=(0,1),unpack=True)
+
+  def _grid(self):
+    return self.x[:,np.newaxis],-self.fes/self.gamma,self.x[1]-self.x[0]
+
+  def _cv_fes(self,x):
+    # the CV of the sampled points and the FES used for their bias
+    return x[:,0],np.interp(x[:,0],self.x,self.fes)
+
+  def sample(self,rng,n):
+    x,fes=self._cv_fes(_sample_grid(rng,n,*self._grid()))
+    bias=-(1-1/self.gamma)*fes
+    return np.c_[x,0.5+0.3*rng.standard_normal(n),bias]
+
+class Alanine(System):
+  fields=('time','phi','psi','ene','opes.bias')
+  reference='fig1c.ala2-FES_rew300.data'
+  temp=300.
+
+  def __init__(self):
+    self.points=np.loadtxt(os.path.join(figures,self.reference),usecols=(0,1))
+    self.fes=np.loadtxt(os.path.join(figures,self.reference),usecols=2) #in kBT units
+    self.spacing=np.amax(np.diff(np.unique(self.points[:,0])))
+
+  def _grid(self):
+    return self.points,-self.fes/self.gamma,self.spacing,2*np.pi
+
+  def _cv_fes(self,x):
+    #nearest grid point, for the bias
+    nx=len(np.unique(self.points[:,0]))
+    i=np.clip(np.rint((x+np.pi)/self.spacing).astype(int),0,nx-1)
+    return x,self.fes[i[:,0]*nx+i[:,1]] if self.points[1,1]!=self.points[0,1] else self.fes[i[:,1]*nx+i[:,0]]
+
+  def sample(self,rng,n):
+    x,fes=self._cv_fes(_sample_grid(rng,n,*self._grid()))
+    bias=-(1-1/self.gamma)*kB*self.temp*fes
+    return np.c_[x,-7500+40*rng.standard_normal(n),bias]
+
+class Sodium(System):
+  fields=('time','ene','vol','refcv.mean','refcv.morethan','opes.bias')
+  reference='fig7b.na-FES-350K-1.0GPa.data'
+  temp=350.
+  pres=10000. #bar
+  rescale_cv=250
+
+  def __init__(self):
+    self.cv,self.fes=np.loadtxt(os.path.join(figures,self.reference),usecols=(0,1),unpack=True) #in kBT units
+
+  def _grid(self):
+    return self.cv[:,np.newaxis],-self.fes/self.gamma,self.cv[1]-self.cv[0]
+
+  def _cv_fes(self,x):
+    cv=np.clip(x[:,0],0,1)
+    return cv,np.interp(cv,self.cv,self.fes)
+
+  def sample(self,rng,n):
+    cv,fes=self._cv_fes(_sample_grid(rng,n,*self._grid()))
+    bias=-(1-1/self.gamma)*kB*self.temp*fes
+    return np.c_[-250*107+30*rng.standard_normal(n),250*0.039+0.05*rng.standard_normal(n),rng.random(n),self.rescale_cv*cv,bias]
+
+class Chignolin(System):
+  fields=('time','full_ene','vol','pdb_rmsd','opes.bias','basin')
+  reference='fig3.chigno-temp_folding-our.data'
+  temp=500.
+  pres=1. #bar, as the reweighting pressure, otherwise the volume term would make the weights degenerate
+  sigma=100. #smallest width of the energy of a basin, kJ/mol
+
+  def __init__(self):
+    temps,fraction=np.loadtxt(os.path.join(figures,self.reference),usecols=(0,1),unpack=True)
+    self.dbeta=1/(kB*temps)-1/(kB*self.temp)
+    c,b,a=np.polyfit(self.dbeta,np.log(fraction/(1-fraction)),2)
+    var_u=self.sigma**2+max(0,-2*c)
+    self.var=np.array([var_u+2*c,var_u]) #folded is basin=0
+    self.mu=np.array([-b,0])-90000
+    self.log_n=np.array([a,0])-np.logaddexp(a,0)
+    #sampled energies, covering the shift of the mean -dbeta*var over the range of temperatures
+    mid=0.5*(np.amin(self.dbeta)+np.amax(self.dbeta))
+    half=0.5*(np.amax(self.dbeta)-np.amin(self.dbeta))
+    self.mean_s=self.mu-mid*self.var
+    self.var_s=self.var+(half*self.var)**2
+
+  def folded_fraction(self,temps):
+    # exact folded fraction of the model
+    d=1/(kB*np.asarray(temps))-1/(kB*self.temp)
+    g=self.log_n[0]-self.log_n[1]-d*(self.mu[0]-self.mu[1])+0.5*d**2*(self.var[0]-self.var[1])
+    return 1/(1+np.exp(-g))
+
+  def sample(self,rng,n):
+    basin=rng.integers(2,size=n)
+    ene=self.mean_s[basin]+np.sqrt(self.var_s[basin])*rng.standard_normal(n)
+    log_target=self.log_n[basin]-0.5*(ene-self.mu[basin])**2/self.var[basin]-0.5*np.log(self.var[basin])
+    log_sample=np.log(0.5)-0.5*(ene-self.mean_s[basin])**2/self.var_s[basin]-0.5*np.log(self.var_s[basin])
+    bias=kB*self.temp*(log_target-log_sample)
+    bias-=kB*self.temp*np.amax(self.log_n-0.5*np.log(self.var)-np.log(0.5)+0.5*np.log(self.var_s)) #at most zero
+    rmsd=np.where(basin==0,0.1,0.5)+0.05*rng.standard_normal(n)
+    return np.c_[ene,2*48.4+0.2*rng.standard_normal(n),rmsd,bias,basin]
+
+systems={'model':Model,'alanine':Alanine,'sodium':Sodium,'chignolin':Chignolin}
@@ -0,0 +1,84 @@
+# Tools to combine the output files of multiple walkers into a single time-sorted file
+#
+# Each walker is read and validated on its own (e.g. in a process pool), then the walkers,
+# already sorted by time, are k-way merged in chunks: a heap keeps the unfinished walkers ordered by the
+# last time they have buffered, and all the buffered rows below the smallest of these times are final.
+# Rows with the same time keep the order of the walkers, as with 'sort -gsk1' on their concatenation.
+
+import heapq
+import io
+import numpy as np
+import pandas as pd
+
+def read_xvg(filename,usecols):
+  # columns of a GROMACS xvg file, skipping the '#' and '@' header lines
+  header=0
+  with open(filename) as f:
+    for line in f:
+      if not line.startswith(('#','@')):
+        break
+      header+=1
+  data=pd.read_csv(filename,sep=r'\s+',header=None,skiprows=header,usecols=sorted(set(usecols)),dtype=np.float64)
+  return [np.array(data[c]) for c in usecols]
+
+def read_restarts(filename,usecols):
+  # columns of a PLUMED file, discarding the first row after each '#!' header block,
+  # i.e. the initial point and the one repeated at each restart
+  lines=[]
+  drop=False
+  with open(filename) as f:
+    for line in f:
+      words=line.split(None,1)
+      if not words:
+        continue
+      if words[0]=='#!':
+        drop=True
+      elif drop:
+        drop=False
+      else:
+        lines.append(line)
+  if len(lines)==0:
+    return [np.zeros(0) for c in usecols]
+  data=pd.read_csv(io.StringIO(''.join(lines)),sep=r'\s+',header=None,usecols=sorted(set(usecols)),dtype=np.float64)
+  return [np.array(data[c]) for c in usecols]
+
+def hysteresis(x,low,up,start):
+  # labels 1 after x goes above up, 0 after it goes below low, otherwise the previous label (initially start)
+  # returns the labels and the last one, to be passed as start of the following chunk
+  event=np.where(x>up,1,np.where(x<low,0,-1))
+  last=np.where(event>=0,np.arange(len(x)),-1)
+  np.maximum.accumulate(last,out=last)
+  labels=np.where(last>=0,event[np.maximum(last,0)],start)
+  return labels,(labels[-1] if len(labels)>0 else start)
+
+def merge(walkers,chunk_size=2**18):
+  # yields chunks of the rows of all walkers, 2D arrays (possibly memory-mapped) sorted by their first column
+  step=max(1,chunk_size//max(1,len(walkers)))
+  pos=[0]*len(walkers)
+  bufs=[np.zeros((0,)+w.shape[1:]) for w in walkers]
+  heap=[]
+  def refill(i):
+    new=np.asarray(walkers[i][pos[i]:pos[i]+step],dtype=np.float64)
+    pos[i]+=len(new)
+    bufs[i]=np.concatenate([bufs[i],new])
+    if pos[i]<len(walkers[i]):
+      heapq.heappush(heap,(bufs[i][-1,0],i))
+  def pop(threshold):
+    rows=[]
+    for i,buf in enumerate(bufs):
+      n=len(buf) if threshold is None else np.searchsorted(buf[:,0],threshold,side='left')
+      rows.append(buf[:n])
+      bufs[i]=buf[n:]
+    rows=np.concatenate(rows)
+    return rows[np.argsort(rows[:,0],kind='stable')]
+  for i in range(len(walkers)):
+    refill(i)
+  while heap:
+    threshold,i=heapq.heappop(heap)
+    rows=pop(threshold)
+    if len(rows)>0:
+      yield rows
+    refill(i)
+  rows=pop(None)
+  if len(rows)>0:
+    yield rows
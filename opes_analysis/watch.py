@@ -0,0 +1,107 @@
+# Follow PLUMED files while they are being written, for live analysis of running simulations
+#
+# A Tail reads only the complete lines appended since its last poll, so the cost of each update
+# depends only on the number of new samples. follow() polls it from an asyncio event loop.
+# RunningFES keeps the reweighted kernel sums and the sums of the weights, shifted by the largest bias seen so far,
+# from which the FES, deltaF between two regions and the Kish effective sample size can be obtained at any time.
+
+import io
+import os
+import sys
+import asyncio
+import numpy as np
+import pandas as pd
+
+from opes_analysis import kde
+from opes_analysis.reweight import LogSumExp
+
+max_read=2**24 #bytes read at once, a long file is ingested in several updates
+
+class Tail:
+  def __init__(self,filename):
+    self.filename=filename
+    self.offset=0
+    self.rest=b''
+    self.fields=None
+    self.reset=False #set when the file has been truncated or replaced
+
+  def poll(self):
+    # new rows as a 2D array, None if there are none
+    try:
+      with open(self.filename,'rb') as f:
+        f.seek(0,os.SEEK_END)
+        size=f.tell()
+        if size<self.offset:
+          print(' +++ WARNING: %s has been truncated, reading it again +++'%self.filename,file=sys.stderr)
+          self.offset=0
+          self.rest=b''
+          self.reset=True
+        if size==self.offset:
+          return None
+        f.seek(self.offset)
+        new=f.read(min(size-self.offset,max_read))
+        text=self.rest+new
+        self.offset+=len(new)
+    except FileNotFoundError:
+      return None
+    cut=text.rfind(b'\n')+1
+    self.rest=text[cut:]
+    rows=[]
+    for line in text[:cut].splitlines():
+      if line.startswith(b'#! FIELDS'):
+        self.fields=[f.decode() for f in line.split()[2:]]
+      elif line.strip() and not line.lstrip().startswith(b'#'):
+        rows.append(line)
+    if len(rows)==0:
+      return None
+    data=pd.read_csv(io.BytesIO(b'\n'.join(rows)),sep=r'\s+',header=None,dtype=np.float64)
+    return data.to_numpy()
+
+async def follow(tail,interval=1.0):
+  # async generator of the new rows of tail, checking for them every interval seconds
+  while True:
+    data=tail.poll()
+    if data is not None:
+      yield data
+      await asyncio.sleep(0) #let the other tasks run
+    else:
+      await asyncio.sleep(interval)
+
+class RunningFES:
+  # reweighted FES of cv, with weights exp(bias/kbt), accumulated over chunks of samples
+  def __init__(self,grid,sigma,kbt=1):
+    self.grid=np.asarray(grid,dtype=np.float64)
+    self.sigma=sigma
+    self.kbt=kbt
+    self.clear()
+
+  def clear(self):
+    self.shift=-np.inf
+    self.sums=np.zeros(len(self.grid))
+    self.log_z=LogSumExp(1)
+    self.log_z2=LogSumExp(1)
+    self.size=0
+
+  def add(self,cv,bias):
+    if len(cv)==0:
+      return
+    x=np.asarray(bias,dtype=np.float64)/self.kbt
+    new_shift=max(self.shift,np.amax(x))
+    if new_shift>self.shift:
+      self.sums*=np.exp(self.shift-new_shift)
+      self.shift=new_shift
+    self.sums+=kde.gaussian_sums(np.asarray(cv,dtype=np.float64),np.exp(x-self.shift),self.grid,self.sigma)
+    self.log_z.add(x)
+    self.log_z2.add(2*x)
+    self.size+=len(cv)
+
+  def fes(self):
+    with np.errstate(divide='ignore'):
+      return -self.kbt*np.log(self.sums/np.amax(self.sums))
+
+  def deltaF(self,transition):
+    # free energy difference between the regions cv<transition and cv>transition, on the grid
+    return self.kbt*np.log(np.sum(self.sums[self.grid<transition])/np.sum(self.sums[self.grid>transition]))
+
+  def neff(self):
+    return np.exp(2*self.log_z.result()[0]-self.log_z2.result()[0])
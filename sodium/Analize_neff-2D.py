@@ -2,9 +2,16 @@
 
 import sys
 import numpy as np
-import pandas as pd
-import subprocess
 import argparse
+import os
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),'..'))
+from opes_analysis import colvar
+from opes_analysis import reweight
+from opes_analysis import output
+from opes_analysis import profiling
+from opes_analysis.reweight import Reweighter
+from opes_analysis.binned import BinnedReweighter
+from opes_analysis.results import ResultCache
 
 
 #parser
@@ -16,12 +23,17 @@ parser.add_argument('--pres',dest='pres',type=float,default=5000,required=False,
 parser.add_argument('--minpres',dest='minpres',type=float,default=0,required=False,help='the minimum preserature')
 parser.add_argument('--maxpres',dest='maxpres',type=float,default=10000,required=False,help='the maximum preserature')
 parser.add_argument('--nbins',dest='nbins',type=int,default=100,required=False,help='number of bins')
+parser.add_argument('--tol',dest='tol',type=float,default=0,required=False,help='accuracy bound on the log partition sums, if positive use the binned (ene,vol) index instead of exact reweighting')
+parser.add_argument('--float32',dest='float32',action='store_true',default=False,help='store the bulk arrays in single precision')
+parser.add_argument('--validate',dest='validate',action='store_true',default=False,help='repeat the calculation in float128 and print the deviations')
 parser.add_argument('--tran',dest='tran',type=int,default=0,required=False,help='transient to be skipped')
 parser.add_argument('--bck',dest='bck',type=str,default='',required=False,help='backup prefix, e.g. \"bck.0.\"')
 parser.add_argument('-f',dest='filename',type=str,default='Colvar.data',required=False,help='input file name')
+parser.add_argument('--format',dest='format',type=str,default='text',required=False,help='comma separated output formats: text, npz, hdf5')
 parser.add_argument('-o',dest='outfilename',type=str,default='Neff-2D.data',required=False,help='output file name')
 
 args = parser.parse_args()
+fmts=output.parse_formats(args.format)
 temp=args.temp
 min_temp=args.mintemp
 max_temp=args.maxtemp
@@ -43,28 +55,32 @@ filename=args.filename
 ene_col=1
 vol_col=2
 bias_col=5
-data=pd.read_csv(bck+filename,sep='\s+',comment='#',header=None,usecols=[ene_col,vol_col,bias_col],skiprows=tran,dtype=np.float128)
-ene=np.array(data.iloc[:,0])
-vol=np.array(data.iloc[:,1])
-bias=np.array(data.iloc[:,2])
-del data
-ene-=np.mean(ene)
-vol-=np.mean(vol)
+profiling.mark('load')
+ene,vol,bias=colvar.read_columns(bck+filename,[ene_col,vol_col,bias_col],skiprows=tran)
+profiling.rows(len(ene))
+dtype=np.float32 if args.float32 else np.float64
+ene=reweight.center(ene,dtype)
+vol=reweight.center(vol,dtype)
+bias=bias.astype(dtype,copy=False)
 
 kB=0.0083144621 #kj/mol
 beta=1/(kB*temp)
 beta_range=np.linspace(1/(kB*min_temp),1/(kB*max_temp),nbins)
 pres_range=np.linspace(min_pres,max_pres,nbins)
 b,p=np.meshgrid(beta_range,pres_range)
-def weights(_b,_p):
-  return np.exp((beta-_b)*ene+(beta*pres-_b*_p)*vol+beta*bias)
+profiling.mark('reweight')
+cache=ResultCache(bck+filename,enabled=args.tol<=0,cols=[ene_col,vol_col,bias_col],tran=tran)
+def compute(dtype):
+  rw=Reweighter(ene.astype(dtype,copy=False),vol.astype(dtype,copy=False),bias.astype(dtype,copy=False),temp,pres)
+  if args.tol>0:
+    rw=BinnedReweighter(rw,b,p,tol=args.tol)
+    print('  binned index: %d occupied bins, tol=%g'%(rw.nbins,args.tol))
+    return rw.neff(b,p)
+  log_z,log_z2=cache.log_sums(rw,b,p,(1,2))
+  return np.exp(2*log_z-log_z2)
+neff=reweight.validate(compute,dtype,args.validate)
+cache.report()
+profiling.mark('output')
 
-cmd=subprocess.Popen('bck.meup.sh -i '+outfilename,shell=True)
-cmd.wait()
-outfile=open(outfilename,'w')
-print('#beta  pres  Neff/N  #N=%d'%len(ene),file=outfile)
-for i in range(nbins):
-  print('    working... {:.0%}'.format(i/nbins),end='\r')
-  for j in range(nbins):
-    print(1/(kB*b[i,j]),p[i,j]/from_bar,np.sum(weights(b[i,j],p[i,j]))**2/np.sum(weights(b[i,j],p[i,j])**2)/len(ene),file=outfile)
-  print('',file=outfile)
+metadata={'temp':temp,'pres':args.pres,'N':len(ene),'tran':args.tran}
+output.write_grid(outfilename,['beta','pres','Neff/N'],[1/(kB*b),p/from_bar,neff/len(ene)],'#N=%d'%len(ene),metadata,fmts)
@@ -0,0 +1,83 @@
+#! /usr/bin/env python3
+
+# Runs several analyses on the same Colvar file, loading it only once
+# usage: ./Analyze_session.py 'phase' 'neff' 'fes_blocks --blocks 0 --scan 20 --rewtemp 370 --rewpres 1'
+#    or: ./Analyze_session.py --jobs jobs.dat   (one job per line)
+# jobs and their defaults are the same as Phase_diagram.py, Analize_neff-2D.py and Reweight-blocks.py
+
+import sys
+import numpy as np
+import argparse
+import os
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),'..'))
+from opes_analysis import colvar
+from opes_analysis import reweight
+from opes_analysis import output
+from opes_analysis import profiling
+from opes_analysis import session
+
+#set columns
+ene_col=1
+vol_col=2
+cv_col=4
+bias_col=5
+rescale_cv=250 #to have crystallyinity from 0 to 1
+
+grid_defaults={'mintemp':350,'maxtemp':450,'minpres':0,'maxpres':10000,'nbins':100}
+
+class Phase(session.TwoStateGrid):
+  name='phase'
+  help='DeltaG between liquid and bcc over a range of temperatures and pressures'
+  defaults=dict(grid_defaults,outfilename='na-phase_diagram.data')
+
+class Neff(session.NeffGrid):
+  name='neff'
+  help='effective sample size over a range of temperatures and pressures'
+  beta_grid=True
+  defaults=dict(grid_defaults,outfilename='Neff-2D.data')
+
+class FES(session.FESBlocks):
+  name='fes_blocks'
+  help='reweighted FES as a function of the crystallinity, with block average uncertainty'
+  defaults={'sigma':0.01,'nbins':100,'cv_min':0,'cv_max':1,'outfilename':'FES_rew.data'}
+
+#parser
+parser = argparse.ArgumentParser(description='run several analyses loading the data only once')
+parser.add_argument('jobs',type=str,nargs='*',help='jobs, with their own options, e.g. \"neff --nbins 30\". Available: phase, neff, fes_blocks')
+parser.add_argument('--jobs',dest='jobfile',type=str,default=None,required=False,help='file with one job per line')
+parser.add_argument('--temp',dest='temp',type=float,default=400,required=False,help='the simulation temperature')
+parser.add_argument('--pres',dest='pres',type=float,default=5000,required=False,help='the simulation pressure (bar)')
+parser.add_argument('--float32',dest='float32',action='store_true',default=False,help='store the bulk arrays in single precision')
+parser.add_argument('--nproc',dest='nproc',type=int,default=0,required=False,help='number of processes, 0 to use all the cores')
+parser.add_argument('--tran',dest='tran',type=int,default=0,required=False,help='transient to be skipped')
+parser.add_argument('--bck',dest='bck',type=str,default='',required=False,help='backup prefix, e.g. \"bck.0.\"')
+parser.add_argument('-f',dest='filename',type=str,default='all_Colvar.data',required=False,help='input file name')
+parser.add_argument('--format',dest='format',type=str,default='text',required=False,help='comma separated output formats: text, npz, hdf5')
+args = parser.parse_args()
+fmts=output.parse_formats(args.format)
+jobs=session.read_jobs(args.jobs,args.jobfile)
+if len(jobs)==0:
+  sys.exit(' no jobs given')
+from_bar=0.06022140857
+tran=args.tran
+if tran:
+  print('  tran =',tran)
+bck=args.bck
+if bck:
+  print('  backup: '+bck)
+
+profiling.mark('load')
+ene,vol,cv,bias=colvar.read_columns(bck+args.filename,[ene_col,vol_col,cv_col,bias_col],skiprows=tran)
+dtype=np.float32 if args.float32 else np.float64
+mean_ene=np.mean(ene,dtype=np.float64)
+mean_vol=np.mean(vol,dtype=np.float64)
+ene=reweight.center(ene,dtype)
+vol=reweight.center(vol,dtype)
+bias=bias.astype(dtype,copy=False)
+cv=cv/rescale_cv
+phase=np.where(cv>0.5,1,np.where(cv<0.5,0,-1)) #0 is liquid, 1 is bcc
+print('  all data loaded')
+profiling.rows(len(ene))
+
+s=session.Session(ene,vol,bias,args.temp,args.pres*from_bar,phase,cv=cv,tran=tran,fmts=fmts,mean_ene=mean_ene,mean_vol=mean_vol)
+session.run_jobs(s,[Phase,Neff,FES],jobs,args.nproc or None)
@@ -2,9 +2,19 @@
 
 import sys
 import numpy as np
-import pandas as pd
-import subprocess
 import argparse
+import os
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),'..'))
+from opes_analysis import colvar
+from opes_analysis import stream
+from opes_analysis import reweight
+from opes_analysis import bootstrap
+from opes_analysis import output
+from opes_analysis import profiling
+from opes_analysis.reweight import Reweighter
+from opes_analysis.binned import BinnedReweighter
+from opes_analysis.results import ResultCache
+from opes_analysis.coexistence import Coexistence
 
 
 #parser
@@ -16,12 +26,28 @@ parser.add_argument('--pres',dest='pres',type=float,default=5000,required=False,
 parser.add_argument('--minpres',dest='minpres',type=float,default=0,required=False,help='the minimum pressure (bar)')
 parser.add_argument('--maxpres',dest='maxpres',type=float,default=10000,required=False,help='the maximum pressure (bar)')
 parser.add_argument('--nbins',dest='nbins',type=int,default=100,required=False,help='number of bins')
+parser.add_argument('--tol',dest='tol',type=float,default=0,required=False,help='accuracy bound on the log partition sums, if positive use the binned (ene,vol) index instead of exact reweighting')
+parser.add_argument('--stream',dest='stream',action='store_true',default=False,help='read the input file in chunks, with memory independent of its length')
+parser.add_argument('--float32',dest='float32',action='store_true',default=False,help='store the bulk arrays in single precision')
+parser.add_argument('--validate',dest='validate',action='store_true',default=False,help='repeat the calculation in float128 and print the deviations')
+parser.add_argument('--bootstrap',dest='bootstrap',type=int,default=0,required=False,help='number of moving-block bootstrap replicas, to print also a confidence interval')
+parser.add_argument('--boot_block',dest='boot_block',type=int,default=1000,required=False,help='length in samples of the bootstrap blocks')
+parser.add_argument('--level',dest='level',type=float,default=0.95,required=False,help='confidence level of the bootstrap interval')
+parser.add_argument('--nproc',dest='nproc',type=int,default=0,required=False,help='number of processes for the bootstrap, 0 to use all the cores')
 parser.add_argument('--tran',dest='tran',type=int,default=0,required=False,help='transient to be skipped')
 parser.add_argument('--bck',dest='bck',type=str,default='',required=False,help='backup prefix, e.g. \"bck.0.\"')
 parser.add_argument('-f',dest='filename',type=str,default='all_Colvar.data',required=False,help='input file name')
+parser.add_argument('--format',dest='format',type=str,default='text',required=False,help='comma separated output formats: text, npz, hdf5')
 parser.add_argument('-o',dest='outfilename',type=str,default='na-phase_diagram.data',required=False,help='output file name')
+parser.add_argument('--adaptive',dest='adaptive',action='store_true',default=False,help='trace only the coexistence line deltaG=0, instead of computing the full grid')
+parser.add_argument('--coarse',dest='coarse',type=int,default=9,required=False,help='number of temperatures and pressures of the coarse grid used to find the line in adaptive mode')
+parser.add_argument('--step',dest='step',type=float,default=0.02,required=False,help='continuation step along the line, as a fraction of the temperature and pressure ranges')
+parser.add_argument('--refine',dest='refine',type=int,default=0,required=False,help='if positive, also write to the output file the coarse grid refined near the line this many times')
+parser.add_argument('--blocks',dest='num_blocks',type=int,default=10,required=False,help='number of blocks for the error on the line')
+parser.add_argument('--line',dest='line_outfilename',type=str,default='na-coexistence.data',required=False,help='output file name of the coexistence line')
 
 args = parser.parse_args()
+fmts=output.parse_formats(args.format)
 temp=args.temp
 min_temp=args.mintemp
 max_temp=args.maxtemp
@@ -32,8 +58,10 @@ max_pres=args.maxpres*from_bar
 nbins=args.nbins
 outfilename=args.outfilename
 tran=args.tran
+line_outfilename=args.line_outfilename
 if tran:
   outfilename='tran'+str(tran)+'-'+outfilename
+  line_outfilename='tran'+str(tran)+'-'+line_outfilename
   print('  tran =',tran)
 bck=args.bck
 if bck:
@@ -45,30 +73,84 @@ vol_col=2
 cv_col=4
 bias_col=5
 rescale_cv=250 #to have crystallyinity from 0 to 1
-data=pd.read_csv(bck+filename,sep='\s+',comment='#',header=None,usecols=[ene_col,vol_col,cv_col,bias_col],skiprows=tran,dtype=np.float128)
-ene=np.array(data.iloc[:,0])
-vol=np.array(data.iloc[:,1])
-cv=np.array(data.iloc[:,2])
-bias=np.array(data.iloc[:,3])
-del data
-ene-=np.mean(ene)
-vol-=np.mean(vol)
-cv/=rescale_cv
-
 kB=0.0083144621 #kj/mol
 beta=1/(kB*temp)
 temp_range=np.linspace(min_temp,max_temp,nbins)
 pres_range=np.linspace(min_pres,max_pres,nbins)
 t,p=np.meshgrid(temp_range,pres_range)
-def weights(_b,_p):
-  return np.exp((beta-_b)*ene+(beta*pres-_b*_p)*vol+beta*bias)
+def get_phase(cv):
+  return np.where(cv/rescale_cv>0.5,1,np.where(cv/rescale_cv<0.5,0,-1)) #0 is liquid, 1 is bcc
+
+dtype=np.float32 if args.float32 else np.float64
+if args.bootstrap and args.stream:
+  sys.exit(' --bootstrap needs the data in memory, it cannot be used with --stream')
+if args.adaptive and (args.stream or args.bootstrap or args.tol>0 or args.validate):
+  sys.exit(' --adaptive cannot be used with --stream, --bootstrap, --tol or --validate')
+profiling.mark('load')
+if args.stream:
+  (mean_ene,mean_vol),N=stream.means(bck+filename,[ene_col,vol_col],skiprows=tran)
+else:
+  ene,vol,cv,bias=colvar.read_columns(bck+filename,[ene_col,vol_col,cv_col,bias_col],skiprows=tran)
+  ene=reweight.center(ene,dtype)
+  vol=reweight.center(vol,dtype)
+  bias=bias.astype(dtype,copy=False)
+  phase=get_phase(cv)
+  N=len(ene)
+  del cv
+profiling.rows(N)
+if args.adaptive:
+  profiling.mark('coexistence')
+  co=Coexistence(ene,vol,bias,temp,pres,phase,((min_temp,max_temp),(min_pres,max_pres)),args.num_blocks)
+  lines=co.lines(args.coarse,args.step)
+  metadata={'temp':temp,'pres':args.pres,'N':N,'tran':args.tran,'num_blocks':args.num_blocks}
+  if args.refine>0:
+    u,deltaG=co.refine(args.coarse,args.refine)
+    t_map,p_map=co.to_tp(u)
+    output.write_grid(outfilename,['temp','pres','deltaG'],[t_map,p_map/from_bar,deltaG],'#N=%d, refined %d times near the line'%(N,args.refine),metadata,fmts)
+  if len(lines)==0:
+    print(' +++ WARNING: no coexistence line found in the given range +++')
+  columns=[[] for i in range(7)]
+  for n,line in enumerate(lines):
+    for u,(deltaG,grad,deltaH,deltaV,error) in line:
+      t_line,p_line=co.to_tp(u)
+      for c,x in zip(columns,[t_line,p_line/from_bar,error*co.span[0]/abs(grad[0]),error*co.span[1]/abs(grad[1])/from_bar,deltaH,deltaV,n]):
+        c.append(x)
+  profiling.mark('output')
+  names=['temp','pres','temp_err','pres_err','deltaH','deltaV','line']
+  metadata['evaluations']=co.evaluations
+  output.write_grid(line_outfilename,names,[np.array(c) for c in columns],'#N=%d, blocks=%d'%(N,args.num_blocks),metadata,fmts)
+  print('  coexistence line: %d points, %d reweighted (temp,pres) points against %d of the full grid'%(len(columns[0]),co.evaluations,nbins**2))
+else:
+  profiling.mark('reweight')
+  cache=ResultCache(bck+filename,enabled=not args.stream and args.tol<=0,cols=[ene_col,vol_col,cv_col,bias_col],tran=tran,rescale_cv=rescale_cv)
+  def compute(dtype):
+    if args.stream:
+      log_Z=np.full((2,nbins,nbins),-np.inf,dtype=np.result_type(dtype,np.float64))
+      for c_ene,c_vol,c_cv,c_bias in stream.iter_chunks(bck+filename,[ene_col,vol_col,cv_col,bias_col],skiprows=tran,dtype=dtype):
+        rw=Reweighter(c_ene-mean_ene,c_vol-mean_vol,c_bias,temp,pres,labels=get_phase(c_cv),nlabels=2)
+        log_Z=np.logaddexp(log_Z,rw.log_sums(1/(kB*t),p))
+      return log_Z
+    rw=Reweighter(ene.astype(dtype,copy=False),vol.astype(dtype,copy=False),bias.astype(dtype,copy=False),temp,pres,labels=phase,nlabels=2)
+    if args.tol>0:
+      rw=BinnedReweighter(rw,1/(kB*t),p,tol=args.tol)
+      print('  binned index: %d occupied bins, tol=%g'%(rw.nbins,args.tol))
+      return rw.log_sums(1/(kB*t),p)
+    return cache.log_sums(rw,1/(kB*t),p)[0]
+  log_Z=reweight.validate(compute,dtype,args.validate)
+  cache.report()
+  deltaG=-(log_Z[1]-log_Z[0])
+  if args.bootstrap:
+    profiling.mark('bootstrap')
+    rep=bootstrap.bootstrap_log_sums(ene,vol,bias,temp,pres,1/(kB*t),p,labels=phase,nlabels=2,segment_len=max(1,args.boot_block//4),block_len=4,nrep=args.bootstrap,processes=args.nproc or None)[1]
+    deltaG_low,deltaG_high=bootstrap.confidence_interval(-(rep[:,1]-rep[:,0]),args.level)
+  profiling.mark('output')
 
-cmd=subprocess.Popen('bck.meup.sh -i '+outfilename,shell=True)
-cmd.wait()
-outfile=open(outfilename,'w')
-print('#temp  pres  deltaG  #N=%d'%len(ene),file=outfile)
-for i in range(nbins):
-  print('    working... {:.0%}'.format(i/nbins),end='\r')
-  for j in range(nbins):
-    print(t[i,j],p[i,j]/from_bar,-np.log(np.sum(weights(1/(kB*t[i,j]),p[i,j])[cv>0.5])/np.sum(weights(1/(kB*t[i,j]),p[i,j])[cv<0.5])),file=outfile)
-  print('',file=outfile)
+  names=['temp','pres','deltaG']
+  columns=[t,p/from_bar,deltaG]
+  comment='#N=%d'%N
+  if args.bootstrap:
+    names+=['deltaG_low','deltaG_high']
+    columns+=[deltaG_low,deltaG_high]
+    comment+=', %g%% bootstrap interval'%(100*args.level)
+  metadata={'temp':temp,'pres':args.pres,'N':N,'tran':args.tran}
+  output.write_grid(outfilename,names,columns,comment,metadata,fmts)
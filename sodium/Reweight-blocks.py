@@ -2,9 +2,19 @@
 
 import sys
 import numpy as np
-import pandas as pd
-import subprocess
 import argparse
+import os
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),'..'))
+from opes_analysis import colvar
+from opes_analysis import stream
+from opes_analysis import reweight
+from opes_analysis import blocks
+from opes_analysis import kde
+from opes_analysis import bootstrap
+from opes_analysis import output
+from opes_analysis import profiling
+from opes_analysis.reweight import LogSumExp
+from opes_analysis.results import ResultCache
 
 #set columns
 ene_col=1
@@ -18,25 +28,59 @@ rescale_cv=250 #to have crystallyinity from 0 to 1
 
 #parser
 parser = argparse.ArgumentParser(description='reweight as a function of a CV for a given temperature and pressure')
-parser.add_argument('--blocks',dest='num_blocks',type=int,required=True,help='number of blocks')
+parser.add_argument('--blocks',dest='num_blocks',type=int,required=True,help='number of blocks, 0 to use the recommended one from --scan')
+parser.add_argument('--scan',dest='scan',type=int,default=0,required=False,help='also print the error for any number of blocks from 2 up to this')
 parser.add_argument('--temp',dest='temp',type=float,default=400,required=False,help='the simulation temperature')
-parser.add_argument('--rewtemp',dest='rewtemp',type=float,required=True,help='the reweighting temperature')
+parser.add_argument('--rewtemp',dest='rewtemp',type=str,required=True,help='the reweighting temperature, or a comma separated list, or a range min:max:n')
 parser.add_argument('--pres',dest='pres',type=float,default=5000,required=False,help='the simulation pressure (bar)')
-parser.add_argument('--rewpres',dest='rewpres',type=float,required=True,help='the reweighting pressure (bar)')
+parser.add_argument('--rewpres',dest='rewpres',type=str,required=True,help='the reweighting pressure (bar), or a comma separated list, or a range min:max:n')
+parser.add_argument('--paired',dest='paired',action='store_true',default=False,help='with lists, take the temperatures and pressures one by one instead of all their combinations')
 parser.add_argument('--sigma',dest='sigma',type=float,default=0.01,required=False,help='sigma for KDE')
 parser.add_argument('--nbins',dest='nbins',type=int,default=100,required=False,help='number of bins')
+parser.add_argument('--cutoff',dest='cutoff',type=float,default=12,required=False,help='neglect the kernels farther than this many sigmas, where this is below double precision, 0 to sum all of them')
+parser.add_argument('--stream',dest='stream',action='store_true',default=False,help='read the input file in chunks, with memory independent of its length')
+parser.add_argument('--float32',dest='float32',action='store_true',default=False,help='store the bulk arrays in single precision')
+parser.add_argument('--validate',dest='validate',action='store_true',default=False,help='repeat the calculation in float128 and print the deviations')
+parser.add_argument('--bootstrap',dest='bootstrap',type=int,default=0,required=False,help='number of moving-block bootstrap replicas, to print also a confidence interval')
+parser.add_argument('--boot_block',dest='boot_block',type=int,default=1000,required=False,help='length in samples of the bootstrap blocks')
+parser.add_argument('--level',dest='level',type=float,default=0.95,required=False,help='confidence level of the bootstrap interval')
 parser.add_argument('--tran',dest='tran',type=int,default=0,required=False,help='transient to be skipped')
 parser.add_argument('--bck',dest='bck',type=str,default='',required=False,help='backup prefix, e.g. \"bck.0.\"')
 parser.add_argument('-f',dest='filename',type=str,default='all_Colvar.data',required=False,help='input file name')
+parser.add_argument('--format',dest='format',type=str,default='text',required=False,help='comma separated output formats: text, npz, hdf5')
 parser.add_argument('-o',dest='outfilename',type=str,default='FES_rew.data',required=False,help='output file name')
 parser.add_argument('--nomintozero',dest='nomintozero',action='store_true',default=False,help='do not shift the minimum to zero')
 
+def _values(arg):
+  # a single value, a comma separated list, or a range min:max:n
+  if ':' in arg:
+    lo,hi,n=arg.split(':')
+    return np.linspace(float(lo),float(hi),int(n))
+  return np.array([float(v) for v in arg.split(',')])
+
 args = parser.parse_args()
+fmts=output.parse_formats(args.format)
 temp=args.temp
-rewtemp=args.rewtemp
 from_bar=0.06022140857
 pres=args.pres*from_bar
-rewpres=args.rewpres*from_bar
+rew_temps=_values(args.rewtemp)
+rew_press=_values(args.rewpres)
+if args.paired:
+  if len(rew_temps)!=len(rew_press) and min(len(rew_temps),len(rew_press))>1:
+    sys.exit(' --paired needs the same number of temperatures and pressures')
+  rew_temps,rew_press=np.broadcast_arrays(rew_temps,rew_press)
+else:
+  rew_temps,rew_press=[np.ravel(g) for g in np.meshgrid(rew_temps,rew_press,indexing='ij')]
+stack=len(rew_temps)>1 #a whole stack of FES, one for each (rewtemp,rewpres)
+if stack:
+  if args.bootstrap:
+    sys.exit(' --bootstrap is only available for a single temperature and pressure')
+  rewtemp=rew_temps
+  rewpres=rew_press*from_bar
+  print('  stack of %d (temp,pres) points'%len(rew_temps))
+else:
+  rewtemp=rew_temps[0]
+  rewpres=rew_press[0]*from_bar
 sigma=args.sigma
 nbins=args.nbins
 outfilename=args.outfilename
@@ -49,47 +93,189 @@ if bck:
   print('  backup: '+bck)
 filename=args.filename
 
-data=pd.read_csv(bck+filename,sep='\s+',comment='#',header=None,usecols=[ene_col,vol_col,cv_col,bias_col],skiprows=tran,dtype=np.float128)
-ene=np.array(data.iloc[:,0])
-vol=np.array(data.iloc[:,1])
-cv=np.array(data.iloc[:,2])
-bias=np.array(data.iloc[:,3])
-del data
-ene-=np.mean(ene)
-vol-=np.mean(vol)
-cv/=rescale_cv
-
 kB=0.0083144621 #kj/mol
 beta=1/(kB*temp)
 rewbeta=1/(kB*rewtemp)
 cv_grid=np.linspace(cv_min,cv_max,nbins)
 
-cmd=subprocess.Popen('bck.meup.sh -i '+outfilename,shell=True)
-cmd.wait()
-
 num_blocks=args.num_blocks
-len_blocks=int(np.floor(len(cv)/num_blocks))
-if num_blocks*len_blocks!=len(cv):
-  print(' +++ WARNING blocks mismatch: throwing away last %d lines'%(len(cv)-num_blocks*len_blocks))
+if num_blocks<=0 and args.scan<2:
+  sys.exit(' --blocks 0 requires --scan')
+dtype=np.float32 if args.float32 else np.float64
+profiling.mark('load')
+if args.stream:
+  (mean_ene,mean_vol),N=stream.means(bck+filename,[ene_col,vol_col],skiprows=tran)
+else:
+  ene,vol,cv,bias=colvar.read_columns(bck+filename,[ene_col,vol_col,cv_col,bias_col],skiprows=tran)
+  ene=reweight.center(ene,dtype)
+  vol=reweight.center(vol,dtype)
+  cv=(cv/rescale_cv).astype(dtype,copy=False)
+  bias=bias.astype(dtype,copy=False)
+  N=len(cv)
+profiling.rows(N)
+scan=blocks.BlockScan(N,[num_blocks]+list(range(2,args.scan+1)),skip_first=False)
+boot_len=max(1,args.boot_block//4) #each bootstrap block is made of 4 segments
+boot_nsegments=-(-N//boot_len)
+
+def chunks(dtype):
+  if args.stream:
+    size=max(1,reweight.max_size//max(nbins,len(rew_temps))) if stack else None
+    for c_ene,c_vol,c_cv,c_bias in stream.iter_chunks(bck+filename,[ene_col,vol_col,cv_col,bias_col],skiprows=tran,dtype=dtype,size=size):
+      yield c_ene-mean_ene,c_vol-mean_vol,c_cv/rescale_cv,c_bias
+  else:
+    if stack:
+      size=max(1,reweight.max_size//max(nbins,len(rew_temps)))
+    else:
+      size=max(1,reweight.max_size//(1 if args.cutoff>0 else nbins))
+    for n in range(0,N,size):
+      yield [x[n:n+size].astype(dtype,copy=False) for x in (ene,vol,cv,bias)]
+
+def _starts(labels):
+  starts=np.flatnonzero(np.r_[True,labels[1:]!=labels[:-1]])
+  return starts,labels[starts]
+
+def compute_stack(dtype):
+  #the log-weights of all the (rewtemp,rewpres) at once, shape (ntargets,n), and a matrix product with the kernels
+  acc_dtype=np.result_type(dtype,np.float64)
+  log_block_w=LogSumExp((len(rewtemp),scan.nsegments),dtype=acc_dtype)
+  log_prob=LogSumExp((len(rewtemp),nbins,scan.nsegments),dtype=acc_dtype)
+  a=(beta-rewbeta)[:,np.newaxis]
+  b=(beta*pres-rewbeta*rewpres)[:,np.newaxis]
+  first=0
+  progress=output.Progress(N)
+  for ene,vol,cv,bias in chunks(dtype):
+    progress.update(first)
+    segments=scan.labels(first,len(cv))
+    log_w=a*ene.astype(acc_dtype)+b*vol.astype(acc_dtype)+beta*bias.astype(acc_dtype)
+    log_block_w.add_unsorted(log_w,segments)
+    log_prob.add_log(np.swapaxes(kde.stacked_log_sums(cv,log_w,cv_grid,sigma,segments,scan.nsegments),1,2))
+    first+=len(cv)
+  return log_block_w.result(),log_prob.result()
+
+def compute(dtype):
+  #accumulate log-sums for each segment of the blocks and grid point
+  if stack:
+    return compute_stack(dtype)
+  acc_dtype=np.result_type(dtype,np.float64)
+  log_block_w=LogSumExp(scan.nsegments,dtype=acc_dtype)
+  log_prob=LogSumExp((nbins,scan.nsegments),dtype=acc_dtype)
+  if args.bootstrap:
+    boot_w=LogSumExp(boot_nsegments,dtype=acc_dtype)
+    boot_prob=LogSumExp((nbins,boot_nsegments),dtype=acc_dtype)
+  bound=0
+  first=0
+  progress=output.Progress(N)
+  for ene,vol,cv,bias in chunks(dtype):
+    progress.update(first)
+    segments=scan.labels(first,len(cv))
+    log_w=(beta-rewbeta)*ene.astype(acc_dtype)+(beta*pres-rewbeta*rewpres)*vol.astype(acc_dtype)+beta*bias.astype(acc_dtype)
+    log_block_w.add_unsorted(log_w,segments)
+    if args.bootstrap:
+      boot_segments=np.arange(first,first+len(cv))//boot_len
+      boot_w.add(log_w,*_starts(boot_segments))
+    if args.cutoff>0:
+      #only the samples within cutoff*sigma of each bin, the sums are then added as single values
+      log_sums,b=kde.truncated_log_sums(cv,log_w,cv_grid,sigma,segments,scan.nsegments,args.cutoff)
+      log_prob.add_log(log_sums.T)
+      bound=max(bound,b)
+      if args.bootstrap:
+        log_sums,b=kde.truncated_log_sums(cv,log_w,cv_grid,sigma,boot_segments,boot_nsegments,args.cutoff)
+        bound=max(bound,b)
+        boot_prob.add_log(log_sums.T)
+    else:
+      log_kernel=log_w-0.5*((cv_grid.astype(acc_dtype)[:,np.newaxis]-cv.astype(acc_dtype))/sigma)**2
+      log_prob.add_unsorted(log_kernel,segments)
+      if args.bootstrap:
+        boot_prob.add(log_kernel,*_starts(boot_segments))
+    first+=len(cv)
+  if args.cutoff>0:
+    print(' truncated KDE: kernels beyond %g sigma neglected, with relative error below %g'%(args.cutoff,bound))
+  if args.bootstrap:
+    return log_block_w.result(),log_prob.result(),boot_w.result(),boot_prob.result()
+  return log_block_w.result(),log_prob.result()
+cache=ResultCache(bck+filename,cols=[ene_col,vol_col,cv_col,bias_col],tran=tran,rescale_cv=rescale_cv,stream=args.stream)
+def cached_compute(dtype):
+  if stack:
+    return cache.get('block_kde_stack',lambda: compute(dtype),temp=temp,pres=pres,rewtemp=rewtemp.tolist(),rewpres=rewpres.tolist(),sigma=sigma,cv_grid=[cv_min,cv_max,nbins],
+                     segments=scan.bounds.tolist(),dtype=str(np.dtype(dtype)))
+  return cache.get('block_kde',lambda: compute(dtype),temp=temp,pres=pres,rewtemp=rewtemp,rewpres=rewpres,sigma=sigma,cutoff=args.cutoff,cv_grid=[cv_min,cv_max,nbins],
+                   segments=scan.bounds.tolist(),boot_len=boot_len if args.bootstrap else 0,dtype=str(np.dtype(dtype)))
+profiling.mark('reweight')
+sums=reweight.validate(cached_compute,dtype,args.validate)
+cache.report()
+log_block_w,log_prob=sums[:2]
+profiling.mark('blocks')
+if args.bootstrap:
+  counts=bootstrap.resample_counts(boot_nsegments,4,args.bootstrap)
+  rep_fes=-(bootstrap.replica_log_sums(sums[3].T,counts)-bootstrap.replica_log_sums(sums[2],counts)[:,np.newaxis])
+  #the replicas are normalized by their total weight, the interval is their spread around the same estimate from all the data
+  boot_fes=-(np.logaddexp.reduce(sums[3],axis=-1)-np.logaddexp.reduce(sums[2]))
+  if not args.nomintozero:
+    rep_fes-=np.amin(rep_fes,axis=1,keepdims=True)
+    boot_fes-=np.amin(boot_fes)
+  dev_low,dev_high=bootstrap.confidence_interval(rep_fes-boot_fes,args.level)
+
+def block_stats(num_blocks):
+  #weighted average over the blocks, without leaving log space, with a leading axis for the stack
+  lbw=scan.block_log_sums(log_block_w,num_blocks)[...,np.newaxis,:]
+  lp=scan.block_log_sums(log_prob,num_blocks)
+  #av_fes=np.average(-np.log(prob),axis=0,weights=block_w)
+  #blocks_var=blocks_neff/(blocks_neff-1)*np.average((-np.log(prob)-av_fes)**2,axis=0,weights=block_w)
+  log_av_prob=np.logaddexp.reduce(lp+blocks.normalize(lbw),axis=-1)
+  error=blocks.block_error(np.exp(lp-log_av_prob[...,np.newaxis]),lbw,np.ones(nbins)) #already divided by av_prob, for error propagation
+  av_fes=-log_av_prob
+  if not args.nomintozero:
+    av_fes-=np.amin(av_fes,axis=-1,keepdims=True)
+  return av_fes,error,blocks.blocks_neff(lbw[...,0,:])
 
-weight=np.exp((beta-rewbeta)*ene+(beta*pres-rewbeta*rewpres)*vol+beta*bias)
-block_w=np.zeros(num_blocks)
-prob=np.zeros((num_blocks,nbins))
-for n in range(num_blocks):
-  for i in range(nbins):
-    print('    working... {:.0%}'.format((n*nbins+i)/nbins/num_blocks),end='\r')
-    block_w[n]=np.sum(weight[n*len_blocks:(n+1)*len_blocks])
-    prob[n,i]=np.sum(weight[n*len_blocks:(n+1)*len_blocks]*np.exp(-0.5*((cv_grid[i]-cv[n*len_blocks:(n+1)*len_blocks])/sigma)**2))
-blocks_neff=np.sum(block_w)**2/np.sum(block_w**2)
-#av_fes=np.average(-np.log(prob),axis=0,weights=block_w)
-#blocks_var=blocks_neff/(blocks_neff-1)*np.average((-np.log(prob)-av_fes)**2,axis=0,weights=block_w)
-av_prob=np.average(prob,axis=0,weights=block_w)
-blocks_var=blocks_neff/(blocks_neff-1)*np.average((prob-av_prob)**2,axis=0,weights=block_w)
-error=np.sqrt(blocks_var/blocks_neff)
+if args.scan:
+  counts=scan.counts[::-1] #increasing block size
+  stats=[block_stats(n) for n in counts]
+  errors=np.stack([st[1] for st in stats],axis=-1)
+  neffs=np.stack([np.broadcast_to(np.expand_dims(st[2],-1),errors.shape[:-1]) for st in stats],axis=-1)
+  best=blocks.plateau(errors,neffs)
+  if num_blocks<=0:
+    num_blocks=counts[blocks.recommended(errors,neffs)]
+    print(' recommended num_blocks=',num_blocks)
+  scanfilename='blocks-'+outfilename
+  n=np.array(counts)
+  shape=errors.shape
+  columns=[np.broadcast_to(cv_grid[:,np.newaxis],shape),np.broadcast_to(n,shape),np.broadcast_to(scan.nrows//n,shape),
+           np.stack([st[0] for st in stats],axis=-1),errors,neffs,best[...,np.newaxis]==np.arange(len(n))]
+  names=['cv','num_blocks','len_blocks','FES','error','blocks_neff','recommended']
+  fmt=['%.12g','%d','%d','%.12g','%.12g','%.12g','%d']
+  if stack:
+    #one block of lines for each (index,cv)
+    columns=[np.broadcast_to(c[:,np.newaxis,np.newaxis],shape) for c in (np.arange(len(rewtemp)),rewtemp,rewpres/from_bar)]+columns
+    columns=[c.reshape(-1,len(n)) for c in columns]
+    names=['index','rewtemp','rewpres']+names
+    fmt=['%d','%g','%g']+fmt
+    comment='#stack of %d (temp,pres) points'%len(rewtemp)
+  else:
+    comment='#temp= %g K, pres= %g bar'%(rewtemp,rewpres/from_bar)
+  metadata={'temp':args.temp,'pres':args.pres,'rewtemp':np.ravel(rewtemp).tolist() if stack else rewtemp,'rewpres':rew_press.tolist() if stack else rew_press[0],'N':N,'tran':args.tran}
+  output.write_grid(scanfilename,names,columns,comment,metadata,fmts,fmt=fmt)
 
-av_fes=-np.log(av_prob)
-error/=av_prob #error propagation
-if not args.nomintozero:
-  av_fes-=min(av_fes)
+if scan.skip(num_blocks)!=0:
+  print(' +++ WARNING blocks mismatch: throwing away last %d lines'%scan.skip(num_blocks))
+av_fes,error,blocks_neff=block_stats(num_blocks)
+profiling.mark('output')
 
-np.savetxt(outfilename,np.c_[cv_grid,av_fes,error],header='cv FES error #temp= %g K, pres= %g bar, blocks_neff=%g'%(rewtemp,rewpres/from_bar,blocks_neff))
+if stack:
+  #a single file with one block of lines for each index, e.g. for gnuplot: every :::k::k
+  shape=av_fes.shape
+  names=['index','rewtemp','rewpres','cv','FES','error','blocks_neff']
+  columns=[np.broadcast_to(c,shape) for c in (np.arange(len(rewtemp))[:,np.newaxis],rewtemp[:,np.newaxis],rewpres[:,np.newaxis]/from_bar,cv_grid,av_fes,error,blocks_neff[:,np.newaxis])]
+  comment='#stack of %d (temp,pres) points'%len(rewtemp)
+  metadata={'temp':args.temp,'pres':args.pres,'rewtemp':rewtemp.tolist(),'rewpres':rew_press.tolist(),'N':N,'tran':args.tran,'num_blocks':num_blocks,'blocks_neff':blocks_neff.tolist()}
+  output.write_grid(outfilename,names,columns,comment,metadata,fmts,fmt=['%d','%g','%g']+['%.18e']*4)
+else:
+  names=['cv','FES','error']
+  columns=[cv_grid,av_fes,error]
+  comment='#temp= %g K, pres= %g bar, blocks_neff=%g'%(rewtemp,rewpres/from_bar,blocks_neff)
+  if args.bootstrap:
+    names+=['FES_low','FES_high']
+    columns+=[av_fes+dev_low,av_fes+dev_high]
+    comment+=', %g%% bootstrap interval'%(100*args.level)
+  metadata={'temp':args.temp,'pres':args.pres,'rewtemp':rewtemp,'rewpres':rew_press[0],'N':N,'tran':args.tran,'num_blocks':num_blocks,'blocks_neff':blocks_neff}
+  output.write_grid(outfilename,names,columns,comment,metadata,fmts,fmt='%.18e')